@@ -150,8 +150,8 @@ def optimise_rgb(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
 @cython.wraparound(False)
 @cython.cdivision(True)
 @cython.warn.undeclared(True)
-def optimise_gray2(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
-        np.ndarray[UINT8DTYPE_t, ndim=2] img, int width, int height, int n_size):
+def optimise_gray2(const UINT8DTYPE_t[:, ::1] mask,
+        const UINT8DTYPE_t[:, ::1] img, int width, int height, int n_size):
     """
     "Optimises" an input image for JPEG2000 compression, it does this by
     radiating pixels in the mask to pixels not in the mask, downwards and to the
@@ -168,9 +168,12 @@ def optimise_gray2(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
     * height (int): mask/img height
     * n_size: window size
 
+    The computation runs without holding the GIL.
+
     Returns a new image (numpy.ndarray[numpy.uint8, ndim=2])
     """
-    cdef np.ndarray[UINT8DTYPE_t, ndim=2] new_img
+    cdef np.ndarray[UINT8DTYPE_t, ndim=2] new_img_arr
+    cdef UINT8DTYPE_t[:, ::1] new_img
     cdef int x, y
     cdef int val_count, val, ys, ye, xs, xe, xx, yy
     cdef int ifysc, ifyec, iiysc, iiyec, ifxsc, ifxec, iixsc, iixec
@@ -180,9 +183,9 @@ def optimise_gray2(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
 
     # This function computes a FIR and IIR version of the box blur filter incrementally
     # As seen above
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_val = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_mask = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_iir_val = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] inc_fir_val = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] inc_fir_mask = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] inc_iir_val = np.zeros([width], dtype=INTDTYPE)
 
     # incremental cursors that track y-dimension FIR filter window borders
     ifysc = 0
@@ -192,100 +195,102 @@ def optimise_gray2(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
     iiysc = 0
     iiyec = 0
 
-    new_img = np.copy(img)
-    for y in range(0, height):
-        #print('loop y')
-        ys = max(0, y - n_size)
-        ye = min(height, y + n_size)
-        # Update y-dimension FIR window
-        while ifysc < ys:
-            for x in range(0, width):
-                if mask[ifysc, x]:
-                    inc_fir_val[x] -= img[ifysc, x]
-                    inc_fir_mask[x] -= 1
-            ifysc += 1
-        while ifyec < ye:
-            for x in range(0, width):
-                if mask[ifyec, x]:
-                    inc_fir_val[x] += img[ifyec, x]
-                    inc_fir_mask[x] += 1
-            ifyec += 1
-        while iiysc < ys:
-            for x in range(0, width):
-                inc_iir_val[x] -= new_img[iiysc, x]
-            iiysc += 1
-        while iiyec < y:
-            for x in range(0, width):
-                inc_iir_val[x] += new_img[iiyec, x]
-            iiyec += 1
-
-        # incremental cursors that track x-dimension FIR filter window borders
-        ifxsc = 0
-        ifxec = 0
-
-        # incremental cursors that track x-dimension IIR filter window borders
-        iixsc = 0
-        iixec = 0
-
-        # incremental FIR value/mask
-        inc_fir_px_val = 0
-        inc_fir_px_mask = 0
-
-        # incremental IIR value
-        inc_iir_px_val = 0
-
-        for x in range(0, width):
-            xs = max(0, x - n_size)
-            xe = min(width, x + n_size)
-
-            # Update x-dimension FIR window
-            while ifxsc < xs:
-                inc_fir_px_val -= inc_fir_val[ifxsc]
-                inc_fir_px_mask -= inc_fir_mask[ifxsc]
-                ifxsc += 1
-            while ifxec < xe:
-                inc_fir_px_val += inc_fir_val[ifxec]
-                inc_fir_px_mask += inc_fir_mask[ifxec]
-                ifxec += 1
-            while iixsc < xs:
-                inc_iir_px_val -= inc_iir_val[iixsc]
-                iixsc += 1
-            while iixec < x:
-                inc_iir_px_val += inc_iir_val[iixec]
-                iixec += 1
-
-            if not mask[y, x]:
-                val_count = 0
-                val = 0
-
-                iir_window_size = (y - ys) * (x - xs)
+    new_img_arr = np.array(img, dtype=UINT8DTYPE)
+    new_img = new_img_arr
+
+    with nogil:
+        for y in range(0, height):
+            ys = max(0, y - n_size)
+            ye = min(height, y + n_size)
+            # Update y-dimension FIR window
+            while ifysc < ys:
+                for x in range(0, width):
+                    if mask[ifysc, x]:
+                        inc_fir_val[x] -= img[ifysc, x]
+                        inc_fir_mask[x] -= 1
+                ifysc += 1
+            while ifyec < ye:
+                for x in range(0, width):
+                    if mask[ifyec, x]:
+                        inc_fir_val[x] += img[ifyec, x]
+                        inc_fir_mask[x] += 1
+                ifyec += 1
+            while iiysc < ys:
+                for x in range(0, width):
+                    inc_iir_val[x] -= new_img[iiysc, x]
+                iiysc += 1
+            while iiyec < y:
+                for x in range(0, width):
+                    inc_iir_val[x] += new_img[iiyec, x]
+                iiyec += 1
+
+            # incremental cursors that track x-dimension FIR filter window borders
+            ifxsc = 0
+            ifxec = 0
+
+            # incremental cursors that track x-dimension IIR filter window borders
+            iixsc = 0
+            iixec = 0
+
+            # incremental FIR value/mask
+            inc_fir_px_val = 0
+            inc_fir_px_mask = 0
+
+            # incremental IIR value
+            inc_iir_px_val = 0
 
-                val = inc_fir_px_val + inc_iir_px_val
-                val_count = inc_fir_px_mask + iir_window_size
-
-                if val_count > 0:
-                    new_img[y, x] = val / val_count
-                else:
-                    new_img[y, x] = 0
-            #else:
-            #    new_img[y, x] = img[y, x]
+            for x in range(0, width):
+                xs = max(0, x - n_size)
+                xe = min(width, x + n_size)
 
-    return new_img
+                # Update x-dimension FIR window
+                while ifxsc < xs:
+                    inc_fir_px_val -= inc_fir_val[ifxsc]
+                    inc_fir_px_mask -= inc_fir_mask[ifxsc]
+                    ifxsc += 1
+                while ifxec < xe:
+                    inc_fir_px_val += inc_fir_val[ifxec]
+                    inc_fir_px_mask += inc_fir_mask[ifxec]
+                    ifxec += 1
+                while iixsc < xs:
+                    inc_iir_px_val -= inc_iir_val[iixsc]
+                    iixsc += 1
+                while iixec < x:
+                    inc_iir_px_val += inc_iir_val[iixec]
+                    iixec += 1
+
+                if not mask[y, x]:
+                    val_count = 0
+                    val = 0
+
+                    iir_window_size = (y - ys) * (x - xs)
+
+                    val = inc_fir_px_val + inc_iir_px_val
+                    val_count = inc_fir_px_mask + iir_window_size
+
+                    if val_count > 0:
+                        new_img[y, x] = val / val_count
+                    else:
+                        new_img[y, x] = 0
+                #else:
+                #    new_img[y, x] = img[y, x]
+
+    return new_img_arr
 
 
-#@cython.boundscheck(False)
-#@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
 @cython.cdivision(True)
 @cython.warn.undeclared(True)
-def optimise_rgb2(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
-        np.ndarray[UINT8DTYPE_t, ndim=3] img, int width, int height, int n_size):
+def optimise_rgb2(const UINT8DTYPE_t[:, ::1] mask,
+        const UINT8DTYPE_t[:, :, ::1] img, int width, int height, int n_size):
     """
     "Optimises" an input image for JPEG2000 compression, it does this by
     radiating pixels in the mask to pixels not in the mask, downwards and to the
     right. This (hopefully) allows for more optimal lossy compression of the
     pixels in the mask.
 
-    Fast and RGB version
+    Fast and RGB version. The computation runs without holding the GIL.
 
     Args:
 
@@ -297,7 +302,8 @@ def optimise_rgb2(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
 
     Returns a new image (numpy.ndarray[numpy.uint8, ndim=3])
     """
-    cdef np.ndarray[UINT8DTYPE_t, ndim=3] new_img
+    cdef np.ndarray[UINT8DTYPE_t, ndim=3] new_img_arr
+    cdef UINT8DTYPE_t[:, :, ::1] new_img
     cdef int x, y
     cdef int val_count, ys, ye, xs, xe, xx, yy
     cdef int r, g, b
@@ -308,13 +314,13 @@ def optimise_rgb2(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
 
     # This function computes a FIR and IIR version of the box blur filter incrementally
     # As seen above
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_r = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_g = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_b = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_iir_r = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_iir_g = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_iir_b = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_mask = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] inc_fir_r = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] inc_fir_g = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] inc_fir_b = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] inc_iir_r = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] inc_iir_g = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] inc_iir_b = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] inc_fir_mask = np.zeros([width], dtype=INTDTYPE)
 
     # incremental cursors that track y-dimension FIR filter window borders
     ifysc = 0
@@ -324,149 +330,709 @@ def optimise_rgb2(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
     iiysc = 0
     iiyec = 0
 
-    new_img = np.copy(img)
-    for y in range(0, height):
-        ys = max(0, y - n_size)
-        ye = min(height, y + n_size)
-        # Update y-dimension FIR window
-        while ifysc < ys:
-            for x in range(0, width):
-                if mask[ifysc, x]:
-                    inc_fir_r[x] -= img[ifysc, x, 0]
-                    inc_fir_g[x] -= img[ifysc, x, 1]
-                    inc_fir_b[x] -= img[ifysc, x, 2]
-                    inc_fir_mask[x] -= 1
-            ifysc += 1
-        while ifyec < ye:
-            for x in range(0, width):
-                if mask[ifyec, x]:
-                    inc_fir_r[x] += img[ifyec, x, 0]
-                    inc_fir_g[x] += img[ifyec, x, 1]
-                    inc_fir_b[x] += img[ifyec, x, 2]
-                    inc_fir_mask[x] += 1
-            ifyec += 1
-        while iiysc < ys:
-            for x in range(0, width):
-                inc_iir_r[x] -= new_img[iiysc, x, 0]
-                inc_iir_g[x] -= new_img[iiysc, x, 1]
-                inc_iir_b[x] -= new_img[iiysc, x, 2]
-            iiysc += 1
-        while iiyec < y:
+    new_img_arr = np.array(img, dtype=UINT8DTYPE)
+    new_img = new_img_arr
+
+    with nogil:
+        for y in range(0, height):
+            ys = max(0, y - n_size)
+            ye = min(height, y + n_size)
+            # Update y-dimension FIR window
+            while ifysc < ys:
+                for x in range(0, width):
+                    if mask[ifysc, x]:
+                        inc_fir_r[x] -= img[ifysc, x, 0]
+                        inc_fir_g[x] -= img[ifysc, x, 1]
+                        inc_fir_b[x] -= img[ifysc, x, 2]
+                        inc_fir_mask[x] -= 1
+                ifysc += 1
+            while ifyec < ye:
+                for x in range(0, width):
+                    if mask[ifyec, x]:
+                        inc_fir_r[x] += img[ifyec, x, 0]
+                        inc_fir_g[x] += img[ifyec, x, 1]
+                        inc_fir_b[x] += img[ifyec, x, 2]
+                        inc_fir_mask[x] += 1
+                ifyec += 1
+            while iiysc < ys:
+                for x in range(0, width):
+                    inc_iir_r[x] -= new_img[iiysc, x, 0]
+                    inc_iir_g[x] -= new_img[iiysc, x, 1]
+                    inc_iir_b[x] -= new_img[iiysc, x, 2]
+                iiysc += 1
+            while iiyec < y:
+                for x in range(0, width):
+                    inc_iir_r[x] += new_img[iiyec, x, 0]
+                    inc_iir_g[x] += new_img[iiyec, x, 1]
+                    inc_iir_b[x] += new_img[iiyec, x, 2]
+                iiyec += 1
+
+            # incremental cursors that track x-dimension FIR filter window borders
+            ifxsc = 0
+            ifxec = 0
+
+            # incremental cursors that track x-dimension IIR filter window borders
+            iixsc = 0
+            iixec = 0
+
+            # incremental FIR value/mask
+            inc_fir_px_r = 0
+            inc_fir_px_g = 0
+            inc_fir_px_b = 0
+            inc_fir_px_mask = 0
+
+            # incremental IIR value
+            inc_iir_px_r = 0
+            inc_iir_px_g = 0
+            inc_iir_px_b = 0
+
             for x in range(0, width):
-                inc_iir_r[x] += new_img[iiyec, x, 0]
-                inc_iir_g[x] += new_img[iiyec, x, 1]
-                inc_iir_b[x] += new_img[iiyec, x, 2]
-            iiyec += 1
-
-        # incremental cursors that track x-dimension FIR filter window borders
-        ifxsc = 0
-        ifxec = 0
-
-        # incremental cursors that track x-dimension IIR filter window borders
-        iixsc = 0
-        iixec = 0
-
-        # incremental FIR value/mask
-        inc_fir_px_r = 0
-        inc_fir_px_g = 0
-        inc_fir_px_b = 0
-        inc_fir_px_mask = 0
-
-        # incremental IIR value
-        inc_iir_px_r = 0
-        inc_iir_px_g = 0
-        inc_iir_px_b = 0
+                xs = max(0, x - n_size)
+                xe = min(width, x + n_size)
 
-        for x in range(0, width):
-            xs = max(0, x - n_size)
-            xe = min(width, x + n_size)
-
-            # Update x-dimension FIR window
-            while ifxsc < xs:
-                inc_fir_px_r -= inc_fir_r[ifxsc]
-                inc_fir_px_g -= inc_fir_g[ifxsc]
-                inc_fir_px_b -= inc_fir_b[ifxsc]
-                inc_fir_px_mask -= inc_fir_mask[ifxsc]
-                ifxsc += 1
-            while ifxec < xe:
-                inc_fir_px_r += inc_fir_r[ifxec]
-                inc_fir_px_g += inc_fir_g[ifxec]
-                inc_fir_px_b += inc_fir_b[ifxec]
-                inc_fir_px_mask += inc_fir_mask[ifxec]
-                ifxec += 1
-            while iixsc < xs:
-                inc_iir_px_r -= inc_iir_r[iixsc]
-                inc_iir_px_g -= inc_iir_g[iixsc]
-                inc_iir_px_b -= inc_iir_b[iixsc]
-                iixsc += 1
-            while iixec < x:
-                inc_iir_px_r += inc_iir_r[iixec]
-                inc_iir_px_g += inc_iir_g[iixec]
-                inc_iir_px_b += inc_iir_b[iixec]
-                iixec += 1
+                # Update x-dimension FIR window
+                while ifxsc < xs:
+                    inc_fir_px_r -= inc_fir_r[ifxsc]
+                    inc_fir_px_g -= inc_fir_g[ifxsc]
+                    inc_fir_px_b -= inc_fir_b[ifxsc]
+                    inc_fir_px_mask -= inc_fir_mask[ifxsc]
+                    ifxsc += 1
+                while ifxec < xe:
+                    inc_fir_px_r += inc_fir_r[ifxec]
+                    inc_fir_px_g += inc_fir_g[ifxec]
+                    inc_fir_px_b += inc_fir_b[ifxec]
+                    inc_fir_px_mask += inc_fir_mask[ifxec]
+                    ifxec += 1
+                while iixsc < xs:
+                    inc_iir_px_r -= inc_iir_r[iixsc]
+                    inc_iir_px_g -= inc_iir_g[iixsc]
+                    inc_iir_px_b -= inc_iir_b[iixsc]
+                    iixsc += 1
+                while iixec < x:
+                    inc_iir_px_r += inc_iir_r[iixec]
+                    inc_iir_px_g += inc_iir_g[iixec]
+                    inc_iir_px_b += inc_iir_b[iixec]
+                    iixec += 1
+
+                if not mask[y, x]:
+                    val_count = 0
+
+                    iir_window_size = (y - ys) * (x - xs)
+
+                    b = inc_fir_px_b + inc_iir_px_b
+                    g = inc_fir_px_g + inc_iir_px_g
+                    r = inc_fir_px_r + inc_iir_px_r
+                    val_count = inc_fir_px_mask + iir_window_size
+
+                    if val_count > 0:
+                        new_img[y, x, 0] = r / val_count
+                        new_img[y, x, 1] = g / val_count
+                        new_img[y, x, 2] = b / val_count
+                    else:
+                        new_img[y, x, 0] = 0
+                        new_img[y, x, 1] = 0
+                        new_img[y, x, 2] = 0
+                #else:
+                #    new_img[y, x] = img[y, x]
+
+    return new_img_arr
+
+
+# Maximum amount of channels supported by optimise_fgbg
+cdef enum:
+    MAX_CHANNELS = 4
+
+
+cdef inline int _mask_get(const UINT8DTYPE_t *mask_row, int x,
+                          int packed) nogil:
+    """
+    Returns 1 if pixel x of a (bit packed if packed is set) mask row is set
+    """
+    if packed:
+        return (mask_row[x >> 3] >> (7 - (x & 7))) & 1
+    return mask_row[x] != 0
 
-            if not mask[y, x]:
-                val_count = 0
 
-                iir_window_size = (y - ys) * (x - xs)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+@cython.warn.undeclared(True)
+cdef void _optimise_layer_row(const UINT8DTYPE_t[:, ::1] mask,
+        const UINT8DTYPE_t[:, :, ::1] img, int width, int height, int channels,
+        int y, int n_size, int keep, int packed, INTDTYPE_t[:, ::1] fir_val,
+        INTDTYPE_t[::1] fir_cnt, INTDTYPE_t[:, ::1] iir_val,
+        UINT8DTYPE_t[:, :, ::1] ring, int[::1] cursors) nogil:
+    """
+    Compute row y of one layer for optimise_fgbg, this is the same
+    incremental FIR/IIR box filter as optimise_gray2/optimise_rgb2, except that
+    only the last n_size + 1 rows of the output are kept (in ring), and that
+    pixels are kept where mask == keep.
+
+    cursors holds the ifysc, ifyec, iiysc and iiyec cursors between calls.
+    """
+    cdef int x, c, ys, ye, xs, xe, val_count, ring_size
+    cdef int ifxsc, ifxec, iixsc, iixec
+    cdef INTDTYPE_t inc_fir_px_mask
+    cdef INTDTYPE_t inc_fir_px_val[MAX_CHANNELS]
+    cdef INTDTYPE_t inc_iir_px_val[MAX_CHANNELS]
+    cdef const UINT8DTYPE_t *mask_row
+
+    ring_size = n_size + 1
 
-                b = inc_fir_px_b + inc_iir_px_b
-                g = inc_fir_px_g + inc_iir_px_g
-                r = inc_fir_px_r + inc_iir_px_r
-                val_count = inc_fir_px_mask + iir_window_size
+    ys = max(0, y - n_size)
+    ye = min(height, y + n_size)
 
+    # Update y-dimension FIR window
+    while cursors[0] < ys:
+        mask_row = &mask[cursors[0], 0]
+        for x in range(0, width):
+            if _mask_get(mask_row, x, packed) == keep:
+                for c in range(0, channels):
+                    fir_val[x, c] -= img[cursors[0], x, c]
+                fir_cnt[x] -= 1
+        cursors[0] += 1
+    while cursors[1] < ye:
+        mask_row = &mask[cursors[1], 0]
+        for x in range(0, width):
+            if _mask_get(mask_row, x, packed) == keep:
+                for c in range(0, channels):
+                    fir_val[x, c] += img[cursors[1], x, c]
+                fir_cnt[x] += 1
+        cursors[1] += 1
+    # Update y-dimension IIR window, the rows are taken from the ring buffer
+    while cursors[2] < ys:
+        for x in range(0, width):
+            for c in range(0, channels):
+                iir_val[x, c] -= ring[cursors[2] % ring_size, x, c]
+        cursors[2] += 1
+    while cursors[3] < y:
+        for x in range(0, width):
+            for c in range(0, channels):
+                iir_val[x, c] += ring[cursors[3] % ring_size, x, c]
+        cursors[3] += 1
+
+    ifxsc = 0
+    ifxec = 0
+    iixsc = 0
+    iixec = 0
+
+    inc_fir_px_mask = 0
+    for c in range(0, channels):
+        inc_fir_px_val[c] = 0
+        inc_iir_px_val[c] = 0
+
+    mask_row = &mask[y, 0]
+    for x in range(0, width):
+        xs = max(0, x - n_size)
+        xe = min(width, x + n_size)
+
+        # Update x-dimension FIR/IIR windows
+        while ifxsc < xs:
+            for c in range(0, channels):
+                inc_fir_px_val[c] -= fir_val[ifxsc, c]
+            inc_fir_px_mask -= fir_cnt[ifxsc]
+            ifxsc += 1
+        while ifxec < xe:
+            for c in range(0, channels):
+                inc_fir_px_val[c] += fir_val[ifxec, c]
+            inc_fir_px_mask += fir_cnt[ifxec]
+            ifxec += 1
+        while iixsc < xs:
+            for c in range(0, channels):
+                inc_iir_px_val[c] -= iir_val[iixsc, c]
+            iixsc += 1
+        while iixec < x:
+            for c in range(0, channels):
+                inc_iir_px_val[c] += iir_val[iixec, c]
+            iixec += 1
+
+        if _mask_get(mask_row, x, packed) == keep:
+            for c in range(0, channels):
+                ring[y % ring_size, x, c] = img[y, x, c]
+        else:
+            val_count = inc_fir_px_mask + (y - ys) * (x - xs)
+            for c in range(0, channels):
                 if val_count > 0:
-                    new_img[y, x, 0] = r / val_count
-                    new_img[y, x, 1] = g / val_count
-                    new_img[y, x, 2] = b / val_count
+                    ring[y % ring_size, x, c] = (inc_fir_px_val[c] +
+                                                 inc_iir_px_val[c]) / val_count
                 else:
-                    new_img[y, x, 0] = 0
-                    new_img[y, x, 1] = 0
-                    new_img[y, x, 2] = 0
-            #else:
-            #    new_img[y, x] = img[y, x]
+                    ring[y % ring_size, x, c] = 0
 
-    return new_img
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+@cython.warn.undeclared(True)
+cdef void _reduce_layer_row(const UINT8DTYPE_t[:, ::1] row, int width,
+        int channels, int y, int height, int factor, INTDTYPE_t[:, ::1] acc,
+        UINT8DTYPE_t[:, :, ::1] out, int[::1] cursors) nogil:
+    """
+    Add a row of a layer to the box reduction accumulator, and write out a row
+    of the reduced layer once factor rows were added. Trailing rows and columns
+    that do not fill a whole cell are folded into the last cell.
+
+    cursors holds the output row and the amount of accumulated rows between
+    calls.
+    """
+    cdef int x, c, cx, cols, out_width, out_height
+
+    out_height = out.shape[0]
+    out_width = out.shape[1]
+
+    for x in range(0, width):
+        cx = min(x / factor, out_width - 1)
+        for c in range(0, channels):
+            acc[cx, c] += row[x, c]
+    cursors[1] += 1
+
+    if y == height - 1 or ((y + 1) % factor == 0 and
+                           cursors[0] < out_height - 1):
+        for cx in range(0, out_width):
+            cols = factor
+            if cx == out_width - 1:
+                cols = width - cx * factor
+            for c in range(0, channels):
+                out[cursors[0], cx, c] = acc[cx, c] / (cols * cursors[1])
+                acc[cx, c] = 0
+        cursors[0] += 1
+        cursors[1] = 0
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
 @cython.warn.undeclared(True)
-def fast_mask_denoise(np.ndarray[UINT8DTYPE_t, ndim=2] mask, int width, int
+def optimise_fgbg(const UINT8DTYPE_t[:, ::1] mask,
+        const UINT8DTYPE_t[:, :, ::1] img, int width, int height,
+        int fg_n_size, int bg_n_size, int fg_downsample, int bg_downsample,
+        bint packed=False):
+    """
+    Create both the foreground and background in a single pass over the mask
+    and the image. This computes the same as calling optimise_gray2/optimise_rgb2
+    with the mask (foreground) and with the inverted mask (background), without
+    having to invert the mask and without keeping two full size copies of the
+    image around.
+
+    The layers can be written out at a reduced resolution directly (by
+    averaging factor x factor cells), in which case only n_size + 1 rows of the
+    full resolution layer are kept in memory.
+
+    The computation runs without holding the GIL.
+
+    Args:
+
+    * mask (numpy.ndarray[numpy.uint8, ndim=2]): input mask
+    * img: (numpy.ndarray[numpy.uint8, ndim=3): input image, (height, width,
+      channels); pass grayscale images as (height, width, 1)
+    * width (int): mask/img width
+    * height (int): mask/img height
+    * fg_n_size (int): foreground window size
+    * bg_n_size (int): background window size
+    * fg_downsample (int): foreground reduction factor, 1 for none, 0 to not
+      create the foreground
+    * bg_downsample (int): background reduction factor, 1 for none, 0 to not
+      create the background
+    * packed (bool): mask is bit packed (see bitmask.PackedMask)
+
+    Returns a tuple of new images (numpy.ndarray[numpy.uint8, ndim=3]):
+    (foreground, background), a layer that is not created is None.
+    """
+    cdef int y, channels, do_fg, do_bg
+    cdef int fg_width, fg_height, bg_width, bg_height
+    cdef np.ndarray[UINT8DTYPE_t, ndim=3] fg_arr, bg_arr
+
+    channels = img.shape[2]
+    if channels > MAX_CHANNELS:
+        raise ValueError('Too many channels: %d' % channels)
+
+    do_fg = fg_downsample > 0
+    do_bg = bg_downsample > 0
+
+    # Skipped layers still get (tiny) output buffers, so that the code below
+    # does not need to special case them
+    fg_width, fg_height = 1, 1
+    if do_fg:
+        fg_width = width // fg_downsample
+        fg_height = height // fg_downsample
+    bg_width, bg_height = 1, 1
+    if do_bg:
+        bg_width = width // bg_downsample
+        bg_height = height // bg_downsample
+
+    if fg_width == 0 or fg_height == 0:
+        raise ValueError('Image too small to downsample by %d' % fg_downsample)
+    if bg_width == 0 or bg_height == 0:
+        raise ValueError('Image too small to downsample by %d' % bg_downsample)
+
+    fg_arr = np.zeros([fg_height, fg_width, channels], dtype=UINT8DTYPE)
+    bg_arr = np.zeros([bg_height, bg_width, channels], dtype=UINT8DTYPE)
+
+    cdef UINT8DTYPE_t[:, :, ::1] fg_out = fg_arr
+    cdef UINT8DTYPE_t[:, :, ::1] bg_out = bg_arr
+
+    cdef INTDTYPE_t[:, ::1] fg_fir_val = np.zeros([width, channels], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] fg_fir_cnt = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[:, ::1] fg_iir_val = np.zeros([width, channels], dtype=INTDTYPE)
+    cdef UINT8DTYPE_t[:, :, ::1] fg_ring = np.zeros([fg_n_size + 1, width,
+                                                     channels], dtype=UINT8DTYPE)
+    cdef INTDTYPE_t[:, ::1] fg_acc = np.zeros([fg_width, channels],
+                                              dtype=INTDTYPE)
+    cdef int[::1] fg_cursors = np.zeros([4], dtype=np.intc)
+    cdef int[::1] fg_out_cursors = np.zeros([2], dtype=np.intc)
+
+    cdef INTDTYPE_t[:, ::1] bg_fir_val = np.zeros([width, channels], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] bg_fir_cnt = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[:, ::1] bg_iir_val = np.zeros([width, channels], dtype=INTDTYPE)
+    cdef UINT8DTYPE_t[:, :, ::1] bg_ring = np.zeros([bg_n_size + 1, width,
+                                                     channels], dtype=UINT8DTYPE)
+    cdef INTDTYPE_t[:, ::1] bg_acc = np.zeros([bg_width, channels],
+                                              dtype=INTDTYPE)
+    cdef int[::1] bg_cursors = np.zeros([4], dtype=np.intc)
+    cdef int[::1] bg_out_cursors = np.zeros([2], dtype=np.intc)
+
+    with nogil:
+        for y in range(0, height):
+            # Foreground keeps the pixels in the mask, background the pixels
+            # not in the mask
+            if do_fg:
+                _optimise_layer_row(mask, img, width, height, channels, y,
+                                    fg_n_size, 1, packed, fg_fir_val, fg_fir_cnt,
+                                    fg_iir_val, fg_ring, fg_cursors)
+                _reduce_layer_row(fg_ring[y % (fg_n_size + 1)], width,
+                                  channels, y, height, fg_downsample, fg_acc,
+                                  fg_out, fg_out_cursors)
+            if do_bg:
+                _optimise_layer_row(mask, img, width, height, channels, y,
+                                    bg_n_size, 0, packed, bg_fir_val, bg_fir_cnt,
+                                    bg_iir_val, bg_ring, bg_cursors)
+                _reduce_layer_row(bg_ring[y % (bg_n_size + 1)], width,
+                                  channels, y, height, bg_downsample, bg_acc,
+                                  bg_out, bg_out_cursors)
+
+    return (fg_arr if do_fg else None), (bg_arr if do_bg else None)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+@cython.warn.undeclared(True)
+def optimise_reduced(const UINT8DTYPE_t[:, ::1] mask,
+        const UINT8DTYPE_t[:, :, ::1] img, int width, int height, int n_size,
+        int factor, int keep, bint packed=False):
+    """
+    Create a foreground or background directly at a reduced resolution.
+
+    The image is first box-reduced to a grid of factor x factor cells, where
+    every cell holds the sum of the pixels that the layer keeps (mask == keep)
+    and the amount of those pixels (the coverage). Then the same FIR/IIR box
+    filter as optimise_gray2/optimise_rgb2 runs on the reduced grid, weighing
+    every cell by its coverage: cells with coverage get the average of the
+    pixels that the layer keeps, cells without coverage are filled from their
+    neighbourhood. The window size is scaled down by factor as well.
+
+    This does about 1 / factor^2 of the filter work of optimise_fgbg, and
+    never allocates a full resolution layer. Trailing rows and columns that
+    do not fill a whole cell are folded into the last cell.
+
+    The computation runs without holding the GIL.
+
+    Args:
+
+    * mask (numpy.ndarray[numpy.uint8, ndim=2]): input mask
+    * img: (numpy.ndarray[numpy.uint8, ndim=3): input image, (height, width,
+      channels); pass grayscale images as (height, width, 1)
+    * width (int): mask/img width
+    * height (int): mask/img height
+    * n_size (int): window size (at full resolution)
+    * factor (int): reduction factor
+    * keep (int): 1 to create a foreground, 0 to create a background
+    * packed (bool): mask is bit packed (see bitmask.PackedMask)
+
+    Returns a new image (numpy.ndarray[numpy.uint8, ndim=3])
+    """
+    cdef int x, y, c, cx, cy, channels, out_width, out_height, n
+    cdef int ys, ye, xs, xe, cell_weight
+    cdef int ifysc, ifyec, iiysc, iiyec, ifxsc, ifxec, iixsc, iixec
+    cdef INTDTYPE_t inc_fir_px_weight, val_count
+    cdef INTDTYPE_t inc_fir_px_val[MAX_CHANNELS]
+    cdef INTDTYPE_t inc_iir_px_val[MAX_CHANNELS]
+    cdef const UINT8DTYPE_t *mask_row
+    cdef np.ndarray[UINT8DTYPE_t, ndim=3] out_arr
+
+    channels = img.shape[2]
+    if channels > MAX_CHANNELS:
+        raise ValueError('Too many channels: %d' % channels)
+
+    out_width = width // factor
+    out_height = height // factor
+    if out_width == 0 or out_height == 0:
+        raise ValueError('Image too small to downsample by %d' % factor)
+
+    n = max(1, (n_size + factor // 2) // factor)
+    # Weight of a filled cell, as if all of its pixels were covered
+    cell_weight = factor * factor
+
+    out_arr = np.zeros([out_height, out_width, channels], dtype=UINT8DTYPE)
+
+    cdef UINT8DTYPE_t[:, :, ::1] out = out_arr
+    cdef INTDTYPE_t[:, :, ::1] cell_val = np.zeros([out_height, out_width,
+                                                    channels], dtype=INTDTYPE)
+    cdef INTDTYPE_t[:, ::1] cell_cov = np.zeros([out_height, out_width],
+                                                dtype=INTDTYPE)
+
+    cdef INTDTYPE_t[:, ::1] inc_fir_val = np.zeros([out_width, channels], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] inc_fir_weight = np.zeros([out_width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[:, ::1] inc_iir_val = np.zeros([out_width, channels], dtype=INTDTYPE)
+
+    with nogil:
+        # Box-reduce the pixels that this layer keeps, and their coverage
+        for y in range(0, height):
+            cy = min(y / factor, out_height - 1)
+            mask_row = &mask[y, 0]
+            for x in range(0, width):
+                if _mask_get(mask_row, x, packed) == keep:
+                    cx = min(x / factor, out_width - 1)
+                    for c in range(0, channels):
+                        cell_val[cy, cx, c] += img[y, x, c]
+                    cell_cov[cy, cx] += 1
+
+        ifysc = 0
+        ifyec = 0
+        iiysc = 0
+        iiyec = 0
+
+        for y in range(0, out_height):
+            ys = max(0, y - n)
+            ye = min(out_height, y + n)
+
+            # Update y-dimension FIR window, weighted by coverage
+            while ifysc < ys:
+                for x in range(0, out_width):
+                    for c in range(0, channels):
+                        inc_fir_val[x, c] -= cell_val[ifysc, x, c]
+                    inc_fir_weight[x] -= cell_cov[ifysc, x]
+                ifysc += 1
+            while ifyec < ye:
+                for x in range(0, out_width):
+                    for c in range(0, channels):
+                        inc_fir_val[x, c] += cell_val[ifyec, x, c]
+                    inc_fir_weight[x] += cell_cov[ifyec, x]
+                ifyec += 1
+            # Update y-dimension IIR window, every cell counts as fully covered
+            while iiysc < ys:
+                for x in range(0, out_width):
+                    for c in range(0, channels):
+                        inc_iir_val[x, c] -= out[iiysc, x, c]
+                iiysc += 1
+            while iiyec < y:
+                for x in range(0, out_width):
+                    for c in range(0, channels):
+                        inc_iir_val[x, c] += out[iiyec, x, c]
+                iiyec += 1
+
+            ifxsc = 0
+            ifxec = 0
+            iixsc = 0
+            iixec = 0
+
+            inc_fir_px_weight = 0
+            for c in range(0, channels):
+                inc_fir_px_val[c] = 0
+                inc_iir_px_val[c] = 0
+
+            for x in range(0, out_width):
+                xs = max(0, x - n)
+                xe = min(out_width, x + n)
+
+                while ifxsc < xs:
+                    for c in range(0, channels):
+                        inc_fir_px_val[c] -= inc_fir_val[ifxsc, c]
+                    inc_fir_px_weight -= inc_fir_weight[ifxsc]
+                    ifxsc += 1
+                while ifxec < xe:
+                    for c in range(0, channels):
+                        inc_fir_px_val[c] += inc_fir_val[ifxec, c]
+                    inc_fir_px_weight += inc_fir_weight[ifxec]
+                    ifxec += 1
+                while iixsc < xs:
+                    for c in range(0, channels):
+                        inc_iir_px_val[c] -= inc_iir_val[iixsc, c]
+                    iixsc += 1
+                while iixec < x:
+                    for c in range(0, channels):
+                        inc_iir_px_val[c] += inc_iir_val[iixec, c]
+                    iixec += 1
+
+                if cell_cov[y, x] > 0:
+                    for c in range(0, channels):
+                        out[y, x, c] = cell_val[y, x, c] / cell_cov[y, x]
+                else:
+                    val_count = inc_fir_px_weight + (y - ys) * (x - xs) * cell_weight
+                    for c in range(0, channels):
+                        if val_count > 0:
+                            out[y, x, c] = (inc_fir_px_val[c] +
+                                            inc_iir_px_val[c] * cell_weight) / val_count
+                        else:
+                            out[y, x, c] = 0
+
+    return out_arr
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+@cython.warn.undeclared(True)
+def fast_mask_denoise(const UINT8DTYPE_t[:, ::1] mask, int width, int
         height, int mincnt, int n_size):
     """
-    Fast in-place denoiser, focussed on speed rather than quality.
+    Fast denoiser, focussed on speed rather than quality.
 
     This function removes noise based on the amount of pixels in its
-    neighbourhood
+    neighbourhood. The neighbourhood count is computed incrementally (per
+    column sums that slide down, and a running sum that slides right), so the
+    cost per pixel is constant regardless of n_size.
+
+    The result is written to a new buffer, so the outcome does not depend on
+    the order in which the mask is scanned. Pixels closer than n_size to the
+    border are copied as-is. The computation runs without holding the GIL.
 
     Args:
 
-    * mask (numpy.ndarray[numpy.uint8, ndim=2]): mask, modified in place
+    * mask (numpy.ndarray[bool, ndim=2]): mask, not modified
     * width (int): width of mask
     * height int): height of mask
     * mincnt (int): min pixels in neighbourhood to not be counted as noise
     * n_size (int): neighbourhood size in all x and y (-n_size, +n_size)
 
-    Returns the input mask, denoised.
+    Returns a new, denoised, mask (numpy.ndarray[bool, ndim=2])
+    """
+    cdef np.ndarray new_mask_arr
+    cdef UINT8DTYPE_t[:, ::1] new_mask
+    cdef int x, y, win
+    cdef int cnt = 0
+
+    # Per column count of set pixels in rows [y - n_size, y + n_size]
+    cdef INTDTYPE_t[::1] col_cnt = np.zeros([width], dtype=INTDTYPE)
+
+    new_mask_arr = np.array(mask, dtype=bool)
+    new_mask = new_mask_arr.view(UINT8DTYPE)
+
+    if height <= 2 * n_size or width <= 2 * n_size:
+        return new_mask_arr
+
+    win = 2 * n_size + 1
+
+    with nogil:
+        # Prime the column counts with the first window
+        for y in range(0, win - 1):
+            for x in range(0, width):
+                col_cnt[x] += mask[y, x]
+
+        for y in range(n_size, height - n_size):
+            # Slide the column window down: add the new bottom row, the top row
+            # is removed at the end of this iteration
+            for x in range(0, width):
+                col_cnt[x] += mask[y + n_size, x]
+
+            cnt = 0
+            for x in range(0, win - 1):
+                cnt += col_cnt[x]
+
+            for x in range(n_size, width - n_size):
+                cnt += col_cnt[x + n_size]
+                if mask[y, x]:
+                    # The count includes the current pixel, so subtract one
+                    new_mask[y, x] = (cnt - 1) >= mincnt
+                cnt -= col_cnt[x - n_size]
+
+            for x in range(0, width):
+                col_cnt[x] -= mask[y - n_size, x]
+
+    return new_mask_arr
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+@cython.warn.undeclared(True)
+def channel_histograms(const UINT8DTYPE_t[:, :, ::1] img, int step=1):
+    """
+    Histograms of the first three channels of an image, in a single pass.
+
+    Args:
+
+    * img (numpy.ndarray[numpy.uint8, ndim=3]): input image
+    * step (int): only look at every step-th row and column (subsample)
+
+    Returns the histograms (numpy.ndarray[numpy.int, ndim=2], 3 rows of 256)
+    """
+    cdef int x, y
+    cdef int height = img.shape[0]
+    cdef int width = img.shape[1]
+    cdef np.ndarray hist_arr = np.zeros([3, 256], dtype=INTDTYPE)
+    cdef INTDTYPE_t[:, ::1] hist = hist_arr
+
+    if step < 1:
+        step = 1
+
+    with nogil:
+        y = 0
+        while y < height:
+            x = 0
+            while x < width:
+                hist[0, img[y, x, 0]] += 1
+                hist[1, img[y, x, 1]] += 1
+                hist[2, img[y, x, 2]] += 1
+                x += step
+            y += step
+
+    return hist_arr
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+@cython.warn.undeclared(True)
+def levels_lightness(const UINT8DTYPE_t[:, :, ::1] img,
+                     const UINT8DTYPE_t[:, ::1] luts):
+    """
+    Apply per channel level lookup tables to the first three channels of an
+    image, and compute the HSL lightness ((max + min) / 2) of the result, in a
+    single pass.
+
+    Args:
+
+    * img (numpy.ndarray[numpy.uint8, ndim=3]): input image
+    * luts (numpy.ndarray[numpy.uint8, ndim=2]): 3 rows of 256 entries
+
+    Returns the lightness (numpy.ndarray[numpy.uint8, ndim=2])
     """
-    cdef np.ndarray[UINT8DTYPE_t, ndim=2] new_img
     cdef int x, y
-    cdef int cnt = 0;
-    cdef int ww = 0;
-    cdef int hh = 0;
-
-    for y in range(n_size, height - n_size):
-        for x in range(n_size, width - n_size):
-            if mask[y, x]:
-                cnt = 0
-                for hh in range(-n_size, n_size + 1):
-                    for ww in range(-n_size, n_size + 1):
-                        cnt += mask[y - hh, x - ww]
-                # We count the current pixel with (hh=0, ww=0),
-                # so subtract one from cnt,
-                # this is faster than branching in the loop
-                mask[y, x] = (cnt - 1) >= mincnt
-
-    return mask
+    cdef int height = img.shape[0]
+    cdef int width = img.shape[1]
+    cdef int r, g, b, vmax, vmin
+    cdef np.ndarray out_arr = np.empty([height, width], dtype=UINT8DTYPE)
+    cdef UINT8DTYPE_t[:, ::1] out = out_arr
+
+    with nogil:
+        for y in range(height):
+            for x in range(width):
+                r = luts[0, img[y, x, 0]]
+                g = luts[1, img[y, x, 1]]
+                b = luts[2, img[y, x, 2]]
+
+                vmax = r
+                if g > vmax:
+                    vmax = g
+                if b > vmax:
+                    vmax = b
+
+                vmin = r
+                if g < vmin:
+                    vmin = g
+                if b < vmin:
+                    vmin = b
+
+                out[y, x] = (vmax + vmin) >> 1
+
+    return out_arr
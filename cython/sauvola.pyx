@@ -26,7 +26,7 @@ ctypedef np.uint8_t UINT8DTYPE_t
 # Let's make sure all variables have a c type, otherwise performs goes out of
 # the window
 @cython.warn.undeclared(True)
-def binarise_sauvola(np.ndarray[UINT8DTYPE_t, ndim=1] in_arr, np.ndarray[UINT8DTYPE_t, ndim=1] out_arr, int width, int height, int window_width, int window_height, double k, double R):
+def binarise_sauvola(const UINT8DTYPE_t[::1] in_arr, UINT8DTYPE_t[::1] out_arr, int width, int height, int window_width, int window_height, double k, double R, bint packed=False):
     """
     Perform fast Sauvola binarisation on the given input array/image.
 
@@ -40,6 +40,15 @@ def binarise_sauvola(np.ndarray[UINT8DTYPE_t, ndim=1] in_arr, np.ndarray[UINT8DT
     * window_height(int): Sauvola window height
     * k (double): k parameter
     * R (double): R parameter
+    * packed (bool): write a bit packed result (see below)
+
+    If packed is True, out_arr has to be a flattened, zeroed, bit packed array
+    of height rows of (width + 7) / 8 bytes (as created by numpy.packbits with
+    axis=1), and the bits of the dark pixels are set. This is the inverse of
+    the non-packed output, and saves both the full size output array and the
+    inversion afterwards.
+
+    The binarisation runs without holding the GIL.
 
     Example usage:
 
@@ -55,109 +64,97 @@ def binarise_sauvola(np.ndarray[UINT8DTYPE_t, ndim=1] in_arr, np.ndarray[UINT8DT
     cdef int index_top, index_bottom, win_top, win_bottom, index, bottom_max
     cdef int top, bottom, win_height, sum_, count, win_right, win_left, imax
     cdef long square_sum
+    cdef int row_start, row_offset, row_bytes, col
 
     cdef char formres;
     cdef double mean, variance, tmp
 
     cdef double k2=k*k/R/R;
 
-    cdef np.ndarray[INTDTYPE_t, ndim=1] integral = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] integral_square = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] integral = np.zeros([width], dtype=INTDTYPE)
+    cdef INTDTYPE_t[::1] integral_square = np.zeros([width], dtype=INTDTYPE)
 
     cdef INTDTYPE_t pixel
 
+    row_bytes = (width + 7) / 8
+
+    with nogil:
+        for i in range(0, width):
+            integral[i] = 0
+            integral_square[i] = 0
 
-    for i in range(0, width):
-        integral[i] = 0
-        integral_square[i] = 0
+        l = (window_width + 1) / 2
+        r = window_width / 2;
+        o = (window_height + 1) / 2
+        u = window_height / 2
+
+        index = 0
+        imax = min(height, u)
+        for i in range(0, imax):
+            for j in range(0, width):
+                pixel = in_arr[index]
 
-    l = (window_width + 1) / 2
-    r = window_width / 2;
-    o = (window_height + 1) / 2
-    u = window_height / 2
+                integral[j] += pixel
+                integral_square[j] += pixel * pixel
 
-    index = 0
-    imax = min(height, u)
-    for i in range(0, imax):
-        for j in range(0, width):
-            pixel = in_arr[index]
+                index += 1
 
-            integral[j] += pixel
-            integral_square[j] += pixel * pixel
+        dr0 = min(window_width, width)
+        dr1 = min(r, width)
+        dr2 = width - l
+        dr3 = min(dr2, 0)
+        index_top = 0
+        index_bottom = u * width
 
-            index += 1
+        win_top = -o
+        win_bottom = u
+        index = 0
+        bottom_max = height + u
+        while win_bottom < bottom_max:
+            # index is at the start of the output row at this point
+            row_start = index
+            row_offset = (index / width) * row_bytes
 
-    dr0 = min(window_width, width)
-    dr1 = min(r, width)
-    dr2 = width - l
-    dr3 = min(dr2, 0)
-    index_top = 0
-    index_bottom = u * width
+            if win_top>=0:
+                for j in range(0, width):
+                    pixel = in_arr[index_top]
 
-    win_top = -o
-    win_bottom = u
-    index = 0
-    bottom_max = height + u
-    while win_bottom < bottom_max:
-        if win_top>=0:
-            for j in range(0, width):
-                pixel = in_arr[index_top]
+                    integral[j] -= pixel
+                    integral_square[j] -= pixel * pixel
 
-                integral[j] -= pixel
-                integral_square[j] -= pixel * pixel
+                    index_top += 1
 
-                index_top += 1
+                top = win_top
+            else:
+                top = -1
 
-            top = win_top
-        else:
-            top = -1
+            if win_bottom < height:
+                for j in range(0, width):
+                    pixel = in_arr[index_bottom]
 
-        if win_bottom < height:
-            for j in range(0, width):
-                pixel = in_arr[index_bottom]
+                    integral[j] += pixel
+                    integral_square[j] += pixel*pixel
 
-                integral[j] += pixel
-                integral_square[j] += pixel*pixel
-
-                index_bottom += 1
-
-            bottom = win_bottom
-        else:
-            bottom = height - 1;
-
-        win_height = bottom-top
-        sum_ = 0
-        square_sum = 0
-        for j in range(0, dr1):
-            sum_ += integral[j];
-            square_sum += integral_square[j];
-
-        count = dr1 * win_height;
-        win_right = r;
-        while win_right < dr0:
-            count += win_height;
-            sum_ += integral[win_right];
-            square_sum += integral_square[win_right];
-
-            pixel = in_arr[index]
-            if k >= 0:
-                mean = sum_ / count
-                variance = square_sum / count - (mean * mean)
-                tmp = (pixel + (mean * (k- 1)))
-                formres = ((tmp <= 0) or (tmp * tmp <= mean * mean * k2 * variance))
+                    index_bottom += 1
+
+                bottom = win_bottom
             else:
-                mean = sum_ / count
-                variance = square_sum / count - (mean*mean)
-                tmp = (pixel + mean * (k - 1))
-                formres = (tmp <= 0 and tmp * tmp >= mean * mean * k2 * variance)
-            out_arr[index] = 0 if formres else 1
-
-            win_right += 1
-            index += 1
-
-        win_left = win_right - window_width;
-        if win_right >= width:
-            while win_left < dr3:
+                bottom = height - 1;
+
+            win_height = bottom-top
+            sum_ = 0
+            square_sum = 0
+            for j in range(0, dr1):
+                sum_ += integral[j];
+                square_sum += integral_square[j];
+
+            count = dr1 * win_height;
+            win_right = r;
+            while win_right < dr0:
+                count += win_height;
+                sum_ += integral[win_right];
+                square_sum += integral_square[win_right];
+
                 pixel = in_arr[index]
                 if k >= 0:
                     mean = sum_ / count
@@ -169,14 +166,70 @@ def binarise_sauvola(np.ndarray[UINT8DTYPE_t, ndim=1] in_arr, np.ndarray[UINT8DT
                     variance = square_sum / count - (mean*mean)
                     tmp = (pixel + mean * (k - 1))
                     formres = (tmp <= 0 and tmp * tmp >= mean * mean * k2 * variance)
-                out_arr[index] = 0 if formres else 1
+                if packed:
+                    if formres:
+                        col = index - row_start
+                        out_arr[row_offset + (col >> 3)] |= 128 >> (col & 7)
+                else:
+                    out_arr[index] = 0 if formres else 1
 
-                win_left += 1
+                win_right += 1
                 index += 1
-        else:
-            while win_right < width:
-                sum_ += integral[win_right] - integral[win_left];
-                square_sum += integral_square[win_right] - integral_square[win_left];
+
+            win_left = win_right - window_width;
+            if win_right >= width:
+                while win_left < dr3:
+                    pixel = in_arr[index]
+                    if k >= 0:
+                        mean = sum_ / count
+                        variance = square_sum / count - (mean * mean)
+                        tmp = (pixel + (mean * (k- 1)))
+                        formres = ((tmp <= 0) or (tmp * tmp <= mean * mean * k2 * variance))
+                    else:
+                        mean = sum_ / count
+                        variance = square_sum / count - (mean*mean)
+                        tmp = (pixel + mean * (k - 1))
+                        formres = (tmp <= 0 and tmp * tmp >= mean * mean * k2 * variance)
+                    if packed:
+                        if formres:
+                            col = index - row_start
+                            out_arr[row_offset + (col >> 3)] |= 128 >> (col & 7)
+                    else:
+                        out_arr[index] = 0 if formres else 1
+
+                    win_left += 1
+                    index += 1
+            else:
+                while win_right < width:
+                    sum_ += integral[win_right] - integral[win_left];
+                    square_sum += integral_square[win_right] - integral_square[win_left];
+
+                    pixel = in_arr[index]
+                    if k >= 0:
+                        mean = sum_ / count
+                        variance = square_sum / count - (mean * mean)
+                        tmp = (pixel + (mean * (k- 1)))
+                        formres = ((tmp <= 0) or (tmp * tmp <= mean * mean * k2 * variance))
+                    else:
+                        mean = sum_ / count
+                        variance = square_sum / count - (mean*mean)
+                        tmp = (pixel + mean * (k - 1))
+                        formres = (tmp <= 0 and tmp * tmp >= mean * mean * k2 * variance)
+                    if packed:
+                        if formres:
+                            col = index - row_start
+                            out_arr[row_offset + (col >> 3)] |= 128 >> (col & 7)
+                    else:
+                        out_arr[index] = 0 if formres else 1
+
+                    win_left += 1
+                    win_right += 1
+                    index += 1
+
+            while win_left < dr2:
+                count -= win_height;
+                sum_ -= integral[win_left];
+                square_sum -= integral_square[win_left];
 
                 pixel = in_arr[index]
                 if k >= 0:
@@ -189,34 +242,17 @@ def binarise_sauvola(np.ndarray[UINT8DTYPE_t, ndim=1] in_arr, np.ndarray[UINT8DT
                     variance = square_sum / count - (mean*mean)
                     tmp = (pixel + mean * (k - 1))
                     formres = (tmp <= 0 and tmp * tmp >= mean * mean * k2 * variance)
-                out_arr[index] = 0 if formres else 1
+                if packed:
+                    if formres:
+                        col = index - row_start
+                        out_arr[row_offset + (col >> 3)] |= 128 >> (col & 7)
+                else:
+                    out_arr[index] = 0 if formres else 1
 
                 win_left += 1
-                win_right += 1
                 index += 1
 
-        while win_left < dr2:
-            count -= win_height;
-            sum_ -= integral[win_left];
-            square_sum -= integral_square[win_left];
-
-            pixel = in_arr[index]
-            if k >= 0:
-                mean = sum_ / count
-                variance = square_sum / count - (mean * mean)
-                tmp = (pixel + (mean * (k- 1)))
-                formres = ((tmp <= 0) or (tmp * tmp <= mean * mean * k2 * variance))
-            else:
-                mean = sum_ / count
-                variance = square_sum / count - (mean*mean)
-                tmp = (pixel + mean * (k - 1))
-                formres = (tmp <= 0 and tmp * tmp >= mean * mean * k2 * variance)
-            out_arr[index] = 0 if formres else 1
-
-            win_left += 1
-            index += 1
-
-        win_top += 1
-        win_bottom += 1
+            win_top += 1
+            win_bottom += 1
 
     return 0
@@ -6,3 +6,10 @@ from . import jpeg2000
 from . import pdfhacks
 from . import pagenumbers
 from . import grayconvert
+from . import bitmask
+from . import pagebuffer
+from . import pageclass
+from . import mrccache
+from . import ratecontrol
+from . import jpeg
+from . import threadbudget
@@ -0,0 +1,188 @@
+# archive-pdf-tools
+# Copyright (C) 2020-2021, Internet Archive
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Merlijn Boris Wolf Wajer <merlijn@archive.org>
+#
+# Bit packed (8 pixels per byte) masks, so that MRC masks do not have to be
+# kept around and passed around as one byte per pixel arrays.
+
+import numpy as np
+from PIL import Image
+
+
+# Amount of set bits for every byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class PackedMask(object):
+    """
+    Bit packed mask
+
+    The pixels are stored in a numpy.ndarray (numpy.uint8) of height rows of
+    (width + 7) // 8 bytes, most significant bit first, with the padding bits
+    at the end of every row set to zero. This is the layout of numpy.packbits
+    (with axis=1), of Pillow '1' mode raw data and of PBM (P4) rows.
+
+    A set bit is a pixel in the mask (True in the boolean array version of the
+    mask, white in a Pillow '1' image).
+    """
+
+    def __init__(self, width, height, data=None):
+        """
+        Create a new (empty) mask, or wrap existing packed data.
+
+        Args:
+
+        * width (int): mask width
+        * height (int): mask height
+        * data (numpy.ndarray): optional packed data, is not copied
+        """
+        self.width = width
+        self.height = height
+        self.row_bytes = (width + 7) // 8
+
+        if data is None:
+            data = np.zeros((height, self.row_bytes), dtype=np.uint8)
+        elif data.shape != (height, self.row_bytes):
+            raise ValueError('Packed data has invalid shape: %s' % (data.shape,))
+
+        self.data = data
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    @property
+    def size(self):
+        return self.width * self.height
+
+    @classmethod
+    def from_array(cls, arr):
+        """
+        Create a packed mask from a boolean numpy.ndarray
+        """
+        height, width = arr.shape
+        return cls(width, height, np.packbits(arr, axis=1))
+
+    @classmethod
+    def from_pil(cls, image):
+        """
+        Create a packed mask from a Pillow '1' mode image, without unpacking
+        """
+        if image.mode != '1':
+            raise ValueError('Image mode has to be \'1\'')
+
+        width, height = image.size
+        data = np.frombuffer(bytearray(image.tobytes()), dtype=np.uint8)
+        return cls(width, height, data.reshape((height, (width + 7) // 8)))
+
+    def to_array(self):
+        """
+        Returns the mask as a boolean numpy.ndarray
+        """
+        return np.unpackbits(self.data, axis=1,
+                             count=self.width).view(bool)
+
+    def to_pil(self):
+        """
+        Returns the mask as a Pillow '1' mode image
+        """
+        return Image.frombytes('1', (self.width, self.height),
+                               self.data.tobytes())
+
+    def to_pbm(self):
+        """
+        Returns the mask as a binary PBM (P4) file, as bytes.
+
+        PBM treats a set bit as black, and pixels in the mask are white (like
+        in the Pillow version of the mask), so the bits are inverted.
+        """
+        header = b'P4\n%d %d\n' % (self.width, self.height)
+        return header + np.invert(self.data).tobytes()
+
+    def copy(self):
+        return PackedMask(self.width, self.height, self.data.copy())
+
+    def count_nonzero(self):
+        """
+        Returns the amount of pixels in the mask
+        """
+        return int(_POPCOUNT[self.data].sum(dtype=np.int64))
+
+    def _clear_padding(self):
+        pad = self.row_bytes * 8 - self.width
+        if pad:
+            self.data[:, -1] &= (0xff << pad) & 0xff
+
+    def _other_data(self, other):
+        if isinstance(other, PackedMask):
+            if other.shape != self.shape:
+                raise ValueError('Mask shapes do not match')
+            return other.data
+        return PackedMask.from_array(other).data
+
+    def invert(self):
+        """
+        Invert the mask in place
+        """
+        np.invert(self.data, out=self.data)
+        self._clear_padding()
+        return self
+
+    def __invert__(self):
+        return self.copy().invert()
+
+    def __ior__(self, other):
+        np.bitwise_or(self.data, self._other_data(other), out=self.data)
+        return self
+
+    def __or__(self, other):
+        return self.copy().__ior__(other)
+
+    def __ixor__(self, other):
+        np.bitwise_xor(self.data, self._other_data(other), out=self.data)
+        return self
+
+    def __xor__(self, other):
+        return self.copy().__ixor__(other)
+
+    def __iand__(self, other):
+        np.bitwise_and(self.data, self._other_data(other), out=self.data)
+        return self
+
+    def __and__(self, other):
+        return self.copy().__iand__(other)
+
+    def __getitem__(self, key):
+        """
+        Returns a region of the mask as a boolean numpy.ndarray, only the rows
+        of the region are unpacked.
+        """
+        rows, cols = key
+        region = np.unpackbits(self.data[rows], axis=1,
+                               count=self.width).view(bool)
+        return region[:, cols]
+
+    def __setitem__(self, key, value):
+        """
+        Set a region of the mask from a boolean numpy.ndarray (or scalar), only
+        the rows of the region are unpacked and packed again.
+        """
+        rows, cols = key
+        region = np.unpackbits(self.data[rows], axis=1,
+                               count=self.width).view(bool)
+        region[:, cols] = value
+        self.data[rows] = np.packbits(region, axis=1)
@@ -31,6 +31,15 @@ IMAGE_MODE_SKIP = 3
 DENOISE_NONE = 'none'
 DENOISE_FAST = 'fast'
 DENOISE_BREGMAN = 'bregman'
+DENOISE_COMPONENTS = 'components'
+
+FILL_BOX = 'box'
+FILL_PUSHPULL = 'pushpull'
+
+PAGE_CLASS_BLANK = 'blank'
+PAGE_CLASS_BITONAL = 'bitonal'
+PAGE_CLASS_GRAY = 'gray'
+PAGE_CLASS_COLOUR = 'colour'
 
 RECODE_RUNTIME_WARNING_INVALID_PAGE_SIZE = 'invalid-page-size'
 RECODE_RUNTIME_WARNING_INVALID_PAGE_NUMBERS = 'invalid-page-numbers'
@@ -52,10 +61,14 @@ JPEG2000_IMPL_PILLOW = 'pillow'
 JPEG2000_IMPLS = (JPEG2000_IMPL_KAKADU, JPEG2000_IMPL_OPENJPEG,
         JPEG2000_IMPL_GROK, JPEG2000_IMPL_PILLOW)
 
+# Pick the fastest available implementation, see jpeg2000.select_jpeg2000_impl
+JPEG2000_IMPL_AUTO = 'auto'
+
 COMPRESSOR_JPEG2000 = 'jpeg2000'
 COMPRESSOR_JPEG = 'jpeg'
 
 COMPRESSOR_JBIG2 = 'jbig2'
 COMPRESSOR_CCITT = 'ccitt'
+COMPRESSOR_FLATE = 'flate'
 
 __version__ = VERSION
@@ -17,31 +17,80 @@
 # Author: Merlijn Boris Wolf Wajer <merlijn@archive.org>
 
 import numpy as np
-from skimage.color import rgb2hsv
+
+from optimiser import channel_histograms, levels_lightness
 
 perc2val = lambda x: (x*255)/100
 
-def level_arr(arr, minv=0, maxv=255):
+# The statistics of larger images are computed on a subsample of about this
+# many pixels, see gray_stats_step
+GRAY_STATS_PIXELS = 2048 * 2048
+
+
+def level_lut(minv=0, maxv=255):
+    """
+    Lookup table that stretches the levels of uint8 values, so that minv
+    becomes 0 and maxv becomes 255.
+
+    Args:
+
+    * minv (float): values below minv become 0
+    * maxv (float): values above maxv become 255
+
+    Returns the 256 entry lookup table (numpy.ndarray[numpy.uint8])
+    """
+    values = np.arange(256, dtype=np.float64)
     interval = (maxv/255.) - (minv/255.)
-    arr_zero = arr < minv
-    arr_max = arr > maxv
-    arr[::] = ((arr[::] - minv) / interval)
-    arr[arr_zero] = 0
-    arr[arr_max] = 255
-    return arr
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lut = (values - minv) / interval
+    lut = np.nan_to_num(lut, nan=0., posinf=255., neginf=0.)
+    lut[values < minv] = 0
+    lut[values > maxv] = 255
+    # Truncate, like assigning into a uint8 array does
+    return np.clip(lut, 0, 255).astype(np.uint8)
+
+
+def histogram_stats(hist):
+    """
+    Returns the min, max, mean and (population) standard deviation of the
+    values that a 256 entry histogram describes.
+    """
+    values = np.arange(len(hist), dtype=np.float64)
+    count = hist.sum()
+    nonzero = np.flatnonzero(hist)
+
+    mean = (hist * values).sum() / count
+    std = np.sqrt((hist * (values - mean) ** 2).sum() / count)
+
+    return nonzero[0], nonzero[-1], mean, std
+
+
+def gray_stats_step(height, width):
+    """
+    Returns the stats_step of special_gray_convert for an image, so that
+    about GRAY_STATS_PIXELS pixels are looked at.
+    """
+    return max(1, int((height * width / GRAY_STATS_PIXELS) ** 0.5))
 
 
 # Straight forward port of color2Gray.sh script
 # We might be able to do better, but there are only a few users of this script
 # in the archive.org currently, so more time has not been invested in finding
 # alternative or better ways.
-def special_gray_convert(imd):
+#
+# The statistics all come from a single histogram pass (optionally on every
+# stats_step-th row and column only), the levels are applied as lookup tables
+# and the HSL lightness is computed in the same pass, straight to uint8.
+def special_gray_convert(imd, stats_step=1):
     components = ('r', 'g', 'b')
 
+    hist = channel_histograms(imd, stats_step)
+
     d = {}
     for i, k in enumerate(components):
-        for fun in ['min', 'max', 'mean', 'std']:
-            d[k + '_' + fun] = getattr(np, fun)(imd[:,:,i]) / 255.
+        stats = histogram_stats(hist[i])
+        for fun, val in zip(['min', 'max', 'mean', 'std'], stats):
+            d[k + '_' + fun] = val / 255.
 
     bright_adjust = round(d['r_mean'] * d['g_mean'] * d['b_mean'] /
                     (d['b_max']*(1-d['r_std'])*(1-d['g_std'])*(1-d['b_std'])), 4)
@@ -54,15 +103,9 @@ def special_gray_convert(imd):
             'b': min(int((45.16*bright_adjust+36.5)/1), 95),
             }
 
-    new_imd = np.copy(imd)
-    for i, c in enumerate(components):
-        new_imd[:,:,i] = level_arr(new_imd[:,:,i],
-                                   minv=perc2val(low_thres),
-                                   maxv=perc2val(high_thres[c]))
-
-    hsv = rgb2hsv(new_imd)
-    # Calculate the 'L' from 'HSL' as L = S * (1 - V/2)
-    l = hsv[:,:,2] * (1 - (hsv[:,:,1]/2))
-    return np.array(l * 255, dtype=np.uint8)
-
+    luts = np.array([level_lut(minv=perc2val(low_thres),
+                               maxv=perc2val(high_thres[c]))
+                     for c in components], dtype=np.uint8)
 
+    # 'L' from 'HSL' is L = V * (1 - S/2) = (max + min) / 2
+    return levels_lightness(np.ascontiguousarray(imd), luts)
@@ -0,0 +1,183 @@
+# archive-pdf-tools
+# Copyright (C) 2020-2021, Internet Archive
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Merlijn Boris Wolf Wajer <merlijn@archive.org>
+#
+# In process JPEG encoding with size targeting, like jpegoptim -S, but without
+# writing, decoding and encoding the image again.
+
+import io
+import re
+
+
+# Longest side of the proxy image (see encode_jpeg) is at least this
+JPEG_PROXY_MIN_SIZE = 256
+
+# Reduction factor of the proxy image
+JPEG_PROXY_FACTOR = 2
+
+# jpegoptim flags that do not change anything for us: we never write metadata
+_JPEGOPTIM_NOOP_FLAGS = ('-s', '--strip-all', '-f', '--force', '-q',
+                         '--quiet', '--all-normal', '--stdout')
+
+_JPEGOPTIM_SIZE_RE = re.compile(r'^(?:-S|--size=)(\d+)(%?)$')
+_JPEGOPTIM_MAX_RE = re.compile(r'^(?:-m|--max=)(\d+)$')
+
+
+def parse_jpegoptim_flags(flags):
+    """
+    Parse the jpegoptim flags that encode_jpeg supports.
+
+    Args:
+
+    * flags (list of str): jpegoptim flags, like ['-S30']
+
+    Returns a dictionary with the keyword arguments for encode_jpeg, or None
+    if the flags contain flags that encode_jpeg does not support.
+    """
+    kwargs = {}
+    for flag in flags:
+        if flag == '' or flag in _JPEGOPTIM_NOOP_FLAGS:
+            continue
+
+        if flag == '--all-progressive':
+            kwargs['progressive'] = True
+            continue
+
+        m = _JPEGOPTIM_SIZE_RE.match(flag)
+        if m is not None:
+            if m.group(2):
+                kwargs['target_percent'] = int(m.group(1))
+            else:
+                # jpegoptim sizes are in kilobytes
+                kwargs['target_size'] = int(m.group(1)) * 1024
+            continue
+
+        m = _JPEGOPTIM_MAX_RE.match(flag)
+        if m is not None:
+            kwargs['max_quality'] = min(100, max(1, int(m.group(1))))
+            continue
+
+        return None
+
+    return kwargs
+
+
+def _jpeg_bytes(image, quality, progressive=False):
+    fd = io.BytesIO()
+    # optimize: optimal Huffman tables, like jpegoptim
+    image.save(fd, format='JPEG', quality=quality, optimize=True,
+               progressive=progressive)
+    return fd.getvalue()
+
+
+def _largest_quality(fits, low, high):
+    # Largest quality in [low, high] for which fits is True (the size grows
+    # with the quality), or low if there is none
+    best = low
+    while low <= high:
+        mid = (low + high) // 2
+        if fits(mid):
+            best = mid
+            low = mid + 1
+        else:
+            high = mid - 1
+
+    return best
+
+
+def encode_jpeg(image, target_size=None, target_percent=None, max_quality=100,
+                progressive=False):
+    """
+    Encode a Pillow image as JPEG, with the highest quality (up to
+    max_quality) that results in at most target_size bytes, like
+    jpegoptim -S (where the input is a quality 100 JPEG).
+
+    The quality is searched for on a downscaled proxy of the image, calibrated
+    with an encode of the full image, so that the full image is typically only
+    encoded twice.
+
+    Args:
+
+    * image (PIL.Image): image to encode
+    * target_size (int): maximum size in bytes, or None
+    * target_percent (int): maximum size in percent of the size of a quality
+      100 encode of the image, or None
+    * max_quality (int): maximum quality
+    * progressive (bool): create a progressive JPEG
+
+    Returns the JPEG (bytes)
+    """
+    full_data = {}
+
+    def full(quality):
+        if quality not in full_data:
+            full_data[quality] = _jpeg_bytes(image, quality,
+                                             progressive=progressive)
+        return full_data[quality]
+
+    if target_percent is not None:
+        target = len(full(100)) * target_percent / 100.
+        if target_size is not None:
+            target = min(target, target_size)
+        target_size = target
+
+    if target_size is None:
+        return full(max_quality)
+
+    w, h = image.size
+    if min(w, h) // JPEG_PROXY_FACTOR >= JPEG_PROXY_MIN_SIZE:
+        proxy = image.reduce(JPEG_PROXY_FACTOR)
+        scale = (w * h) / float(proxy.size[0] * proxy.size[1])
+    else:
+        proxy = image
+        scale = 1.
+
+    proxy_sizes = {}
+
+    def proxy_size(quality):
+        if quality not in proxy_sizes:
+            proxy_sizes[quality] = len(_jpeg_bytes(proxy, quality,
+                                                   progressive=progressive))
+        return proxy_sizes[quality]
+
+    # First guess assumes that the size scales with the amount of pixels
+    quality = _largest_quality(lambda q: proxy_size(q) * scale <= target_size,
+                               1, max_quality)
+    data = full(quality)
+
+    if proxy is not image:
+        # Calibrate the proxy with the real size and search again
+        scale = len(data) / float(proxy_size(quality))
+        new_quality = _largest_quality(
+                lambda q: proxy_size(q) * scale <= target_size,
+                1, max_quality)
+        if new_quality != quality:
+            quality = new_quality
+            data = full(quality)
+
+    # The proxy is only an estimate, finish with real encodes
+    def fits(q):
+        return len(full(q)) <= target_size
+
+    if len(data) > target_size and quality > 1:
+        quality = _largest_quality(fits, 1, quality - 1)
+        data = full(quality)
+    elif quality < max_quality and fits(quality + 1):
+        quality = _largest_quality(fits, quality + 1, max_quality)
+        data = full(quality)
+
+    return data
@@ -20,18 +20,28 @@
 # binaries.
 
 import sys
+import os
+import re
+import json
 from os import close, remove
-from subprocess import check_call, DEVNULL
+from subprocess import check_call, run, DEVNULL, PIPE, STDOUT, \
+        CalledProcessError, SubprocessError
 from tempfile import mkstemp
 from ast import literal_eval
+from shutil import which
+from time import time
 
-from PIL import Image
+import numpy as np
+
+import PIL
+from PIL import Image, features
 from PIL import Jpeg2KImagePlugin
 
 from internetarchivepdf.const import RECODE_RUNTIME_WARNING_INVALID_JP2_HEADERS
 from internetarchivepdf.const import (JPEG2000_IMPL_KAKADU,
         JPEG2000_IMPL_OPENJPEG, JPEG2000_IMPL_GROK,
-        JPEG2000_IMPL_PILLOW, JPEG2000_IMPLS)
+        JPEG2000_IMPL_PILLOW, JPEG2000_IMPL_AUTO, JPEG2000_IMPLS)
+from internetarchivepdf.ratecontrol import rate_flags
 
 
 KDU_COMPRESS = 'kdu_compress'
@@ -41,6 +51,44 @@ OPJ_DECOMPRESS = 'opj_decompress'
 GRK_COMPRESS = 'grk_compress'
 GRK_DECOMPRESS = 'grk_decompress'
 
+# Encoder and decoder programs of the external implementations
+JPEG2000_TOOLS = {
+    JPEG2000_IMPL_KAKADU: (KDU_COMPRESS, KDU_EXPAND),
+    JPEG2000_IMPL_OPENJPEG: (OPJ_COMPRESS, OPJ_DECOMPRESS),
+    JPEG2000_IMPL_GROK: (GRK_COMPRESS, GRK_DECOMPRESS),
+}
+
+# Argument to print the usage of the programs, and the thread and reduce flags
+_TOOL_HELP_ARGS = {
+    JPEG2000_IMPL_KAKADU: '-usage',
+    JPEG2000_IMPL_OPENJPEG: '-h',
+    JPEG2000_IMPL_GROK: '-h',
+}
+_TOOL_THREADS_FLAGS = {
+    JPEG2000_IMPL_KAKADU: '-num_threads',
+    JPEG2000_IMPL_OPENJPEG: '-threads',
+    JPEG2000_IMPL_GROK: '-H',
+}
+_TOOL_REDUCE_FLAGS = {
+    JPEG2000_IMPL_KAKADU: '-reduce',
+    JPEG2000_IMPL_OPENJPEG: '-r',
+    JPEG2000_IMPL_GROK: '-r',
+}
+
+# Size of the (square, RGB) image used to benchmark the implementations, and
+# the compression ratio to encode it with
+JPEG2000_CALIBRATION_SIZE = 1024
+JPEG2000_CALIBRATION_RATIO = 100
+# Seed of the noise in the test image, so that it is the same on every run
+JPEG2000_CALIBRATION_SEED = 0
+
+# Used if no implementation could be calibrated, and to break ties
+_IMPL_PREFERENCE = (JPEG2000_IMPL_KAKADU, JPEG2000_IMPL_GROK,
+                    JPEG2000_IMPL_OPENJPEG, JPEG2000_IMPL_PILLOW)
+
+_capabilities = None
+_backends = None
+
 def encode_jpeg2000(image, outpath, impl, flags, tmp_dir=None, imgtype=None,
         threads=None, debug=False):
     """ Encode PIL image to JPEG2000 file
@@ -176,6 +224,12 @@ def get_jpeg2000_info(infile, impl, errors=None):
 def add_impl_args(args, impl, encode=False, threads=None):
     threads = str(threads) if threads else '1'
 
+    # Leave out the threads flag if the program does not know it (e.g. older
+    # versions of OpenJPEG)
+    caps = get_jpeg2000_capabilities().get(impl)
+    with_threads = caps is None or \
+            caps['encode_threads' if encode else 'decode_threads']
+
     # Use just one core
     if impl in (JPEG2000_IMPL_KAKADU,):
         # From kdu_expand/kdu_compress:
@@ -184,19 +238,22 @@ def add_impl_args(args, impl, encode=False, threads=None):
         # want to create or use a threading environment.
         if threads == '1':
             threads = '0'
-        args += ['-num_threads', threads]
+        if with_threads:
+            args += ['-num_threads', threads]
         if encode:
             args = [KDU_COMPRESS] + args
         else:
             args = [KDU_EXPAND] + args
     if impl in (JPEG2000_IMPL_OPENJPEG,):
-        args += ['-threads', threads]
+        if with_threads:
+            args += ['-threads', threads]
         if encode:
             args = [OPJ_COMPRESS] + args
         else:
             args = [OPJ_DECOMPRESS] + args
     if impl in (JPEG2000_IMPL_GROK,):
-        args += ['-H', threads]
+        if with_threads:
+            args += ['-H', threads]
         if encode:
             args = [GRK_COMPRESS] + args
         else:
@@ -211,3 +268,267 @@ def _jpeg2000_pillow_str_to_kwargs(s):
         kwargs[k] = literal_eval(v)
 
     return kwargs
+
+
+def _tool_usage(path, impl):
+    try:
+        res = run([path, _TOOL_HELP_ARGS[impl]], stdin=DEVNULL, stdout=PIPE,
+                  stderr=STDOUT, timeout=10)
+    except (OSError, SubprocessError):
+        return ''
+
+    return res.stdout.decode('utf-8', 'replace')
+
+
+def _has_flag(usage, flag):
+    return re.search(r'(^|\s)' + re.escape(flag) + r'(\s|,|=|$)', usage,
+                     re.M) is not None
+
+
+def probe_jpeg2000_capabilities():
+    """
+    Find out which JPEG2000 implementations are installed, and which of the
+    flags we use they support, from the usage of the programs.
+
+    Returns a dictionary of implementation to a dictionary with 'encode',
+    'decode' (if the encoder and decoder are available), 'encode_threads',
+    'decode_threads' (if they support the threads flag) and 'reduce' (if the
+    decoder can reduce the resolution), all bools.
+    """
+    pillow = features.check_codec('jpg_2000')
+    caps = {JPEG2000_IMPL_PILLOW: {'encode': pillow, 'decode': pillow,
+                                   'encode_threads': False,
+                                   'decode_threads': False,
+                                   'reduce': pillow}}
+
+    for impl, tools in JPEG2000_TOOLS.items():
+        enc_path, dec_path = which(tools[0]), which(tools[1])
+        enc_usage = _tool_usage(enc_path, impl) if enc_path else ''
+        dec_usage = _tool_usage(dec_path, impl) if dec_path else ''
+
+        caps[impl] = {
+            'encode': enc_path is not None,
+            'decode': dec_path is not None,
+            # No usage output: assume the flags work, as before probing
+            'encode_threads': not enc_usage or
+                    _has_flag(enc_usage, _TOOL_THREADS_FLAGS[impl]),
+            'decode_threads': not dec_usage or
+                    _has_flag(dec_usage, _TOOL_THREADS_FLAGS[impl]),
+            'reduce': not dec_usage or
+                    _has_flag(dec_usage, _TOOL_REDUCE_FLAGS[impl]),
+        }
+
+    return caps
+
+
+def get_jpeg2000_capabilities():
+    """
+    Returns the (once per process) probed capabilities, see
+    probe_jpeg2000_capabilities
+    """
+    global _capabilities
+
+    if _capabilities is None:
+        _capabilities = probe_jpeg2000_capabilities()
+
+    return _capabilities
+
+
+def _calibration_image():
+    size = (JPEG2000_CALIBRATION_SIZE, JPEG2000_CALIBRATION_SIZE)
+    rng = np.random.default_rng(JPEG2000_CALIBRATION_SEED)
+    noise = Image.fromarray(np.clip(rng.normal(128, 48, size), 0,
+                                    255).astype(np.uint8))
+    gradient = Image.linear_gradient('L').resize(size)
+    return Image.merge('RGB', (noise, gradient, gradient.transpose(
+        Image.TRANSPOSE)))
+
+
+def calibrate_jpeg2000_backends(caps, tmp_dir=None):
+    """
+    Benchmark the available JPEG2000 implementations, by encoding and
+    decoding a test image with each of them.
+
+    Args:
+
+    * caps (dict): capabilities, see probe_jpeg2000_capabilities
+    * tmp_dir (str): directory for the temporary files
+
+    Returns a dictionary with 'encode' and 'decode' dictionaries of the
+    implementations that work to their time in seconds.
+    """
+    img = _calibration_image()
+    w, h = img.size
+    size = w * h * 3 // JPEG2000_CALIBRATION_RATIO
+
+    timings = {'encode': {}, 'decode': {}}
+    test_file = None
+
+    for impl in _IMPL_PREFERENCE:
+        if not caps[impl]['encode']:
+            continue
+
+        fd, path = mkstemp(prefix='calibrate', suffix='.jp2', dir=tmp_dir)
+        close(fd)
+        remove(path)
+
+        flags = rate_flags(size, w, h, 3, jpeg2000_implementation=impl)
+        try:
+            t = time()
+            encode_jpeg2000(img, path, impl, flags, tmp_dir=tmp_dir,
+                            imgtype='calibrate')
+            timings['encode'][impl] = time() - t
+        except (OSError, CalledProcessError, ValueError):
+            if os.path.exists(path):
+                remove(path)
+            continue
+
+        if test_file is None:
+            test_file = path
+        else:
+            remove(path)
+
+    if test_file is None:
+        return timings
+
+    for impl in _IMPL_PREFERENCE:
+        if not caps[impl]['decode']:
+            continue
+
+        try:
+            t = time()
+            decode_jpeg2000(test_file, impl=impl, tmp_dir=tmp_dir)
+            timings['decode'][impl] = time() - t
+        except (OSError, CalledProcessError, ValueError):
+            continue
+
+    remove(test_file)
+
+    return timings
+
+
+def _backend_fingerprint():
+    # Changes when programs are installed, removed or updated
+    tools = []
+    for impl in sorted(JPEG2000_TOOLS):
+        for tool in JPEG2000_TOOLS[impl]:
+            path = which(tool)
+            if path is None:
+                tools.append((tool, None))
+                continue
+            st = os.stat(path)
+            tools.append((tool, path, st.st_size, int(st.st_mtime)))
+
+    return repr((PIL.__version__, features.check_codec('jpg_2000'), tools))
+
+
+def default_jpeg2000_cache_path():
+    """
+    Returns the path of the JPEG2000 backend cache file
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'archive-pdf-tools',
+                        'jpeg2000-backends.json')
+
+
+def get_jpeg2000_backends(tmp_dir=None, cache_path=None):
+    """
+    Returns the capabilities and calibration timings of the JPEG2000
+    implementations, as a dictionary with 'capabilities' and 'timings'.
+
+    The result is cached on disk (see default_jpeg2000_cache_path), until
+    programs are installed, removed or updated.
+    """
+    global _backends
+
+    if _backends is not None:
+        return _backends
+
+    if cache_path is None:
+        cache_path = default_jpeg2000_cache_path()
+
+    fingerprint = _backend_fingerprint()
+
+    try:
+        with open(cache_path) as fp:
+            cached = json.load(fp)
+        if cached.get('fingerprint') == fingerprint:
+            _backends = cached
+            return _backends
+    except (OSError, ValueError):
+        pass
+
+    caps = get_jpeg2000_capabilities()
+    backends = {'fingerprint': fingerprint, 'capabilities': caps,
+                'timings': calibrate_jpeg2000_backends(caps, tmp_dir=tmp_dir)}
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + '.%d' % os.getpid()
+        with open(tmp_path, 'w') as fp:
+            json.dump(backends, fp)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+    _backends = backends
+    return _backends
+
+
+def select_jpeg2000_impl(operation, tmp_dir=None, cache_path=None):
+    """
+    Pick the fastest working JPEG2000 implementation.
+
+    Args:
+
+    * operation (str): 'encode' or 'decode'
+    * tmp_dir (str): directory for the temporary calibration files
+    * cache_path (str): path of the cache file, see get_jpeg2000_backends
+
+    Returns the implementation (str)
+    """
+    if operation not in ('encode', 'decode'):
+        raise ValueError('operation should be \'encode\' or \'decode\'')
+
+    timings = get_jpeg2000_backends(tmp_dir=tmp_dir,
+                                    cache_path=cache_path)['timings'][operation]
+    if timings:
+        return min(_IMPL_PREFERENCE,
+                   key=lambda impl: timings.get(impl, float('inf')))
+
+    caps = get_jpeg2000_capabilities()
+    for impl in _IMPL_PREFERENCE:
+        if caps[impl][operation]:
+            return impl
+
+    return JPEG2000_IMPL_PILLOW
+
+
+def resolve_jpeg2000_impls(jpeg2000_implementation,
+                           jpeg2000_decode_implementation=None, tmp_dir=None):
+    """
+    Turn JPEG2000_IMPL_AUTO into the fastest implementation, see
+    select_jpeg2000_impl.
+
+    Args:
+
+    * jpeg2000_implementation (str): implementation to encode (and by
+      default decode) with, or JPEG2000_IMPL_AUTO
+    * jpeg2000_decode_implementation (str): implementation to decode with,
+      or JPEG2000_IMPL_AUTO, or None for jpeg2000_implementation
+    * tmp_dir (str): directory for the temporary calibration files
+
+    Returns a tuple of the encode and the decode implementation (str, str)
+    """
+    if jpeg2000_decode_implementation is None:
+        jpeg2000_decode_implementation = jpeg2000_implementation
+
+    if jpeg2000_implementation == JPEG2000_IMPL_AUTO:
+        jpeg2000_implementation = select_jpeg2000_impl('encode',
+                                                       tmp_dir=tmp_dir)
+    if jpeg2000_decode_implementation == JPEG2000_IMPL_AUTO:
+        jpeg2000_decode_implementation = select_jpeg2000_impl('decode',
+                                                              tmp_dir=tmp_dir)
+
+    return jpeg2000_implementation, jpeg2000_decode_implementation
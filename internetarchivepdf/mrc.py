@@ -18,11 +18,15 @@
 
 import sys
 from os import close, remove
+from os.path import getsize
 
 from glob import glob
 from tempfile import mkstemp
 import subprocess
+import io
+import zlib
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 
 import warnings
 
@@ -33,7 +37,7 @@ from skimage.restoration import denoise_tv_bregman, estimate_sigma
 from scipy import ndimage
 import numpy as np
 
-from optimiser import optimise_gray, optimise_rgb, optimise_gray2, optimise_rgb2, fast_mask_denoise
+from optimiser import optimise_fgbg, optimise_reduced, fast_mask_denoise
 from sauvola import binarise_sauvola
 
 import fitz
@@ -41,8 +45,13 @@ import fitz
 fitz.TOOLS.set_icc(True) # For good measure, not required
 
 from internetarchivepdf.jpeg2000 import encode_jpeg2000
+from internetarchivepdf.bitmask import PackedMask
+from internetarchivepdf.ratecontrol import rate_flags
+from internetarchivepdf.jpeg import encode_jpeg, parse_jpegoptim_flags
+from internetarchivepdf.pagebuffer import PageBuffer
 from internetarchivepdf.const import (RECODE_RUNTIME_WARNING_TOO_SMALL_TO_DOWNSAMPLE, COMPRESSOR_JPEG,
-        COMPRESSOR_JPEG2000, DENOISE_NONE, DENOISE_FAST, DENOISE_BREGMAN)
+        COMPRESSOR_JPEG2000, JPEG2000_IMPL_PILLOW, DENOISE_NONE, DENOISE_FAST, DENOISE_BREGMAN,
+        DENOISE_COMPONENTS, FILL_BOX, FILL_PUSHPULL)
 
 
 """
@@ -55,7 +64,21 @@ def mean_estimate_sigma(arr):
         return np.mean(estimate_sigma(arr))
 
 
-def threshold_image(img, dpi, k=0.34):
+def sauvola_window_size(dpi):
+    """
+    Sauvola window size (in pixels, odd) for a given dpi, 51 if dpi is None
+    """
+    window_size = 51
+
+    if dpi is not None:
+        window_size = int(dpi / 4)
+        if window_size % 2 == 0:
+            window_size += 1
+
+    return window_size
+
+
+def threshold_image(img, dpi, k=0.34, packed=False):
     """
     Perform Sauvola binarisation on the given image
 
@@ -64,20 +87,23 @@ def threshold_image(img, dpi, k=0.34):
     * img (np.ndarray): input image array
     * dpi (int): dpi for Sauvola, used to calculate window size if not None
     * k (float): k parameter, defaults to 0.34
+    * packed (bool): return a PackedMask, written directly by the binariser
 
-    Returns binarised numpy.ndarray
+    Returns binarised numpy.ndarray (or PackedMask if packed is True)
     """
-    window_size = 51
-
-    if dpi is not None:
-        window_size = int(dpi / 4)
-        if window_size % 2 == 0:
-            window_size += 1
+    window_size = sauvola_window_size(dpi)
 
     h, w = img.shape
+    in_img = np.reshape(img, w*h)
+
+    if packed:
+        mask = PackedMask(w, h)
+        binarise_sauvola(in_img, np.reshape(mask.data, mask.data.size), w, h,
+                         window_size, window_size, k, 128, packed=True)
+        return mask
+
     out_img = np.ndarray(img.shape, dtype=bool)
     out_img = np.reshape(out_img, w*h)
-    in_img = np.reshape(img, w*h)
 
     binarise_sauvola(in_img, out_img, w, h, window_size, window_size, k, 128)
     out_img = np.reshape(out_img, (h, w))
@@ -87,6 +113,32 @@ def threshold_image(img, dpi, k=0.34):
     return out_img
 
 
+def fast_denoise_parameters(dpi):
+    """
+    Pick the fast_mask_denoise parameters for a given DPI.
+
+    The defaults (a minimum of 4 neighbours in a 5x5 neighbourhood) were tuned
+    on 300 DPI scans; the neighbourhood size scales linearly with the DPI and
+    the minimum count with the area of the neighbourhood.
+
+    Args:
+
+    * dpi (int): dpi of the page, or None if unknown
+
+    Returns a tuple: (mincnt, n_size)
+    """
+    mincnt, n_size = 4, 2
+
+    if dpi is None:
+        return mincnt, n_size
+
+    scale = dpi / 300.
+    n_size = max(1, int(round(n_size * scale)))
+    mincnt = max(1, int(round(mincnt * scale * scale)))
+
+    return mincnt, n_size
+
+
 def denoise_bregman(binary_img):
     """
     Denoise a binary numpy array using Bregman total variation denoising
@@ -107,6 +159,36 @@ def denoise_bregman(binary_img):
 
     return denoise
 
+def denoise_components(binary_img, dpi=None, min_area=8):
+    """
+    Denoise a binary numpy array by removing small connected components.
+
+    The mask is labelled once (8-connectivity) and every component with fewer
+    than min_area pixels is dropped. Components that are kept are left
+    untouched, so unlike neighbourhood based denoising thin strokes are not
+    eroded.
+
+    Args:
+
+    * binary_img (np.array): input array
+    * dpi (int): dpi of the page, min_area is scaled from 300 DPI if not None
+    * min_area (int): minimum component area (in pixels at 300 DPI)
+
+    Returns the denoised array
+    """
+    if dpi is not None:
+        min_area = max(1, int(round(min_area * (dpi / 300.) ** 2)))
+
+    labels, _ = ndimage.label(binary_img, structure=np.ones((3, 3), dtype=bool))
+    areas = np.bincount(labels.ravel())
+
+    keep = areas >= min_area
+    # Label 0 is the background
+    keep[0] = False
+
+    return keep[labels]
+
+
 # TODO: Rename, can be either foreground or background
 def partial_blur(mask, img, sigma=5, mode=None):
     """
@@ -185,9 +267,154 @@ def partial_boxblur(mask, fg, size=5, mode=None):
     return newfg
 
 
+def _reduce_sum(arr, factor):
+    """
+    Sum factor x factor cells of arr (over the first two axes), trailing rows
+    and columns that do not fill a whole cell are added to the last cell.
+    """
+    h, w = arr.shape[0:2]
+    rows = np.arange(0, max(1, h // factor)) * factor
+    cols = np.arange(0, max(1, w // factor)) * factor
+    arr = np.add.reduceat(arr, rows, axis=0)
+    return np.add.reduceat(arr, cols, axis=1)
+
+
+def _clamp_weights(val, weight):
+    over = weight > 1.
+    val[over] /= weight[over][:, np.newaxis]
+    weight[over] = 1.
+
+
+def _upsample(arr, shape):
+    zoom = [shape[0] / arr.shape[0], shape[1] / arr.shape[1]] + \
+            [1] * (arr.ndim - 2)
+    arr = ndimage.zoom(arr, zoom, order=1, mode='nearest')
+    # zoom rounds the output shape, make sure it matches exactly
+    arr = arr[:shape[0], :shape[1]]
+    pad = [(0, shape[0] - arr.shape[0]), (0, shape[1] - arr.shape[1])] + \
+            [(0, 0)] * (arr.ndim - 2)
+    return np.pad(arr, pad, mode='edge')
+
+
+# Rows of the image (in cells) that _masked_reduce_sum works on at a time
+PUSHPULL_BAND_CELLS = 64
+
+
+def _masked_reduce_sum(mask_arr, image_arr, keep, factor):
+    """
+    Sum the kept pixels (and their amount) in factor x factor cells, like
+    _reduce_sum, in bands of rows, so that no full resolution copy of the
+    image or the mask is made.
+
+    Returns the sums (float32, (h, w, channels)) and the weights (float32)
+    """
+    h, w = image_arr.shape[0:2]
+    cells = max(1, h // factor)
+    band = PUSHPULL_BAND_CELLS * factor
+
+    vals, weights = [], []
+    for y in range(0, cells * factor, band):
+        # The last band gets the trailing rows that do not fill a whole cell
+        y_end = h if y + band >= cells * factor else y + band
+        kept = (mask_arr[y:y_end] != 0) == bool(keep)
+        masked = np.where(kept[:, :, np.newaxis], image_arr[y:y_end],
+                          0).astype(np.uint32)
+        vals.append(_reduce_sum(masked, factor).astype(np.float32))
+        weights.append(_reduce_sum(kept.astype(np.uint32),
+                                   factor).astype(np.float32))
+
+    return np.concatenate(vals), np.concatenate(weights)
+
+
+def pushpull_fill(mask_arr, image_arr, keep, factor=1):
+    """
+    Fill the pixels of a foreground or background that are not kept using
+    push-pull (pyramid) interpolation, as an alternative to the windowed fill
+    of the optimise kernels.
+
+    The kept pixels (weight 1) and their values are summed into a pyramid of
+    2x2 reductions (push), with the weights clamped to 1. The pyramid is then
+    composited from the top down (pull), where every level fills what it is
+    missing from the (bilinearly upsampled) level above it. Holes of any size
+    are filled smoothly and the cost is linear in the number of pixels.
+
+    The pyramid starts at the output resolution reduced by factor (or by 2 at
+    full resolution, where the kept pixels are copied from the image as is),
+    so the only full resolution array that is allocated is the output.
+
+    Args:
+
+    * mask_arr (numpy.ndarray): MRC mask
+    * image_arr (numpy.ndarray): image, (height, width, channels)
+    * keep (bool): True to keep the pixels in the mask (foreground), False to
+      keep the pixels not in the mask (background)
+    * factor (int): reduction factor of the output (box reduced, weighted by
+      mask coverage)
+
+    Returns a new image (numpy.ndarray, uint8)
+    """
+    h, w = image_arr.shape[0:2]
+    full_res = factor <= 1 and min(h, w) > 1
+
+    val, weight = _masked_reduce_sum(mask_arr, image_arr, keep,
+                                     2 if full_res else max(1, factor))
+    _clamp_weights(val, weight)
+
+    # Push
+    levels = [(val, weight)]
+    while max(weight.shape) > 1:
+        val = _reduce_sum(val, 2)
+        weight = _reduce_sum(weight, 2)
+        _clamp_weights(val, weight)
+        levels.append((val, weight))
+
+    # Pull, the levels are dropped once they are composited
+    val, weight = levels.pop()
+    while levels:
+        level_val, level_weight = levels.pop()
+        missing = 1. - level_weight
+
+        up = _upsample(val, level_weight.shape)
+        up *= missing[:, :, np.newaxis]
+        level_val += up
+        val = level_val
+
+        up = _upsample(weight, level_weight.shape)
+        up *= missing
+        level_weight += up
+        weight = level_weight
+        level_val = level_weight = up = missing = None
+
+    # Pixels are 0 if nothing is kept at all (like the optimise kernels)
+    val /= np.maximum(weight, 1e-6)[:, :, np.newaxis]
+    weight = None
+    out = np.array(np.clip(np.rint(val), 0, 255), dtype=np.uint8)
+    val = None
+
+    if full_res:
+        # Fill from the half resolution result, keep the kept pixels
+        out = _upsample(out, (h, w))
+        band = PUSHPULL_BAND_CELLS * 2
+        for y in range(0, h, band):
+            kept = (mask_arr[y:y + band] != 0) == bool(keep)
+            np.copyto(out[y:y + band], image_arr[y:y + band],
+                      where=kept[:, :, np.newaxis])
+
+    return out
+
+
 def create_hocr_mask(img, mask_arr, hocr_word_data, downsample=None, dpi=None, timing_data=None):
-    image_width, image_height = img.size
-    np_img = np.array(img)
+    # With a PageBuffer, only the gray rows of a line are made at a time
+    page_buf = None
+    if isinstance(img, PageBuffer):
+        image_width, image_height = img.size
+        page_buf = img
+    elif isinstance(img, np.ndarray):
+        image_height, image_width = img.shape
+        np_img = img
+    else:
+        image_width, image_height = img.size
+        np_img = np.array(img)
 
     t = time()
 
@@ -220,7 +447,10 @@ def create_hocr_mask(img, mask_arr, hocr_word_data, downsample=None, dpi=None, t
                 print('Invalid bounding box outside image: (%d, %d, %d, %d)' % (left, top, right, bottom), file=sys.stderr)
                 continue
 
-            np_lineimg = np_img[top:bottom,left:right]
+            if page_buf is not None:
+                np_lineimg = page_buf.gray_rows(top, bottom)[:,left:right]
+            else:
+                np_lineimg = np_img[top:bottom,left:right]
             # Simple grayscale invert
             np_lineimg_invert = 255 - np.copy(np_lineimg)
 
@@ -270,14 +500,14 @@ def create_hocr_mask(img, mask_arr, hocr_word_data, downsample=None, dpi=None, t
         timing_data.append(('hocr_mask_gen', time() - t))
 
 
-def estimate_noise(imgf):
-    #sigma_est = mean_estimate_sigma(imgf)
+def estimate_noise(img):
+    #sigma_est = mean_estimate_sigma(img)
     #return sigma_est
 
     # We do this only on a part of the image, because it's accurate enough wrt
     # noise estimation (definitely for camera noise estimation since that's
     # everywhere in the image, and it's quite a bit faster this way).
-    h, w = imgf.shape
+    h, w = img.shape
     MUL = 4
     hs = int(h/2 - h/MUL)
     he = int(h/2 + h/MUL)
@@ -291,44 +521,214 @@ def estimate_noise(imgf):
         ws = 0
         we = w
 
-    sigma_est = mean_estimate_sigma(imgf[hs:he, ws:we])
+    # Only the part we look at is converted to float
+    sigma_est = mean_estimate_sigma(img[hs:he, ws:we].astype(np.float32))
 
     return sigma_est
 
 
 
-def create_threshold_mask(mask_arr, imgf, dpi=None, denoise_mask=None, timing_data=None):
+def blur_image(img, sigma):
+    """
+    Gaussian blur of a uint8 image.
+
+    The blur is performed in 8.8 fixed point in a uint16 buffer, which is
+    precise enough for an 8 bit result and half the size of a float32 copy.
+
+    Args:
+
+    * img (numpy.ndarray): uint8 image array
+    * sigma (float): standard deviation of the Gaussian kernel
+
+    Returns the blurred uint8 numpy.ndarray
+    """
+    img16 = np.left_shift(img, 8, dtype=np.uint16)
+    ndimage.gaussian_filter(img16, sigma=sigma, output=img16)
+    # Round rather than truncate (max is 255 << 8, so this cannot overflow)
+    img16 += 128
+    out = np.empty(img.shape, dtype=np.uint8)
+    np.right_shift(img16, 8, out=out, casting='unsafe')
+    return out
+
+
+def create_threshold_mask(mask_arr, img, dpi=None, denoise_mask=None, timing_data=None):
     # We don't apply any of these blurs to the hOCR mask, we want that as
     # sharp as possible.
+    #
+    # img is a uint8 array, which is not modified (it can be a view of the
+    # page buffer).
 
     t = time()
-    sigma_est = estimate_noise(imgf)
+    sigma_est = estimate_noise(img)
 
     if timing_data is not None:
         timing_data.append(('est_1', time() - t))
     if sigma_est > 1.0:
         t = time()
-        imgf = ndimage.filters.gaussian_filter(imgf, sigma=sigma_est*0.1)
+        img = blur_image(img, sigma_est*0.1)
         if timing_data is not None:
             timing_data.append(('blur_1', time() - t))
 
         #t = time()
-        #n_sigma_est = mean_estimate_sigma(imgf)
+        #n_sigma_est = mean_estimate_sigma(img)
         #time_data.append(('est_2', time() - t))
         #if sigma_est > 1.0 and n_sigma_est > 1.0:
             #    t = time()
-        #    imgf = ndimage.filters.gaussian_filter(imgf, sigma=sigma_est*0.5)
+        #    img = blur_image(img, sigma_est*0.5)
         #    print('Going for second blur: n_sigma_est:',n_sigma_est)
         #    time_data.append(('blur_2', time() - t))
 
     t = time()
-    thres_arr = threshold_image(imgf.astype(np.uint8), dpi)
+    thres_arr = threshold_image(img, dpi, packed=True)
     if timing_data is not None:
         timing_data.append(('threshold', time() - t))
 
     mask_arr |= thres_arr
 
 
+def _strips(height, strip_height, overlap):
+    """
+    Yields (start, stop, band_start, band_stop) for every strip of a page,
+    where the band is the strip extended by overlap rows on both sides.
+    """
+    for start in range(0, height, strip_height):
+        stop = min(start + strip_height, height)
+        yield start, stop, max(0, start - overlap), min(height, stop + overlap)
+
+
+def create_threshold_mask_strips(mask_arr, page_buf, strip_height, dpi=None,
+                                 timing_data=None):
+    """
+    Strip based version of create_threshold_mask, only a band of the gray
+    page is in memory at any point.
+
+    The bands overlap by half the Sauvola window plus the radius of the
+    pre-blur, so the result is the same as thresholding the full page. The
+    noise is estimated on a band in the middle of the page rather than on the
+    middle of the full page.
+
+    Args:
+
+    * mask_arr (PackedMask): mask, modified in place
+    * page_buf (PageBuffer): page
+    * strip_height (int): amount of rows per strip
+    * dpi (int): dpi of the page
+    * timing_data (optional): Add time information to timing_data structure
+    """
+    height = page_buf.height
+
+    t = time()
+    middle = height // 2
+    half = min(strip_height, height) // 2
+    sigma_est = estimate_noise(page_buf.gray_rows(max(0, middle - half),
+                                                  min(height, middle + half)))
+    if timing_data is not None:
+        timing_data.append(('est_1', time() - t))
+
+    sigma = None
+    overlap = sauvola_window_size(dpi) // 2 + 1
+    if sigma_est > 1.0:
+        sigma = sigma_est*0.1
+        # Gaussian kernel radius, as used by ndimage (truncate=4.0)
+        overlap += int(4.0 * sigma + 0.5)
+
+    blur_time = 0.
+    threshold_time = 0.
+    for start, stop, band_start, band_stop in _strips(height, strip_height,
+                                                      overlap):
+        band = page_buf.gray_rows(band_start, band_stop)
+
+        if sigma is not None:
+            t = time()
+            band = blur_image(band, sigma)
+            blur_time += time() - t
+
+        t = time()
+        thres_arr = threshold_image(band, dpi, packed=True)
+        mask_arr.data[start:stop] |= \
+                thres_arr.data[start - band_start:stop - band_start]
+        threshold_time += time() - t
+
+    if timing_data is not None:
+        if sigma is not None:
+            timing_data.append(('blur_1', blur_time))
+        timing_data.append(('threshold', threshold_time))
+
+
+def denoise_mask_arr(mask_arr, denoise_mask, dpi=None):
+    """
+    Denoise an (unpacked) mask array with the given denoise method.
+
+    Args:
+
+    * mask_arr (numpy.ndarray): boolean mask array
+    * denoise_mask (str): DENOISE_FAST, DENOISE_BREGMAN or DENOISE_COMPONENTS
+    * dpi (int): dpi of the page
+
+    Returns the denoised mask array
+    """
+    if denoise_mask == DENOISE_FAST:
+        mincnt, n_size = fast_denoise_parameters(dpi)
+        height, width = mask_arr.shape
+        return fast_mask_denoise(mask_arr, width, height, mincnt, n_size)
+    elif denoise_mask == DENOISE_BREGMAN:
+        return denoise_bregman(mask_arr)
+    elif denoise_mask == DENOISE_COMPONENTS:
+        return denoise_components(mask_arr, dpi=dpi)
+    else:
+        raise ValueError('Invalid denoise option:', denoise_mask)
+
+
+# Timing data keys of the denoise methods
+DENOISE_TIMING_KEYS = {
+    DENOISE_FAST: 'fast_denoise',
+    DENOISE_BREGMAN: 'denoise',
+    DENOISE_COMPONENTS: 'components_denoise',
+}
+
+
+def denoise_mask_strips(mask_arr, denoise_mask, strip_height, dpi=None):
+    """
+    Strip based version of denoise_mask_arr on a packed mask, only a band of
+    the mask is unpacked at any point.
+
+    The bands overlap by the fast denoise neighbourhood or the minimum
+    component area, which makes these methods give the same result as on
+    the full mask. Bregman denoising is not local, so for that method the
+    result is an approximation.
+
+    Args:
+
+    * mask_arr (PackedMask): mask
+    * denoise_mask (str): DENOISE_FAST, DENOISE_BREGMAN or DENOISE_COMPONENTS
+    * strip_height (int): amount of rows per strip
+    * dpi (int): dpi of the page
+
+    Returns the denoised PackedMask
+    """
+    if denoise_mask == DENOISE_FAST:
+        _, n_size = fast_denoise_parameters(dpi)
+        overlap = n_size + 1
+    elif denoise_mask == DENOISE_COMPONENTS:
+        # A component that is cut off by the band edge spans at least overlap
+        # rows, and thus has at least min_area pixels
+        overlap = 8
+        if dpi is not None:
+            overlap = max(1, int(round(8 * (dpi / 300.) ** 2)))
+    else:
+        overlap = 16
+
+    new_mask = PackedMask(mask_arr.width, mask_arr.height)
+    for start, stop, band_start, band_stop in _strips(mask_arr.height,
+                                                      strip_height, overlap):
+        band = np.ascontiguousarray(mask_arr[band_start:band_stop, :])
+        band = denoise_mask_arr(band, denoise_mask, dpi=dpi)
+        new_mask.data[start:stop] = np.packbits(
+                band[start - band_start:stop - band_start], axis=1)
+
+    return new_mask
+
+
 # TODO: Reduce amount of memory active at one given point (keep less images in
 # memory, write to disk sooner, etc), careful with numpy <-> PIL conversions
 def create_mrc_hocr_components(image, hocr_word_data,
@@ -336,189 +736,410 @@ def create_mrc_hocr_components(image, hocr_word_data,
                                downsample=None,
                                bg_downsample=None,
                                fg_downsample=None,
-                               denoise_mask=None, timing_data=None,
-                               errors=None):
+                               denoise_mask=None, fill_mode=None,
+                               strip_height=None,
+                               timing_data=None, errors=None):
     """
     Create the MRC components: mask, foreground and background
 
     Args:
 
-    * image (PIL.Image): Image to be decomposed
+    * image (PIL.Image or PageBuffer): Image to be decomposed
     * hocr_word_data: OCR data about found text on the page
     * downsample (int): factor by which the OCR data is to be downsampled
     * bg_downsample (int): if the background image should be downscaled
     * denoise_mask (bool): Whether to denoise the image if it is deemed too
       noisy
+    * fill_mode (str): How to fill the foreground and background, FILL_BOX
+      or FILL_PUSHPULL
+    * strip_height (int): if not None, create the mask in horizontal strips
+      of this many rows, so that only a band of the gray page (and of the
+      unpacked mask) is in memory at a time.
     * timing_data: Optional timing data to log individual timing data to.
     * errors: Optional argument (of type set) with encountered runtime errors
 
-    Returns a tuple of the components, as numpy arrays: (mask, foreground,
-    background)
+    Returns a generator yielding the components: mask (as PackedMask),
+    foreground and background (as numpy arrays)
     """
-    grayimg = image
-    if image.mode != 'L':
-        t = time()
-        grayimg = image.convert('L')
-        if timing_data is not None:
-            timing_data.append(('grey_conversion', time() - t))
+    if not isinstance(image, PageBuffer):
+        image = PageBuffer.from_image(image)
 
     width_, height_ = image.size
 
-    mask_arr = np.array(Image.new('1', image.size))
+    mask_arr = PackedMask(width_, height_)
+
+    if strip_height is not None:
+        # Modifies mask_arr in place, converting only the lines to gray
+        create_hocr_mask(image, mask_arr, hocr_word_data,
+                         downsample=downsample, dpi=dpi,
+                         timing_data=timing_data)
 
-    # Modifies mask_arr in place
-    create_hocr_mask(grayimg, mask_arr, hocr_word_data, downsample=downsample,
-                     dpi=dpi, timing_data=timing_data)
-    grayimgf = np.array(grayimg, dtype=np.float32)
+        # Modifies mask_arr in place
+        create_threshold_mask_strips(mask_arr, image, strip_height, dpi=dpi,
+                                     timing_data=timing_data)
+    else:
+        grayimg = image
+        if image.mode != 'L':
+            t = time()
+            grayimg = image.gray()
+            if timing_data is not None:
+                timing_data.append(('grey_conversion', time() - t))
 
-    MIX_THRESHOLD = True
-    if MIX_THRESHOLD:
-        # XXX: this nukes the hocr threshold, testing only
-        # mask_arr = np.zeros(mask_arr.shape, dtype=bool)
+        # Gray pixels, shared by the hOCR and threshold masks (and the page
+        # buffer itself for grayscale pages)
+        grayimg_arr = grayimg.asarray()
+        grayimg = None
 
         # Modifies mask_arr in place
-        create_threshold_mask(mask_arr, grayimgf, dpi=dpi,
-                              denoise_mask=denoise_mask,
-                              timing_data=timing_data)
+        create_hocr_mask(grayimg_arr, mask_arr, hocr_word_data,
+                         downsample=downsample, dpi=dpi,
+                         timing_data=timing_data)
+
+        MIX_THRESHOLD = True
+        if MIX_THRESHOLD:
+            # XXX: this nukes the hocr threshold, testing only
+            # mask_arr = np.zeros(mask_arr.shape, dtype=bool)
+
+            # Modifies mask_arr in place
+            create_threshold_mask(mask_arr, grayimg_arr, dpi=dpi,
+                                  denoise_mask=denoise_mask,
+                                  timing_data=timing_data)
+        grayimg_arr = None
 
     if denoise_mask != DENOISE_NONE:
         t = time()
-        if denoise_mask == DENOISE_FAST:
-            # XXX: We could make the mincnt parameter take the dpi into account
-            fast_mask_denoise(mask_arr, width_, height_, 4, 2)
-            if timing_data is not None:
-                timing_data.append(('fast_denoise', time() - t))
-        elif denoise_mask == DENOISE_BREGMAN:
-            mask_arr = denoise_bregman(mask_arr)
-            if timing_data is not None:
-                timing_data.append(('denoise', time() - t))
+        # The denoisers work on unpacked masks
+        if strip_height is not None:
+            mask_arr = denoise_mask_strips(mask_arr, denoise_mask,
+                                           strip_height, dpi=dpi)
         else:
-            raise ValueError('Invalid denoise option:', denoise_mask)
+            mask_arr = PackedMask.from_array(denoise_mask_arr(
+                mask_arr.to_array(), denoise_mask, dpi=dpi))
 
+        if timing_data is not None:
+            timing_data.append((DENOISE_TIMING_KEYS[denoise_mask],
+                                time() - t))
 
     yield mask_arr
 
-    image_arr = np.array(image)
+    image_arr = image.asarray()
 
-    t = time()
-    # Take foreground pixels and optimise the image by making the surrounding
-    # pixels like the foreground, allowing for more optimal compression (and
-    # higher quality foreground pixels as a result)
-    if image.mode == 'L':
-        foreground_arr = optimise_gray2(mask_arr, image_arr, width_, height_, 3)
-    else:
-        foreground_arr = optimise_rgb2(mask_arr, image_arr, width_, height_, 3)
-    if timing_data is not None:
-        # The name fg_partial_blur is kept for backwards compatibility
-        timing_data.append(('fg_partial_blur', time() - t))
+    foreground_arr, background_arr = create_mrc_layers(mask_arr, image_arr,
+            fg_downsample=fg_downsample, bg_downsample=bg_downsample,
+            fill_mode=fill_mode, timing_data=timing_data, errors=errors)
+    image_arr = None
 
-    if fg_downsample is not None:
-        t = time()
-        image2 = Image.fromarray(foreground_arr)
-        w, h = image2.size
-        w_downsample = int(w / fg_downsample)
-        h_downsample = int(h / fg_downsample)
-        if w_downsample > 0 and h_downsample > 0:
-            image2.thumbnail((w_downsample, h_downsample))
-            foreground_arr = np.array(image2)
-        else:
-            if errors is not None:
-                errors.add(RECODE_RUNTIME_WARNING_TOO_SMALL_TO_DOWNSAMPLE)
+    yield foreground_arr
+    foreground_arr = None
+
+    yield background_arr
+    return
+
+
+def create_mrc_layers(mask_arr, image_arr, fg_downsample=None,
+                      bg_downsample=None, reduced_grid=True, fill_mode=None,
+                      timing_data=None, errors=None):
+    """
+    Create the MRC foreground and background from the image and the mask, in
+    a single pass over both.
+
+    Take foreground pixels and optimise the image by making the surrounding
+    pixels like the foreground, allowing for more optimal compression (and
+    higher quality foreground pixels as a result).
 
+    Take background pixels and optimise the image by placing them where the
+    foreground pixels are thought to be, this has the effect of reducing
+    compression artifacts (thus improving quality) and at the same time making
+    the image easier to compress (smaller file size).
+
+    Args:
+
+    * mask_arr (PackedMask or numpy.ndarray): MRC mask
+    * image_arr (numpy.ndarray): L or RGB image
+    * fg_downsample (int): if the foreground image should be downscaled
+    * bg_downsample (int): if the background image should be downscaled
+    * reduced_grid (bool): create downscaled layers on a box-reduced grid of
+      the image (weighted by mask coverage) rather than at full resolution
+    * fill_mode (str): FILL_BOX (default) fills pixels from a window around
+      them, FILL_PUSHPULL uses push-pull pyramid interpolation
+    * timing_data: Optional timing data to log individual timing data to.
+    * errors: Optional argument (of type set) with encountered runtime errors
+
+    Returns a tuple of numpy arrays: (foreground, background)
+    """
+    height_, width_ = image_arr.shape[0:2]
+
+    fg_factor = fg_downsample if fg_downsample is not None else 1
+    bg_factor = bg_downsample if bg_downsample is not None else 1
+
+    if width_ // fg_factor == 0 or height_ // fg_factor == 0:
+        fg_factor = 1
+        if errors is not None:
+            errors.add(RECODE_RUNTIME_WARNING_TOO_SMALL_TO_DOWNSAMPLE)
+    if width_ // bg_factor == 0 or height_ // bg_factor == 0:
+        bg_factor = 1
+        if errors is not None:
+            errors.add(RECODE_RUNTIME_WARNING_TOO_SMALL_TO_DOWNSAMPLE)
+
+    gray = image_arr.ndim == 2
+    if gray:
+        image_arr = image_arr[:, :, np.newaxis]
+
+    # The kernels read packed masks directly
+    packed = isinstance(mask_arr, PackedMask)
+    mask_data = mask_arr.data if packed else mask_arr
+
+    if fill_mode == FILL_PUSHPULL:
+        t = time()
+        unpacked_mask = mask_arr.to_array() if packed else mask_arr
+        foreground_arr = pushpull_fill(unpacked_mask, image_arr, True, fg_factor)
+        if timing_data is not None:
+            timing_data.append(('fg_pushpull', time() - t))
+        t = time()
+        background_arr = pushpull_fill(unpacked_mask, image_arr, False, bg_factor)
+        unpacked_mask = None
         if timing_data is not None:
-            timing_data.append(('fg_downsample', time() - t))
+            timing_data.append(('bg_pushpull', time() - t))
+    elif fill_mode not in (None, FILL_BOX):
+        raise ValueError('Invalid fill mode: %s' % fill_mode)
+    elif reduced_grid:
+        foreground_arr, background_arr = None, None
+
+        if fg_factor > 1:
+            t = time()
+            foreground_arr = optimise_reduced(mask_data, image_arr, width_,
+                                              height_, 3, fg_factor, 1,
+                                              packed=packed)
+            if timing_data is not None:
+                timing_data.append(('fg_reduced_partial_blur', time() - t))
+        if bg_factor > 1:
+            t = time()
+            background_arr = optimise_reduced(mask_data, image_arr, width_,
+                                              height_, 10, bg_factor, 0,
+                                              packed=packed)
+            if timing_data is not None:
+                timing_data.append(('bg_reduced_partial_blur', time() - t))
+
+        # Layers that are not downscaled still go through the fused kernel,
+        # 0 tells it to skip a layer
+        if fg_factor == 1 or bg_factor == 1:
+            t = time()
+            fg, bg = optimise_fgbg(mask_data, image_arr, width_, height_, 3, 10,
+                                   fg_factor if fg_factor == 1 else 0,
+                                   bg_factor if bg_factor == 1 else 0,
+                                   packed=packed)
+            if fg is not None:
+                foreground_arr = fg
+            if bg is not None:
+                background_arr = bg
+            if timing_data is not None:
+                timing_data.append(('fgbg_partial_blur', time() - t))
+    else:
+        t = time()
+        foreground_arr, background_arr = optimise_fgbg(mask_data, image_arr,
+                width_, height_, 3, 10, fg_factor, bg_factor, packed=packed)
+        if timing_data is not None:
+            timing_data.append(('fgbg_partial_blur', time() - t))
 
-    yield foreground_arr
-    foreground_arr = None
+    if gray:
+        foreground_arr = foreground_arr[:, :, 0]
+        background_arr = background_arr[:, :, 0]
 
-    mask_inv = mask_arr ^ np.ones(mask_arr.shape, dtype=bool)
+    return foreground_arr, background_arr
 
-    t = time()
-    # Take background pixels and optimise the image by placing them where the
-    # foreground pixels are thought to be, this has the effect of reducing
-    # compression artifacts (thus improving quality) and at the same time making
-    # the image easier to compress (smaller file size)
-    if image.mode == 'L':
-        background_arr = optimise_gray2(mask_inv, image_arr, width_, height_, 10)
+
+# Size of the mask that ccitt_available encodes. The packed mask is larger
+# than the default TIFF strip size (64 KiB), so that the probe fails when
+# Pillow cannot write a page sized mask as a single strip.
+CCITT_PROBE_SIZE = 2048
+
+# Whether Pillow's (libtiff) G4 encoder has to be given an inverted mask for
+# the stream to decode to the mask with the default /BlackIs1 false. Depends on
+# the Pillow version, found out on the first encode.
+_CCITT_INVERT = None
+
+
+def _encode_g4_strip(img):
+    """
+    Encode a Pillow '1' image as a single strip G4 TIFF with Pillow/libtiff.
+
+    Returns a tuple of the raw G4 data and the TIFF photometric
+    interpretation, or None if the TIFF does not have a single strip.
+    """
+    width, height = img.size
+    # One strip for the entire image, so that the strip is a complete G4
+    # stream (strip_size is ignored by older Pillow versions, which then fail
+    # for masks larger than a strip, see ccitt_available)
+    strip_size = max(1, ((width + 7) // 8) * height)
+
+    fd = io.BytesIO()
+    img.save(fd, format='TIFF', compression='group4', strip_size=strip_size)
+    data = fd.getvalue()
+
+    fd.seek(0)
+    tif = Image.open(fd)
+    offsets = tif.tag_v2.get(273)
+    counts = tif.tag_v2.get(279)
+    photometric = tif.tag_v2.get(262, 0)
+    tif.close()
+
+    if offsets is None or counts is None or len(offsets) != 1:
+        return None
+
+    return data[offsets[0]:offsets[0] + counts[0]], photometric
+
+
+def encode_ccitt_g4(mask):
+    """
+    Encode a mask as CCITT G4 (/CCITTFaxDecode with /K -1), in process, using
+    Pillow's libtiff support.
+
+    The stream decodes to the mask (pixels in the mask being 1) with the
+    default /BlackIs1 false.
+
+    Args:
+
+    * mask (PackedMask or numpy.ndarray): Mask image
+
+    Returns the G4 stream (bytes). Raises ValueError if the stream could not be
+    created (Pillow without libtiff, for example).
+    """
+    global _CCITT_INVERT
+
+    if not isinstance(mask, PackedMask):
+        mask = PackedMask.from_array(mask)
+
+    if _CCITT_INVERT:
+        res = _encode_g4_strip((~mask).to_pil())
     else:
-        background_arr = optimise_rgb2(mask_inv, image_arr, width_, height_, 10)
-    if timing_data is not None:
-        # The name bg_partial_blur is kept for backwards compatibility
-        timing_data.append(('bg_partial_blur', time() - t))
+        res = _encode_g4_strip(mask.to_pil())
 
-    if bg_downsample is not None:
-        t = time()
-        image2 = Image.fromarray(background_arr)
-        w, h = image2.size
-        w_downsample = int(w / bg_downsample)
-        h_downsample = int(h / bg_downsample)
-        if w_downsample > 0 and h_downsample > 0:
-            image2.thumbnail((w_downsample, h_downsample))
-            background_arr = np.array(image2)
-        else:
-            if errors is not None:
-                errors.add(RECODE_RUNTIME_WARNING_TOO_SMALL_TO_DOWNSAMPLE)
+    if res is None:
+        raise ValueError('Could not create single strip G4 data')
 
-        if timing_data is not None:
-            timing_data.append(('bg_downsample', time() - t))
+    data, photometric = res
 
-    yield background_arr
-    return
+    if _CCITT_INVERT is None:
+        # With MinIsBlack, Pillow hands libtiff the '1' pixels as-is, and
+        # libtiff encodes 0 bits as white runs, which decode to 1 bits with
+        # /BlackIs1 false, so the mask needs to be inverted
+        _CCITT_INVERT = photometric == 1
+        if _CCITT_INVERT:
+            return encode_ccitt_g4(mask)
+
+    return data
+
+
+def ccitt_available():
+    """
+    Returns whether in process CCITT G4 encoding (encode_ccitt_g4) works with
+    the installed Pillow, for page sized masks.
+    """
+    try:
+        encode_ccitt_g4(PackedMask(CCITT_PROBE_SIZE, CCITT_PROBE_SIZE))
+    except Exception:
+        return False
+
+    return True
 
 
 def encode_mrc_mask(np_mask, tmp_dir=None, jbig2=True, embedded_jbig2=False,
-                    timing_data=None, debug=False):
+                    timing_data=None, debug=False, ccitt=False, flate=False):
     """
     Encode mask image either to JBIG2 or PNG.
 
+    For JBIG2, the packed mask is written as PBM and handed to jbig2 as-is,
+    without ever unpacking it.
+
     Args:
 
-    * np_mask (numpy.array): Mask image array
+    * np_mask (PackedMask or numpy.array): Mask image
     * tmp_dir (str): path the temporary directory to write images to
     * jbig2 (bool): Whether to encode to JBIG2 or PNG
     * embedded_jbig2 (bool): Whether to encode to JBIG2 with or without header
     * timing_data (optional): Add time information to timing_data structure
+    * ccitt (bool): If not jbig2, encode to a raw CCITT G4 stream (see
+      encode_ccitt_g4) instead of PNG
+    * flate (bool): If not jbig2 and not ccitt, encode to a zlib compressed
+      1 bit stream (for /FlateDecode) instead of PNG
 
     Returns a tuple: (str, str) where the first entry is the jbig2
-    path, if any, the second is the png path.
+    path, if any, the second is the png (or pbm, for jbig2, G4, for ccitt, or
+    zlib, for flate) path.
     """
     t = time()
-    mask = Image.fromarray(np_mask)
+    if isinstance(np_mask, PackedMask):
+        mask = np_mask
+    else:
+        mask = PackedMask.from_array(np_mask)
 
-    fd, mask_img_png = mkstemp(prefix='mask', suffix='.png', dir=tmp_dir)
-    close(fd)
-    if jbig2:
-        fd, mask_img_jbig2 = mkstemp(prefix='mask', suffix='.jbig2', dir=tmp_dir)
+    if not jbig2 and ccitt:
+        fd, mask_img_g4 = mkstemp(prefix='mask', suffix='.g4', dir=tmp_dir)
         close(fd)
+        fp = open(mask_img_g4, 'wb+')
+        fp.write(encode_ccitt_g4(mask))
+        fp.close()
 
-    mask.save(mask_img_png, compress_level=0)
-
-    if jbig2:
-        args = ['jbig2', mask_img_png]
-        if embedded_jbig2:
-            args = ['jbig2', '-p', mask_img_png]
+        if timing_data is not None:
+            timing_data.append(('mask_ccitt', time()-t))
 
-        if debug:
-            print('check_output: %s' % args, file=sys.stderr)
+        return None, mask_img_g4
 
-        out = subprocess.check_output(args)
-        fp= open(mask_img_jbig2, 'wb+')
-        fp.write(out)
+    if not jbig2 and flate:
+        fd, mask_img_flate = mkstemp(prefix='mask', suffix='.zlib',
+                                     dir=tmp_dir)
+        close(fd)
+        fp = open(mask_img_flate, 'wb+')
+        # The packed rows are the raw 1 bit image data of the PDF image
+        fp.write(zlib.compress(mask.data.tobytes()))
         fp.close()
 
+        if timing_data is not None:
+            timing_data.append(('mask_flate', time()-t))
+
+        return None, mask_img_flate
+
+    if not jbig2:
+        fd, mask_img_png = mkstemp(prefix='mask', suffix='.png', dir=tmp_dir)
+        close(fd)
+        mask.to_pil().save(mask_img_png, compress_level=0)
+
+        if timing_data is not None:
+            timing_data.append(('mask_jbig2', time()-t))
+
+        return None, mask_img_png
+
+    fd, mask_img_pbm = mkstemp(prefix='mask', suffix='.pbm', dir=tmp_dir)
+    close(fd)
+    fd, mask_img_jbig2 = mkstemp(prefix='mask', suffix='.jbig2', dir=tmp_dir)
+    close(fd)
+
+    fp = open(mask_img_pbm, 'wb+')
+    fp.write(mask.to_pbm())
+    fp.close()
+
+    args = ['jbig2', mask_img_pbm]
+    if embedded_jbig2:
+        args = ['jbig2', '-p', mask_img_pbm]
+
+    if debug:
+        print('check_output: %s' % args, file=sys.stderr)
+
+    out = subprocess.check_output(args)
+    fp= open(mask_img_jbig2, 'wb+')
+    fp.write(out)
+    fp.close()
+
     if timing_data is not None:
         timing_data.append(('mask_jbig2', time()-t))
 
-    if jbig2:
-        return mask_img_jbig2, mask_img_png
-    else:
-        return None, mask_img_png
+    return mask_img_jbig2, mask_img_pbm
 
 
 def encode_mrc_img(np_img, img_compression_flags, imgtype=None, tmp_dir=None,
         jpeg2000_implementation=None, mrc_image_format=None, timing_data=None,
-        threads=False,
-        debug=False):
+        threads=False, rate_control=None, page_pixels=None,
+        thread_budget=None, debug=False):
     """
     Encode image as JPEG2000 or JPEG, with the provided compression settings
     and JPEG2000/JPEG encoder.
@@ -532,6 +1153,13 @@ def encode_mrc_img(np_img, img_compression_flags, imgtype=None, tmp_dir=None,
     * jpeg2000_implementation (str): What JPEG2000 implementation to use
     * mrc_image_format (str): What image format to produce
     * timing_data (optional): Add time information to timing_data structure
+    * rate_control (RateControl, optional): if it has a budget for imgtype,
+      the rate flags in the compression flags are replaced by flags that
+      target the budget (see ratecontrol.rate_flags)
+    * page_pixels (int, optional): amount of pixels of the page, for the
+      budget (default is the amount of pixels of np_img)
+    * thread_budget (ThreadBudget, optional): take the encoder threads from
+      this budget instead of using threads
     * debug (bool, optional): Write debug info to stderr
 
     Returns the filepath to the JPEG2000 image
@@ -540,8 +1168,26 @@ def encode_mrc_img(np_img, img_compression_flags, imgtype=None, tmp_dir=None,
     if imgtype not in ('bg', 'fg'):
         raise ValueError('imgtype should be \'bg\' or \'fg\'')
 
-    # Create background
+    requested_size = None
+    if rate_control is not None and rate_control.enabled(imgtype):
+        height, width = np_img.shape[0:2]
+        if page_pixels is None:
+            page_pixels = width * height
+
+        requested_size = rate_control.request_size(imgtype, page_pixels)
+        img_compression_flags = rate_flags(requested_size, width, height,
+                np_img.shape[2] if np_img.ndim == 3 else 1,
+                jpeg2000_implementation=jpeg2000_implementation,
+                mrc_image_format=mrc_image_format,
+                flags=img_compression_flags)
+
+    # jpegoptim flags that we can handle in process
+    jpeg_kwargs = None
     if mrc_image_format == COMPRESSOR_JPEG:
+        jpeg_kwargs = parse_jpegoptim_flags(img_compression_flags)
+
+    # Create background
+    if mrc_image_format == COMPRESSOR_JPEG and jpeg_kwargs is None:
         fd, img_tiff = mkstemp(prefix=imgtype, suffix='.jpg', dir=tmp_dir)
         close(fd)
 
@@ -552,7 +1198,11 @@ def encode_mrc_img(np_img, img_compression_flags, imgtype=None, tmp_dir=None,
 
     img = Image.fromarray(np_img)
 
-    if mrc_image_format == COMPRESSOR_JPEG:
+    if mrc_image_format == COMPRESSOR_JPEG and jpeg_kwargs is not None:
+        tmpfd = open(img_jp2, 'bw+')
+        tmpfd.write(encode_jpeg(img, **jpeg_kwargs))
+        tmpfd.close()
+    elif mrc_image_format == COMPRESSOR_JPEG:
         img.save(img_tiff, quality=100)
 
 
@@ -563,11 +1213,21 @@ def encode_mrc_img(np_img, img_compression_flags, imgtype=None, tmp_dir=None,
         tmpfd=open(img_jp2, 'bw+') # XXX: FIXME: this defeats the point of a tmpfile
         tmpfd.write(output)
         tmpfd.close()
+        remove(img_tiff)
+    elif thread_budget is not None:
+        # Pillow does not take a thread count, it always uses one
+        want = 1 if jpeg2000_implementation == JPEG2000_IMPL_PILLOW else None
+        with thread_budget.reserve(want) as granted:
+            encode_jpeg2000(img, img_jp2, jpeg2000_implementation,
+                            img_compression_flags, imgtype=imgtype,
+                            threads=granted, debug=debug)
     else:
         encode_jpeg2000(img, img_jp2, jpeg2000_implementation,
                         img_compression_flags, imgtype=imgtype,
                         threads=threads, debug=debug)
 
+    if requested_size is not None:
+        rate_control.update(imgtype, requested_size, getsize(img_jp2))
 
     if timing_data is not None:
         timing_data.append(('%s_jp2' % imgtype, time()-t))
@@ -577,7 +1237,8 @@ def encode_mrc_img(np_img, img_compression_flags, imgtype=None, tmp_dir=None,
 
 def encode_mrc_background(np_bg, bg_compression_flags, tmp_dir=None,
         jpeg2000_implementation=None, mrc_image_format=None, timing_data=None,
-        threads=None, debug=False):
+        threads=None, rate_control=None, page_pixels=None,
+        thread_budget=None, debug=False):
     """
     Encode background image as JPEG2000, with the provided compression settings
     and JPEG2000 encoder.
@@ -590,19 +1251,24 @@ def encode_mrc_background(np_bg, bg_compression_flags, tmp_dir=None,
     * jpeg2000_implementation (str): What JPEG2000 implementation to use
     * mrc_image_format (str): What image format to produce
     * timing_data (optional): Add time information to timing_data structure
+    * rate_control (RateControl, optional): see encode_mrc_img
+    * page_pixels (int, optional): see encode_mrc_img
+    * thread_budget (ThreadBudget, optional): see encode_mrc_img
 
     Returns the filepath to the JPEG2000 background image
     """
     return encode_mrc_img(np_bg, bg_compression_flags, 'bg', tmp_dir=tmp_dir,
             jpeg2000_implementation=jpeg2000_implementation,
             mrc_image_format=mrc_image_format, timing_data=timing_data,
-            threads=threads,
+            threads=threads, rate_control=rate_control,
+            page_pixels=page_pixels, thread_budget=thread_budget,
             debug=debug)
 
 
 def encode_mrc_foreground(np_fg, fg_compression_flags, tmp_dir=None,
         jpeg2000_implementation=None, mrc_image_format=None, timing_data=None,
-        threads=False, debug=False):
+        threads=False, rate_control=None, page_pixels=None,
+        thread_budget=None, debug=False):
     """
     Encode foreground image as JPEG2000, with the provided compression settings
     and JPEG2000 encoder.
@@ -615,39 +1281,121 @@ def encode_mrc_foreground(np_fg, fg_compression_flags, tmp_dir=None,
     * jpeg2000_implementation (str): What JPEG2000 implementation to use
     * mrc_image_format (str): What image format to produce
     * timing_data (optional): Add time information to timing_data structure
+    * rate_control (RateControl, optional): see encode_mrc_img
+    * page_pixels (int, optional): see encode_mrc_img
+    * thread_budget (ThreadBudget, optional): see encode_mrc_img
 
     Returns the filepath to the JPEG2000 foreground image
     """
     return encode_mrc_img(np_fg, fg_compression_flags, 'fg', tmp_dir=tmp_dir,
             jpeg2000_implementation=jpeg2000_implementation,
             mrc_image_format=mrc_image_format, timing_data=timing_data,
-            threads=threads,
+            threads=threads, rate_control=rate_control,
+            page_pixels=page_pixels, thread_budget=thread_budget,
             debug=debug)
 
 
 def encode_mrc_images(mrc_gen, bg_compression_flags=None, fg_compression_flags=None,
                       tmp_dir=None, jbig2=True, timing_data=None,
                       jpeg2000_implementation=None, mrc_image_format=None,
-                      embedded_jbig2=False, threads=None, debug=False):
-    mask_img_jbig2, mask_img_png = encode_mrc_mask(next(mrc_gen),
-            tmp_dir=tmp_dir, jbig2=jbig2, embedded_jbig2=embedded_jbig2,
-            timing_data=timing_data)
-
-    np_fg = next(mrc_gen)
-    fg_img_jp2 = encode_mrc_foreground(np_fg, fg_compression_flags, tmp_dir=tmp_dir,
-                                       jpeg2000_implementation=jpeg2000_implementation,
-                                       mrc_image_format=mrc_image_format,
-                                       timing_data=timing_data, threads=threads, debug=debug)
-    fg_h, fg_w = np_fg.shape[0:2]
-    np_fg = None
-
-    np_bg = next(mrc_gen)
-    bg_img_jp2 = encode_mrc_background(np_bg, bg_compression_flags, tmp_dir=tmp_dir,
-                                       jpeg2000_implementation=jpeg2000_implementation,
-                                       mrc_image_format=mrc_image_format,
-                                       timing_data=timing_data, threads=threads, debug=debug)
-    bg_h, bg_w = np_bg.shape[0:2]
-    np_bg = None
+                      embedded_jbig2=False, threads=None, debug=False,
+                      concurrent=True, ccitt=False, flate=False,
+                      rate_control=None, thread_budget=None):
+    np_mask = next(mrc_gen)
+
+    # The mask has the page size, the budgets are per page pixel
+    page_pixels = np_mask.shape[0] * np_mask.shape[1]
+
+    # With a single thread there is nothing to run next to the component
+    # creation
+    workers = 2
+    if thread_budget is not None:
+        workers = min(workers, thread_budget.total - 1)
+        concurrent = concurrent and workers > 0
+
+    if concurrent:
+        # Encode the mask and foreground on a thread pool while the next
+        # component is being created, encoders don't hold the GIL (they are
+        # either external programs or Pillow codecs)
+        #
+        # Creating the components takes a thread of the budget (the kernels
+        # are single threaded), until the background is created
+        main_threads = None
+        if thread_budget is not None:
+            main_threads = thread_budget.acquire(1)
+
+        def encode_mask(np_mask):
+            # The mask encoders are single threaded
+            if thread_budget is None:
+                return encode_mrc_mask(np_mask, tmp_dir=tmp_dir, jbig2=jbig2,
+                        embedded_jbig2=embedded_jbig2, timing_data=timing_data,
+                        ccitt=ccitt, flate=flate)
+            with thread_budget.reserve(1):
+                return encode_mrc_mask(np_mask, tmp_dir=tmp_dir, jbig2=jbig2,
+                        embedded_jbig2=embedded_jbig2, timing_data=timing_data,
+                        ccitt=ccitt, flate=flate)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            mask_future = executor.submit(encode_mask, np_mask)
+            np_mask = None
+
+            np_fg = next(mrc_gen)
+            fg_future = executor.submit(encode_mrc_foreground, np_fg,
+                    fg_compression_flags, tmp_dir=tmp_dir,
+                    jpeg2000_implementation=jpeg2000_implementation,
+                    mrc_image_format=mrc_image_format,
+                    timing_data=timing_data, threads=threads,
+                    rate_control=rate_control, page_pixels=page_pixels,
+                    thread_budget=thread_budget, debug=debug)
+            fg_h, fg_w = np_fg.shape[0:2]
+            np_fg = None
+
+            try:
+                np_bg = next(mrc_gen)
+            finally:
+                if main_threads is not None:
+                    thread_budget.release(main_threads)
+            bg_img_jp2 = encode_mrc_background(np_bg, bg_compression_flags,
+                    tmp_dir=tmp_dir,
+                    jpeg2000_implementation=jpeg2000_implementation,
+                    mrc_image_format=mrc_image_format,
+                    timing_data=timing_data, threads=threads,
+                    rate_control=rate_control, page_pixels=page_pixels,
+                    thread_budget=thread_budget, debug=debug)
+            bg_h, bg_w = np_bg.shape[0:2]
+            np_bg = None
+
+            mask_img_jbig2, mask_img_png = mask_future.result()
+            fg_img_jp2 = fg_future.result()
+    else:
+        mask_img_jbig2, mask_img_png = encode_mrc_mask(np_mask,
+                tmp_dir=tmp_dir, jbig2=jbig2, embedded_jbig2=embedded_jbig2,
+                timing_data=timing_data, ccitt=ccitt, flate=flate)
+        np_mask = None
+
+        np_fg = next(mrc_gen)
+        fg_img_jp2 = encode_mrc_foreground(np_fg, fg_compression_flags, tmp_dir=tmp_dir,
+                                           jpeg2000_implementation=jpeg2000_implementation,
+                                           mrc_image_format=mrc_image_format,
+                                           timing_data=timing_data, threads=threads,
+                                           rate_control=rate_control,
+                                           page_pixels=page_pixels,
+                                           thread_budget=thread_budget,
+                                           debug=debug)
+        fg_h, fg_w = np_fg.shape[0:2]
+        np_fg = None
+
+        np_bg = next(mrc_gen)
+        bg_img_jp2 = encode_mrc_background(np_bg, bg_compression_flags, tmp_dir=tmp_dir,
+                                           jpeg2000_implementation=jpeg2000_implementation,
+                                           mrc_image_format=mrc_image_format,
+                                           timing_data=timing_data, threads=threads,
+                                           rate_control=rate_control,
+                                           page_pixels=page_pixels,
+                                           thread_budget=thread_budget,
+                                           debug=debug)
+        bg_h, bg_w = np_bg.shape[0:2]
+        np_bg = None
 
     # XXX: probably don't need this
     try:
@@ -661,7 +1409,8 @@ def encode_mrc_images(mrc_gen, bg_compression_flags=None, fg_compression_flags=N
     if jbig2:
         return mask_img_jbig2, bg_img_jp2, (bg_w, bg_h), fg_img_jp2, (fg_w, fg_h)
     else:
-        # Return PNG which mupdf will turn into ccitt with
-        # save(..., deflate=True) until mupdf fixes their JBIG2 support
+        # Return the raw G4 (or zlib) stream if ccitt (or flate), otherwise
+        # PNG which mupdf will turn into ccitt with save(..., deflate=True)
+        # until mupdf fixes their JBIG2 support
         #return mask_img_png, bg_img_jp2, fg_img_jp2
         return mask_img_png, bg_img_jp2, (bg_w, bg_h), fg_img_jp2, (fg_w, fg_h)
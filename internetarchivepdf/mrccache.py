@@ -0,0 +1,211 @@
+# archive-pdf-tools
+# Copyright (C) 2020-2021, Internet Archive
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Merlijn Boris Wolf Wajer <merlijn@archive.org>
+#
+# Persistent on-disk cache of encoded MRC components, so that re-runs on the
+# same item do not have to create and encode the MRC images of unchanged pages
+# again.
+
+import os
+import json
+import hashlib
+from os import close, remove
+from tempfile import mkstemp
+from collections import OrderedDict
+
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+CACHE_SUFFIX = '.mrc'
+
+
+class MRCCache(object):
+    """
+    On-disk cache of encoded MRC components (mask, foreground and background
+    streams), with least recently used eviction once the cache grows beyond
+    max_size bytes.
+
+    Every entry is a single file: a line of JSON with the image sizes and
+    stream lengths, followed by the mask, background and foreground streams.
+    Entries are written to a temporary file and renamed, so a cache directory
+    can be shared between processes. Each process only evicts the entries it
+    knows of, so the size bound is approximate when the directory is shared.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE):
+        """
+        Open (or create) a cache directory.
+
+        Args:
+
+        * path (str): cache directory
+        * max_size (int): maximum size of the cache, in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(path, exist_ok=True)
+
+        # Entries from least to most recently used, with their size
+        entries = []
+        for name in os.listdir(path):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name[:-len(CACHE_SUFFIX)], st.st_size))
+
+        entries.sort()
+        self._entries = OrderedDict((key, size) for _, key, size in entries)
+        self.size = sum(self._entries.values())
+
+    def key(self, *params):
+        """
+        Create a cache key from the page pixel hash and all the parameters
+        that influence the MRC components (these need to have a stable repr).
+        """
+        h = hashlib.blake2b(digest_size=20)
+        h.update(repr(params).encode('utf-8'))
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + CACHE_SUFFIX)
+
+    def _write_tmp(self, data, prefix, tmp_dir):
+        fd, path = mkstemp(prefix=prefix, dir=tmp_dir)
+        close(fd)
+        fp = open(path, 'wb')
+        fp.write(data)
+        fp.close()
+        return path
+
+    def get(self, key, tmp_dir=None):
+        """
+        Look up the MRC components of a page.
+
+        Args:
+
+        * key (str): cache key, see key
+        * tmp_dir (str): directory to write the component files to
+
+        Returns None if the page is not in the cache, otherwise a tuple like
+        encode_mrc_images returns: (mask path, bg path, bg size, fg path,
+        fg size). The files are copies, so the caller owns them.
+        """
+        path = self._entry_path(key)
+        try:
+            fp = open(path, 'rb')
+            try:
+                header = json.loads(fp.readline().decode('utf-8'))
+                mask = fp.read(header['mask'])
+                bg = fp.read(header['bg'])
+                fg = fp.read(header['fg'])
+            finally:
+                fp.close()
+
+            if len(mask) != header['mask'] or len(bg) != header['bg'] or \
+                    len(fg) != header['fg']:
+                raise ValueError('Truncated cache entry')
+        except FileNotFoundError:
+            self._forget(key)
+            self.misses += 1
+            return None
+        except (OSError, ValueError, KeyError):
+            # Broken entry, drop it
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        # Mark as most recently used, also for other processes
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        if key in self._entries:
+            self._entries.move_to_end(key)
+
+        self.hits += 1
+
+        mask_f = self._write_tmp(mask, 'mask', tmp_dir)
+        bg_f = self._write_tmp(bg, 'bg', tmp_dir)
+        fg_f = self._write_tmp(fg, 'fg', tmp_dir)
+
+        return (mask_f, bg_f, tuple(header['bg_size']), fg_f,
+                tuple(header['fg_size']))
+
+    def put(self, key, mask_f, bg_f, bg_s, fg_f, fg_s):
+        """
+        Store the MRC components of a page, as returned by encode_mrc_images.
+        The component files are copied into the cache.
+        """
+        mask = open(mask_f, 'rb').read()
+        bg = open(bg_f, 'rb').read()
+        fg = open(fg_f, 'rb').read()
+
+        header = json.dumps({'mask': len(mask), 'bg': len(bg), 'fg': len(fg),
+                             'bg_size': list(bg_s), 'fg_size': list(fg_s)})
+
+        fd, tmp_path = mkstemp(prefix='tmp', dir=self.path)
+        close(fd)
+        fp = open(tmp_path, 'wb')
+        fp.write(header.encode('utf-8') + b'\n')
+        fp.write(mask)
+        fp.write(bg)
+        fp.write(fg)
+        fp.close()
+
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, self._entry_path(key))
+
+        self._forget(key)
+        self._entries[key] = size
+        self.size += size
+
+        self._evict()
+
+    def _forget(self, key):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self.size -= size
+
+    def _remove(self, key):
+        self._forget(key)
+        try:
+            remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.size > self.max_size and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the hits, misses, evictions, and the amount
+        of entries and bytes in the cache.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self._entries),
+                'bytes': self.size}
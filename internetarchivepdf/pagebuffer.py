@@ -0,0 +1,163 @@
+# archive-pdf-tools
+# Copyright (C) 2020-2021, Internet Archive
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Merlijn Boris Wolf Wajer <merlijn@archive.org>
+#
+# Page buffers own the pixels of a page, and hand out numpy and Pillow views
+# of them, so that the MRC code does not copy the full page every time it
+# moves between Pillow and numpy.
+
+import numpy as np
+from PIL import Image
+
+
+# Pillow modes that Image.frombuffer can map without copying
+_MAPPED_MODES = ('L', 'RGBA', 'RGBX', 'CMYK')
+
+# Amount of rows converted at a time by PageBuffer.gray_rows
+_GRAY_BAND_ROWS = 256
+
+
+class PageBuffer(object):
+    """
+    Pixels of a page (or a part of a page), as a C contiguous numpy.ndarray
+    (numpy.uint8) of shape (height, width) for 'L' or (height, width,
+    channels) for colour modes.
+
+    Every full page copy that is made through the buffer is appended to the
+    optional trace list, as a tuple of (label, bytes), see get_copy_summary.
+    """
+
+    def __init__(self, arr, mode, trace=None):
+        """
+        Wrap an existing array, the array is not copied.
+
+        Args:
+
+        * arr (numpy.ndarray): pixel data
+        * mode (str): Pillow mode of the pixel data ('L' or 'RGB')
+        * trace (list): optional list to record full page copies in
+        """
+        if not arr.flags['C_CONTIGUOUS']:
+            raise ValueError('Page buffer has to be C contiguous')
+
+        self.arr = arr
+        self.mode = mode
+        self.trace = trace
+
+    @classmethod
+    def from_image(cls, image, trace=None):
+        """
+        Create a page buffer from a Pillow image, this is the one copy of the
+        pixels from Pillow to numpy. The resulting array is read-only.
+        """
+        # np.asarray uses the bytes from Image.tobytes as buffer, where
+        # np.array would copy them again
+        arr = np.asarray(image)
+        buf = cls(arr, image.mode, trace=trace)
+        buf._record('from_image', arr.nbytes)
+        return buf
+
+    @property
+    def size(self):
+        return (self.arr.shape[1], self.arr.shape[0])
+
+    @property
+    def width(self):
+        return self.arr.shape[1]
+
+    @property
+    def height(self):
+        return self.arr.shape[0]
+
+    def _record(self, label, nbytes):
+        if self.trace is not None:
+            self.trace.append((label, nbytes))
+
+    def asarray(self):
+        """
+        Returns the pixels as numpy.ndarray, without copying
+        """
+        return self.arr
+
+    def image(self):
+        """
+        Returns the pixels as Pillow image. This does not copy for 'L' pages,
+        for 'RGB' pages Pillow has to copy (and pad) the pixels.
+        """
+        if self.mode in _MAPPED_MODES:
+            return Image.frombuffer(self.mode, self.size, self.arr, 'raw',
+                                    self.mode, 0, 1)
+
+        self._record('to_image', self.arr.nbytes)
+        return Image.fromarray(self.arr, self.mode)
+
+    def gray_rows(self, start, stop):
+        """
+        Returns the rows start up to stop of the page as grayscale
+        numpy.ndarray. This is a view for 'L' pages, otherwise the rows are
+        converted by Pillow in bands, so that only a band is copied at a time.
+        """
+        if self.mode == 'L':
+            return self.arr[start:stop]
+
+        width = self.arr.shape[1]
+        gray = np.empty((stop - start, width), dtype=np.uint8)
+
+        for y in range(start, stop, _GRAY_BAND_ROWS):
+            band = self.arr[y:min(y + _GRAY_BAND_ROWS, stop)]
+            band_img = Image.frombuffer(self.mode, (width, band.shape[0]),
+                                        band, 'raw', self.mode, 0, 1)
+            gray[y - start:y - start + band.shape[0]] = \
+                    np.asarray(band_img.convert('L'))
+
+        return gray
+
+    def gray(self):
+        """
+        Returns a grayscale ('L') page buffer. This is the buffer itself for
+        'L' pages, see also gray_rows.
+        """
+        if self.mode == 'L':
+            return self
+
+        gray = self.gray_rows(0, self.arr.shape[0])
+
+        buf = PageBuffer(gray, 'L', trace=self.trace)
+        buf._record('gray', gray.nbytes)
+        return buf
+
+
+def get_copy_summary(trace):
+    """
+    Summarise a page buffer copy trace.
+
+    Args:
+
+    * trace (list): list of (label, bytes) tuples
+
+    Returns a dictionary mapping the label to a dictionary with the amount of
+    copies ('count') and the amount of bytes copied ('bytes').
+    """
+    summary = {}
+    for label, nbytes in trace:
+        if label not in summary:
+            summary[label] = {'count': 0, 'bytes': 0}
+
+        summary[label]['count'] += 1
+        summary[label]['bytes'] += nbytes
+
+    return summary
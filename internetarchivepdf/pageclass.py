@@ -0,0 +1,200 @@
+# archive-pdf-tools
+# Copyright (C) 2020-2021, Internet Archive
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Merlijn Boris Wolf Wajer <merlijn@archive.org>
+#
+# Cheap page classification on subsampled pages, used to pick a faster
+# encoding path for pages that do not need full MRC compression.
+
+import numpy as np
+from PIL import Image
+
+from internetarchivepdf.const import (PAGE_CLASS_BITONAL, PAGE_CLASS_GRAY,
+        PAGE_CLASS_COLOUR)
+
+
+# Longest side of the subsampled page that the statistics are computed on
+SUBSAMPLE_SIZE = 256
+
+# A page is blank if it has no (more than BLANK_MAX_WORDS) OCR words, and the
+# subsampled gray page has a standard deviation of at most BLANK_MAX_STDDEV
+# and a 1st-99th percentile spread of at most BLANK_MAX_SPREAD.
+BLANK_MAX_WORDS = 0
+BLANK_MAX_STDDEV = 6.0
+BLANK_MAX_SPREAD = 40
+
+# Longest side of the point sampled page used by classify_page; point sampling
+# (rather than averaging) keeps text edges sharp for the bimodality check.
+CLASSIFY_SAMPLE_SIZE = 512
+
+# A colour page is gray if the 1st-99th percentile spread of its chroma
+# (red - green and blue - yellow) is at most GRAY_MAX_CHROMA_SPREAD, so that
+# uniformly tinted paper still counts as gray.
+GRAY_MAX_CHROMA_SPREAD = 24
+
+# A (gray) page is bitonal if the Otsu between class variance is at least
+# this fraction of the total variance of the gray values.
+BITONAL_MIN_BIMODALITY = 0.95
+
+
+def subsample_page(image, max_size=SUBSAMPLE_SIZE):
+    """
+    Subsample a page by box averaging, so that the longest side is at most
+    max_size pixels.
+
+    Args:
+
+    * image (PIL.Image): page image
+    * max_size (int): maximum size of the longest side
+
+    Returns the subsampled page as numpy.ndarray
+    """
+    factor = max(1, -(-max(image.size) // max_size))
+    if factor > 1:
+        image = image.reduce(factor)
+
+    return np.asarray(image)
+
+
+def hocr_word_count(hocr_word_data):
+    """
+    Returns the amount of (non empty) words in the hOCR word data of a page
+    """
+    count = 0
+    for paragraph in hocr_word_data:
+        for line in paragraph['lines']:
+            for word in line['words']:
+                if word['text'].strip():
+                    count += 1
+
+    return count
+
+
+def detect_blank_page(image, hocr_word_data, max_words=BLANK_MAX_WORDS,
+                      max_stddev=BLANK_MAX_STDDEV,
+                      max_spread=BLANK_MAX_SPREAD):
+    """
+    Detect blank and near blank (uniform) pages.
+
+    Args:
+
+    * image (PIL.Image): page image ('L' or 'RGB')
+    * hocr_word_data: OCR data about found text on the page
+    * max_words (int): maximum amount of OCR words on a blank page
+    * max_stddev (float): maximum standard deviation of the gray values
+    * max_spread (int): maximum spread between the 1st and 99th percentile of
+      the gray values
+
+    Returns the colour of the page (int for 'L' pages, tuple of ints for
+    'RGB' pages) if the page is blank, None otherwise.
+    """
+    if hocr_word_count(hocr_word_data) > max_words:
+        return None
+
+    arr = subsample_page(image)
+    if arr.ndim == 3:
+        gray = arr.mean(axis=2)
+    else:
+        gray = arr
+
+    if gray.std() > max_stddev:
+        return None
+
+    low, high = np.percentile(gray, (1, 99))
+    if high - low > max_spread:
+        return None
+
+    # Median rather than mean, so that specks do not tint the page
+    if arr.ndim == 3:
+        return tuple(int(v) for v in np.median(arr.reshape(-1, arr.shape[2]),
+                                               axis=0))
+
+    return int(np.median(arr))
+
+
+def _percentile_spread(arr):
+    low, high = np.percentile(arr, (1, 99))
+    return high - low
+
+
+def histogram_bimodality(gray):
+    """
+    Measure how bimodal the histogram of a gray image is.
+
+    Args:
+
+    * gray (numpy.ndarray): gray (uint8 or int) image array
+
+    Returns the ratio (between 0 and 1) of the largest between class
+    variance over all thresholds (as in Otsu's method) to the total variance.
+    """
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    p = hist / hist.sum()
+    values = np.arange(len(p), dtype=np.float64)
+
+    omega = np.cumsum(p)
+    mu = np.cumsum(p * values)
+    mu_t = mu[-1]
+
+    total = (p * (values - mu_t) ** 2).sum()
+    if total == 0:
+        return 0.
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (mu_t * omega - mu) ** 2 / (omega * (1. - omega))
+    between = np.nan_to_num(between, nan=0., posinf=0.)
+
+    return between.max() / total
+
+
+def classify_page(image, gray_max_chroma_spread=GRAY_MAX_CHROMA_SPREAD,
+                  bitonal_min_bimodality=BITONAL_MIN_BIMODALITY):
+    """
+    Classify a page as bitonal, gray or colour, on a point sampled version of
+    the page.
+
+    Args:
+
+    * image (PIL.Image): page image ('L' or 'RGB')
+    * gray_max_chroma_spread (int): maximum chroma spread of a gray page
+    * bitonal_min_bimodality (float): minimum histogram bimodality of a
+      bitonal page (see histogram_bimodality)
+
+    Returns PAGE_CLASS_BITONAL, PAGE_CLASS_GRAY or PAGE_CLASS_COLOUR
+    """
+    w, h = image.size
+    factor = max(1, -(-max(w, h) // CLASSIFY_SAMPLE_SIZE))
+    sample = image.resize((max(1, w // factor), max(1, h // factor)),
+                          resample=Image.NEAREST)
+    arr = np.asarray(sample).astype(np.int32)
+
+    if arr.ndim == 3:
+        r, g, b = arr[:, :, 0], arr[:, :, 1], arr[:, :, 2]
+
+        chroma_spread = max(_percentile_spread(r - g),
+                            _percentile_spread(b - (r + g) // 2))
+        if chroma_spread > gray_max_chroma_spread:
+            return PAGE_CLASS_COLOUR
+
+        # ITU-R 601-2 luma, like Pillow
+        gray = (r * 299 + g * 587 + b * 114) // 1000
+    else:
+        gray = arr
+
+    if histogram_bimodality(gray) >= bitonal_min_bimodality:
+        return PAGE_CLASS_BITONAL
+
+    return PAGE_CLASS_GRAY
@@ -25,13 +25,14 @@
 # For fast_insert_image, see this for more background:
 # https://github.com/pymupdf/PyMuPDF/issues/1408
 
+import re
 import pkg_resources
-from math import ceil
 from datetime import datetime
 from xml.sax.saxutils import escape as xmlescape
 
 from internetarchivepdf.const import COMPRESSOR_JPEG, COMPRESSOR_JPEG2000, \
-        COMPRESSOR_JBIG2, PRODUCER, RECODE_RUNTIME_WARNING_INVALID_PAGE_NUMBERS
+        COMPRESSOR_JBIG2, COMPRESSOR_CCITT, COMPRESSOR_FLATE, PRODUCER, \
+        RECODE_RUNTIME_WARNING_INVALID_PAGE_NUMBERS
 from internetarchivepdf.pagenumbers import parse_series, series_to_pdf
 from internetarchivepdf.scandata import scandata_xml_get_page_numbers
 
@@ -67,6 +68,28 @@ JBIG2_TEMPL = """<<
 >>"""
 
 
+CCITT_TEMPL = """<<
+  /Type /XObject
+  /Subtype /Image
+  /BitsPerComponent 1
+  /Width &width
+  /Height &height
+  /ColorSpace /DeviceGray
+  /Length &len
+>>"""
+
+
+FLATE_TEMPL = """<<
+  /Type /XObject
+  /Subtype /Image
+  /BitsPerComponent &bits
+  /Width &width
+  /Height &height
+  /ColorSpace /&colourspace
+  /Length &len
+>>"""
+
+
 def jpx_string(stream=None, width=0, height=0, gray=True):
     if any((stream == None, width == 0, height == 0)):
         raise ValueError("invalid args")
@@ -102,11 +125,112 @@ def jbig2_string(stream=None, width=0, height=0):
     return jbig2
 
 
+def ccitt_string(stream=None, width=0, height=0):
+    if any((stream == None, width == 0, height == 0)):
+        raise ValueError("invalid args")
+    ccitt = (
+        CCITT_TEMPL.replace("&width", str(width))
+        .replace("&height", str(height))
+        .replace("&len", str(len(stream)))
+    )
+    return ccitt
+
+
+IMAGE_FILTERS = {
+    COMPRESSOR_JPEG2000: '/JPXDecode',
+    COMPRESSOR_JPEG: '/DCTDecode',
+    COMPRESSOR_JBIG2: '/JBIG2Decode',
+    COMPRESSOR_CCITT: '/CCITTFaxDecode',
+    COMPRESSOR_FLATE: '/FlateDecode',
+}
+
+
+def ccitt_decode_parms(width, height):
+    """
+    DecodeParms of a CCITT G4 stream (as created by mrc.encode_ccitt_g4)
+    """
+    return "<< /K -1 /Columns %d /Rows %d >>" % (width, height)
+
+
+def flate_string(stream=None, width=0, height=0, gray=True, bits=8):
+    if any((stream == None, width == 0, height == 0)):
+        raise ValueError("invalid args")
+    flate = (
+        FLATE_TEMPL.replace("&width", str(width))
+        .replace("&height", str(height))
+        .replace("&bits", str(bits))
+        .replace("&colourspace", 'DeviceGray' if gray else 'DeviceRGB')
+        .replace("&len", str(len(stream)))
+    )
+    return flate
+
+
+def insert_image_xobject(doc, stream, fmt, width, height, gray=True, bits=8,
+                         decode=None):
+    """
+    Add an image XObject with an already encoded stream to a document, the
+    stream is not decoded or recompressed.
+
+    Args:
+
+    * doc: output fitz.Document
+    * stream: encoded image stream
+    * fmt: COMPRESSOR_JPEG2000, COMPRESSOR_JPEG, COMPRESSOR_JBIG2 (embedded
+      JBIG2, without file header), COMPRESSOR_CCITT (raw G4 stream, see
+      mrc.encode_ccitt_g4) or COMPRESSOR_FLATE (zlib compressed raw pixels)
+    * width: image width
+    * height: image height
+    * gray: if the image is grayscale (otherwise RGB is assumed), ignored for
+      JBIG2 and CCITT
+    * bits: bits per component, only used for Flate (JBIG2 and CCITT are
+      always 1 bit, JPEG2000 and JPEG always 8 bit)
+    * decode: optional Decode array (e.g. '[1 0]' to invert a 1 bit image)
+
+    Returns the xref of the image XObject
+    """
+    if fmt == COMPRESSOR_JPEG2000:
+        obj = jpx_string(stream=stream, width=width, height=height, gray=gray)
+    elif fmt == COMPRESSOR_JPEG:
+        obj = jpg_string(stream=stream, width=width, height=height, gray=gray)
+    elif fmt == COMPRESSOR_JBIG2:
+        obj = jbig2_string(stream=stream, width=width, height=height)
+    elif fmt == COMPRESSOR_CCITT:
+        obj = ccitt_string(stream=stream, width=width, height=height)
+    elif fmt == COMPRESSOR_FLATE:
+        obj = flate_string(stream=stream, width=width, height=height,
+                           gray=gray, bits=bits)
+    else:
+        raise ValueError('Unsupported image format: %s' % fmt)
+
+    xref = doc.get_new_xref()
+    doc.update_object(xref, obj)  # give it the object definition
+
+    # give it the image stream - unchanged compression
+    doc.update_stream(xref, stream=stream, new=True, compress=False)
+
+    # adjust image definition with correct compression info
+    # this must happen AFTER stream insertion!
+    doc.xref_set_key(xref, "Filter", IMAGE_FILTERS[fmt])
+    if fmt == COMPRESSOR_CCITT:
+        doc.xref_set_key(xref, "DecodeParms",
+                         ccitt_decode_parms(width, height))
+
+    if decode is not None:
+        doc.xref_set_key(xref, "Decode", decode)
+
+    return xref
+
+
 def fast_insert_image(page, rect=None, width=0, height=0, stream=None,
                       mask=None, stream_fmt=COMPRESSOR_JPEG2000,
-                      mask_fmt=COMPRESSOR_JBIG2, gray=True):
+                      mask_fmt=COMPRESSOR_JBIG2, gray=True, mask_width=None,
+                      mask_height=None, bits=8, decode=None, mask_decode=None,
+                      overlay=True):
     """Fast image insertion
 
+    The image (and mask) streams are inserted as they are, PyMuPDF does not
+    have to parse or decode them, so the dimensions have to be provided.
+
     Args:
 
     * page: output fitz.Page
@@ -115,65 +239,255 @@ def fast_insert_image(page, rect=None, width=0, height=0, stream=None,
     * height: image height
     * stream: image stream
     * mask: mask image stream (if any)
-    * stream_fmt: COMPRESSOR_JPEG2000 or COMPRESSOR_JPEG
-    * mask_fmt: COMPRESSOR_JBIG2 or None
+    * stream_fmt: image format, see insert_image_xobject
+    * mask_fmt: COMPRESSOR_JBIG2, COMPRESSOR_CCITT or COMPRESSOR_FLATE (1 bit)
     * gray: if the image is grayscale (otherwise RGB is assumed)
+    * mask_width: mask width, if it differs from the image width
+    * mask_height: mask height, if it differs from the image height
+    * bits: bits per component of a Flate image
+    * decode: Decode array of the image (if any)
+    * mask_decode: Decode array of the mask (if any)
+    * overlay: overlay argument of page.insert_image
+
+    Returns the xref of the image
+    """
+    # We encode jbig2 ourselves using jbig2enc, and ccitt with Pillow
+    if mask_fmt not in (COMPRESSOR_JBIG2, COMPRESSOR_CCITT, COMPRESSOR_FLATE):
+        raise ValueError('mask_fmt can only be jbig2, ccitt or flate')
+
+    doc = page.parent
+    nxref = insert_image_xobject(doc, stream, stream_fmt, width, height,
+                                 gray=gray, bits=bits, decode=decode)
+
+    # if input image had a mask, we need further adjustments ...
+    if mask:
+        if mask_width is None:
+            mask_width = width
+        if mask_height is None:
+            mask_height = height
+
+        nmask = insert_image_xobject(doc, mask, mask_fmt, mask_width,
+                                     mask_height, gray=True, bits=1,
+                                     decode=mask_decode)
+
+        # we also need to tell the main image that it has a mask:
+        doc.xref_set_key(nxref, "SMask", "%i 0 R" % nmask)
+
+    # now we are ready to insert the image
+    return page.insert_image(rect, xref=nxref, overlay=overlay)
+
+
+# Indirect reference, at the start of a token
+_XREF_RE = re.compile(r'(\d+)\s+(\d+)\s+R(?=[\s()<>\[\]{}/%]|$)')
+
+_PDF_DELIMITERS = ' \t\r\n\f\0()<>[]{}/%'
+
+
+def _rewrite_refs(obj, ref):
+    """
+    Replace the indirect references in the text of a PDF object, leaving
+    string literals, hex strings, names and comments alone.
+
+    Args:
+
+    * obj (str): object, as returned by fitz.Document.xref_object
+    * ref (function): maps an xref to the xref to reference instead
+
+    Returns the new object text (str)
+    """
+    out = []
+    i, n = 0, len(obj)
+    while i < n:
+        c = obj[i]
+        start = i
+        if c == '(':
+            # String literal, with balanced parentheses and escapes
+            depth = 0
+            while i < n:
+                if obj[i] == '\\':
+                    i += 2
+                    continue
+                if obj[i] == '(':
+                    depth += 1
+                elif obj[i] == ')':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                i += 1
+            i += 1
+        elif c == '<' and obj.startswith('<<', i):
+            i += 2
+        elif c == '<':
+            # Hex string
+            i = obj.find('>', i)
+            i = n if i < 0 else i + 1
+        elif c == '%':
+            i = obj.find('\n', i)
+            i = n if i < 0 else i
+        elif c == '/':
+            i += 1
+            while i < n and obj[i] not in _PDF_DELIMITERS:
+                i += 1
+        elif c.isdigit() and (i == 0 or obj[i - 1] in _PDF_DELIMITERS):
+            m = _XREF_RE.match(obj, i)
+            if m is not None:
+                out.append('%d 0 R' % ref(int(m.group(1))))
+                i = m.end()
+                continue
+            while i < n and obj[i] not in _PDF_DELIMITERS:
+                i += 1
+        else:
+            i += 1
+        out.append(obj[start:i])
+
+    return ''.join(out)
+
+
+def graft_xref(from_doc, to_doc, xref, xref_map):
+    """
+    Copy an object, and all objects it references, from one document to
+    another. Streams are copied as they are (with their filters and decode
+    parameters), without decoding them, so this takes the same time for any
+    image size.
+
+    The references are followed with a work list rather than recursion, so
+    long reference chains are fine.
+
+    Args:
+
+    * from_doc: source fitz.Document
+    * to_doc: target fitz.Document
+    * xref: xref of the object in from_doc
+    * xref_map (dict): xrefs in from_doc to xrefs in to_doc of already copied
+      objects, shared between calls so that shared objects (like colour
+      profiles or image masks) are only copied once
+
+    Returns the xref of the copy in to_doc
     """
-    # We encode jbig2 ourselves using jbig2enc, we can't do that for ccitt
-    # currently, so we rely on mupdf to do it for us, so let's not support that
-    # in this code path now
-    if mask_fmt not in (COMPRESSOR_JBIG2,):
-        raise ValueError('mask_fmt can only be jbig2')
+    if xref in xref_map:
+        return xref_map[xref]
+
+    xref_count = from_doc.xref_length()
+    pending = []
+
+    def ref(from_xref):
+        # Allocate the copy now (this also takes care of reference cycles),
+        # fill it in later
+        if from_xref not in xref_map:
+            xref_map[from_xref] = to_doc.get_new_xref()
+            pending.append(from_xref)
+        return xref_map[from_xref]
+
+    new_xref = ref(xref)
+
+    while pending:
+        from_xref = pending.pop()
+        to_xref = xref_map[from_xref]
+
+        if not 0 < from_xref < xref_count:
+            # Dangling reference, which PDF readers treat as null
+            to_doc.update_object(to_xref, 'null')
+            continue
+
+        to_doc.update_object(to_xref,
+                             _rewrite_refs(from_doc.xref_object(from_xref), ref))
+
+        if from_doc.xref_is_stream(from_xref):
+            to_doc.update_stream(to_xref, from_doc.xref_stream_raw(from_xref),
+                                 new=True, compress=False)
+
+            # The stream insertion drops the filter, so restore it (and its
+            # parameters) AFTER stream insertion
+            for key in ('Filter', 'DecodeParms'):
+                key_type, value = from_doc.xref_get_key(from_xref, key)
+                if key_type != 'null':
+                    to_doc.xref_set_key(to_xref, key,
+                                        _rewrite_refs(value, ref))
+
+    return new_xref
 
-    # We can't handle other formats (yet)
-    if stream_fmt not in (COMPRESSOR_JPEG, COMPRESSOR_JPEG2000):
-        raise ValueError('stream_fmt can only be jpeg or jpeg2000')
 
+# Font resource name of the TessPDFRenderer text layer
+TEXT_LAYER_FONT = 'f-0-0'
+
+
+def find_text_layer_xref(page):
+    """
+    Find the content stream of the TessPDFRenderer text layer of a page.
+
+    The text layer starts with a (no-op) 'q <w> 0 0 <h> 0 0 cm Q' and never
+    draws XObjects, while the content streams that PyMuPDF adds for images
+    start with a newline and always draw one.
+
+    Returns the xref of the content stream, or None if there is none
+    """
     doc = page.parent
-    nxref = doc.get_new_xref()  # make image xref in output page
-    xref_stream = stream
-    mask_stream = mask
+    for xref in page.get_contents():
+        data = doc.xref_stream(xref)
+        if data.startswith(b'q ') and b' Do' not in data:
+            return xref
 
-    # Make object string for target page
-    if stream_fmt == COMPRESSOR_JPEG2000:
-        jpx_obj = jpx_string(stream=xref_stream, width=width, height=height,
-                             gray=gray)
-    elif stream_fmt == COMPRESSOR_JPEG:
-        jpx_obj = jpg_string(stream=xref_stream, width=width, height=height,
-                             gray=gray)
+    return None
 
-    doc.update_object(nxref, jpx_obj)  # give it the object definition
 
-    # give it the image stream - unchanged compression
-    doc.update_stream(nxref, stream=xref_stream, new=True, compress=False)
+def replace_text_layer(page, text_page, xref_map):
+    """
+    Replace the text layer of a page with the text layer of a page of a
+    (new) TessPDFRenderer document. The images and all other objects of the
+    page are left alone.
 
-    # adjust image definition with correct compression info
-    # this must happen AFTER stream insertion!
-    if stream_fmt == COMPRESSOR_JPEG2000:
-        doc.xref_set_key(nxref, "Filter", "/JPXDecode")
-    elif stream_fmt == COMPRESSOR_JPEG:
-        doc.xref_set_key(nxref, "Filter", "/DCTDecode")
+    Args:
 
-    # if input image had a mask, we need further adjustments ...
-    if mask_stream:
-        nmask = doc.get_new_xref()  # need another xref in target doc
+    * page: fitz.Page to replace the text layer of
+    * text_page: fitz.Page with the new text layer
+    * xref_map (dict): see graft_xref, for the text layer font
 
-        # make smask object definition
-        mask_obj = jbig2_string(stream=mask_stream, width=width, height=height)
-        # and put it in mask object xref
-        doc.update_object(nmask, mask_obj)
+    Raises ValueError if page does not have a text layer.
+    """
+    doc = page.parent
+    text_doc = text_page.parent
 
-        # now insert raw mask image stream
-        doc.update_stream(nmask, stream=mask_stream, new=True, compress=False)
+    xref = find_text_layer_xref(page)
+    if xref is None:
+        raise ValueError('Page %d has no text layer' % page.number)
 
-        # and also adjust the compression filer ... AFTER stream insertion
-        doc.xref_set_key(nmask, "Filter", "/JBIG2Decode")
+    contents = b''.join([text_doc.xref_stream(text_xref)
+                         for text_xref in text_page.get_contents()])
+    doc.update_stream(xref, contents)
 
-        # we also need to tell the main image that it has a mask:
-        doc.xref_set_key(nxref, "SMask", "%i 0 R" % nmask)
+    # The existing font is the same, so only add it if it is missing
+    font_key = 'Resources/Font/' + TEXT_LAYER_FONT
+    key_type, _ = doc.xref_get_key(page.xref, font_key)
+    if key_type == 'null':
+        key_type, font_ref = text_doc.xref_get_key(text_page.xref, font_key)
+        if key_type != 'xref':
+            raise ValueError('Text layer has no font')
 
-    # now we are ready to insert the image
-    return page.insert_image(rect, xref=nxref)
+        font_xref = graft_xref(text_doc, doc, int(font_ref.split()[0]),
+                               xref_map)
+        doc.xref_set_key(page.xref, font_key, '%d 0 R' % font_xref)
+
+
+def remove_page_images(page):
+    """
+    Remove the images of a page, leaving the text layer alone.
+
+    The content streams that draw the images are emptied and the images are
+    removed from the page resources, the image objects themselves are not
+    removed (they can be shared with other pages).
+    """
+    doc = page.parent
+    text_xref = find_text_layer_xref(page)
+
+    for xref in page.get_contents():
+        if xref == text_xref:
+            continue
+
+        if b' Do' in doc.xref_stream(xref):
+            doc.update_stream(xref, b'')
+
+    for img in page.get_images(full=True):
+        doc.xref_set_key(page.xref, 'Resources/XObject/' + img[7], 'null')
 
 
 # XXX: tmp.icc - pick proper one and ship it with the tool, or embed it
@@ -224,141 +538,116 @@ def write_page_labels(to_pdf, scandata, errors=None, ignore_invalid=False):
 
 
 
-def write_basic_ua(to_pdf, language=None):
-    # Create StructTreeRoot and descendants, allocate new xrefs as needed
-    structtreeroot_xref = to_pdf.get_new_xref()
-    parenttree_xref = to_pdf.get_new_xref()
-    page_info_xrefs = []
-    page_info_a_xrefs = []
-    parenttree_kids_xrefs = []
-    parenttree_kids_indirect_xrefs = []
-
-    kids_cnt = ceil(to_pdf.page_count / 32)
-    for _ in range(kids_cnt):
-        kid_xref = to_pdf.get_new_xref()
-        parenttree_kids_xrefs.append(kid_xref)
-
-    # Parent tree contains a /Kids entry with a list of xrefs, that each contain
-    # a list of xrefs (limited to 32 per), and each entry in that list of list
-    # of xrefs contains a single reference that points to the page info xref.
-    for idx, page in enumerate(to_pdf):
-        page_info_xref = to_pdf.get_new_xref()
-        page_info_xrefs.append(page_info_xref)
-
-        page_info_a_xref = to_pdf.get_new_xref()
-        page_info_a_xrefs.append(page_info_a_xref)
-
-        parenttree_kids_indirect_xref = to_pdf.get_new_xref()
-        parenttree_kids_indirect_xrefs.append(parenttree_kids_indirect_xref)
-
-
-    for idx in range(kids_cnt):
-        start = idx*32
-        stop = (idx+1)*31
-        if stop > to_pdf.page_count:
-            stop = to_pdf.page_count- 1
-
-        s = """<<
-  /Limits [ %d %d ]
-""" % (start, stop - 1)
-        s += '  /Nums [ '
+# Amount of StructParents keys per ParentTree kid
+PARENTTREE_KID_SIZE = 32
 
-        for pidx in range(start, stop):
-            s += '%d %d 0 R ' % (pidx, parenttree_kids_indirect_xrefs[pidx])
+# Amount of array entries per line in the written objects
+_REFS_PER_LINE = 8
 
-            if idx % 7 == 0:
-                s = s[:-1] + '\n' + '      '
 
-        s += ']\n>>'
+def parent_tree_ranges(page_count, kid_size=PARENTTREE_KID_SIZE):
+    """
+    Split the StructParents keys (one per page) over the ParentTree kids.
 
-        to_pdf.update_object(parenttree_kids_xrefs[idx], s)
+    Args:
 
+    * page_count (int): amount of pages
+    * kid_size (int): maximum amount of keys per kid
 
-    for idx, page in enumerate(to_pdf):
-        intrect = tuple([int(x) for x in page.rect])
+    Returns a list of (start, stop) tuples, one per kid, stop is exclusive, so
+    the /Limits of the kid are [ start stop-1 ].
+    """
+    return [(start, min(start + kid_size, page_count))
+            for start in range(0, page_count, kid_size)]
 
-        s = """<<
-  /BBox [ %d %d %d %d ]
-  /InlineAlign /Center
-  /O /Layout
-  /Placement /Block
->>
-""" % intrect
-        to_pdf.update_object(page_info_a_xrefs[idx], s)
 
-        s = """ <<
-  /A %d 0 R
+def _join_lines(entries, indent='      '):
+    lines = []
+    for idx in range(0, len(entries), _REFS_PER_LINE):
+        lines.append(' '.join(entries[idx:idx + _REFS_PER_LINE]))
+
+    return ('\n' + indent).join(lines)
+
+
+def write_basic_ua(to_pdf, language=None):
+    page_count = to_pdf.page_count
+    kid_ranges = parent_tree_ranges(page_count)
+    kids_cnt = len(kid_ranges)
+
+    # Allocate all new xrefs in one go: StructTreeRoot, ParentTree, the
+    # ParentTree kids and one structure element per page
+    new_xrefs = [to_pdf.get_new_xref() for _ in range(2 + kids_cnt +
+                                                      page_count)]
+    structtreeroot_xref = new_xrefs[0]
+    parenttree_xref = new_xrefs[1]
+    parenttree_kids_xrefs = new_xrefs[2:2 + kids_cnt]
+    page_info_xrefs = new_xrefs[2 + kids_cnt:]
+
+    page_xrefs = []
+    page_rects = []
+    for page in to_pdf:
+        page_xrefs.append(page.xref)
+        page_rects.append(tuple(page.rect))
+
+    # (xref, object) of all the objects to write
+    objects = []
+
+    # Every page gets a /Figure structure element, with its attributes
+    # inline
+    for idx in range(page_count):
+        intrect = tuple([int(x) for x in page_rects[idx]])
+        objects.append((page_info_xrefs[idx], """<<
+  /A <<
+    /BBox [ %d %d %d %d ]
+    /InlineAlign /Center
+    /O /Layout
+    /Placement /Block
+  >>
   /K 0
   /P %d 0 R
   /Pg %d 0 R
   /S /Figure
->>""" % (page_info_a_xrefs[idx], structtreeroot_xref, page.xref)
-
-        to_pdf.update_object(page_info_xrefs[idx], s)
-
-
-    for idx, page in enumerate(to_pdf):
-        s = '[ %d 0 R ]' % page_info_a_xrefs[idx]
-        to_pdf.update_object(parenttree_kids_indirect_xrefs[idx], s)
-
-
-    K = '  /Kids [ '
-    for idx in range(kids_cnt):
-        K += '%d 0 R ' % parenttree_kids_xrefs[idx]
-
-        if idx % 7 == 0:
-            K = K[:-1] + '\n' + '      '
-
-    K += ']'
-    s = """<<
-%s
->>
-""" % K
-
-    to_pdf.update_object(parenttree_xref, s)
-
-    K = '  /K [ '
-    for idx, xref in enumerate(page_info_xrefs):
-        K += '%d 0 R ' % xref
-
-        if idx % 7 == 0:
-            K = K[:-1] + '\n' + '      '
+>>""" % (intrect + (structtreeroot_xref, page_xrefs[idx]))))
+
+    # The parent tree is a number tree of the StructParents key of every page
+    # to the (inline) array of its structure elements, split over kids of at
+    # most PARENTTREE_KID_SIZE keys each.
+    for idx, (start, stop) in enumerate(kid_ranges):
+        nums = ['%d [ %d 0 R ]' % (pidx, page_info_xrefs[pidx])
+                for pidx in range(start, stop)]
+        objects.append((parenttree_kids_xrefs[idx], """<<
+  /Limits [ %d %d ]
+  /Nums [ %s ]
+>>""" % (start, stop - 1, _join_lines(nums))))
 
-    K += ']'
+    kids = ['%d 0 R' % xref for xref in parenttree_kids_xrefs]
+    objects.append((parenttree_xref, """<<
+  /Kids [ %s ]
+>>""" % _join_lines(kids)))
 
-    to_pdf.update_object(structtreeroot_xref, """
-<<
-""" + K + """
+    elems = ['%d 0 R' % xref for xref in page_info_xrefs]
+    objects.append((structtreeroot_xref, """<<
+  /K [ %s ]
   /Type /StructTreeRoot
   /ParentTree %d 0 R
->>
-""" % parenttree_xref)
+  /ParentTreeNextKey %d
+>>""" % (_join_lines(elems), parenttree_xref, page_count)))
 
-    #  TODO? /ClassMap 1006 0 R
-    #  TODO? /ParentTreeNextKey 198
+    for xref, obj in objects:
+        to_pdf.update_object(xref, obj)
 
+    #  TODO? /ClassMap 1006 0 R
 
     # Update pages, add back xrefs
-    for idx, page in enumerate(to_pdf):
-        page_data = to_pdf.xref_object(page.xref)
-        page_data = page_data[:-2]
+    for idx in range(page_count):
+        page_data = to_pdf.xref_object(page_xrefs[idx])[:-2]
 
-        page_data += """
+        to_pdf.update_object(page_xrefs[idx], ''.join((page_data, """
   /StructParents %d
-""" % idx
-
-        page_data += """
   /CropBox [ 0 0 %.1f %.1f ]
-""" % (page.rect[2], page.rect[3])
-
-        page_data += """
   /Rotate 0
-"""
-        page_data += """
   /Tabs /S
-"""
-        page_data += '>>'
-        to_pdf.update_object(page.xref, page_data)
+>>""" % (idx, page_rects[idx][2], page_rects[idx][3]))))
 
     catalogxref = to_pdf.pdf_catalog()
     s = to_pdf.xref_object(to_pdf.pdf_catalog())
@@ -0,0 +1,196 @@
+# archive-pdf-tools
+# Copyright (C) 2020-2021, Internet Archive
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Merlijn Boris Wolf Wajer <merlijn@archive.org>
+#
+# Target size rate control for the MRC background and foreground layers.
+
+from internetarchivepdf.const import (JPEG2000_IMPL_KAKADU,
+        JPEG2000_IMPL_OPENJPEG, JPEG2000_IMPL_GROK, JPEG2000_IMPL_PILLOW,
+        COMPRESSOR_JPEG)
+
+
+# Weight of the last page in the size correction factor of a layer
+RATE_CORRECTION_WEIGHT = 0.3
+
+# Bounds of the size correction factor
+RATE_CORRECTION_MIN = 0.25
+RATE_CORRECTION_MAX = 4.0
+
+# Flags (followed by a value) that control the rate of the external JPEG2000
+# encoders, and keys of the Pillow flags that do
+_RATE_FLAGS = {
+    JPEG2000_IMPL_KAKADU: ('-slope', '-rate'),
+    JPEG2000_IMPL_OPENJPEG: ('-r', '-q'),
+    JPEG2000_IMPL_GROK: ('-r', '-q'),
+}
+_PILLOW_RATE_KEYS = ('quality_mode', 'quality_layers')
+
+# Pages that end up smaller than this fraction of the requested size were not
+# limited by the rate (the encoder ran out of detail to spend bytes on), and
+# tell us nothing about the encoder overhead
+RATE_MIN_FILL = 0.75
+
+
+class RateControl(object):
+    """
+    Rate control of the MRC background and foreground layers of a book.
+
+    The budget of a layer is given in bits per page pixel, so that it does not
+    depend on the downsampling of the layer. The JPEG2000 encoders can all
+    target a rate themselves (post compression rate allocation), so the
+    budget is turned into the rate flags of the encoder, without trial
+    encodes. The resulting sizes are fed back, and a per layer correction
+    factor (for headers and encoder differences) is learned over the pages,
+    so that later pages of the book land on the budget in one encode.
+    """
+
+    def __init__(self, bg_bpp=None, fg_bpp=None):
+        """
+        Args:
+
+        * bg_bpp (float): background budget, in bits per page pixel
+        * fg_bpp (float): foreground budget, in bits per page pixel
+        """
+        self.bpp = {'bg': bg_bpp, 'fg': fg_bpp}
+        self.correction = {'bg': 1., 'fg': 1.}
+        self.samples = {'bg': 0, 'fg': 0}
+
+    def enabled(self, imgtype):
+        """
+        Returns whether the layer ('bg' or 'fg') has a budget
+        """
+        return self.bpp.get(imgtype) is not None
+
+    def target_size(self, imgtype, page_pixels):
+        """
+        Returns the budget of a layer of a page, in bytes
+        """
+        return self.bpp[imgtype] * page_pixels / 8.
+
+    def request_size(self, imgtype, page_pixels):
+        """
+        Returns the size (in bytes) to ask of the encoder for a layer of a
+        page, the budget corrected for what the encoder did on earlier pages
+        """
+        return max(1, int(self.target_size(imgtype, page_pixels) *
+                          self.correction[imgtype]))
+
+    def update(self, imgtype, requested, actual):
+        """
+        Update the correction factor of a layer with the requested (see
+        request_size) and the resulting size of a page.
+        """
+        if actual <= 0 or actual < requested * RATE_MIN_FILL:
+            return
+
+        correction = self.correction[imgtype] * requested / actual
+        if self.samples[imgtype] > 0:
+            correction = (RATE_CORRECTION_WEIGHT * correction +
+                    (1. - RATE_CORRECTION_WEIGHT) * self.correction[imgtype])
+
+        self.correction[imgtype] = min(RATE_CORRECTION_MAX,
+                                       max(RATE_CORRECTION_MIN, correction))
+        self.samples[imgtype] += 1
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the budget, correction factor and amount of
+        learned pages per layer.
+        """
+        return dict((imgtype, {'bpp': self.bpp[imgtype],
+                               'correction': self.correction[imgtype],
+                               'samples': self.samples[imgtype]})
+                    for imgtype in ('bg', 'fg'))
+
+
+def _strip_rate_flags(flags, jpeg2000_implementation, mrc_image_format):
+    # Remove the flags that control the rate, keep all others
+    if not flags:
+        return []
+
+    if jpeg2000_implementation == JPEG2000_IMPL_PILLOW and \
+            mrc_image_format != COMPRESSOR_JPEG:
+        entries = [en for en in ';'.join(flags).split(';')
+                   if en and en.split(':', 1)[0] not in _PILLOW_RATE_KEYS]
+        return [';'.join(entries)] if entries else []
+
+    res = []
+    skip_value = False
+    for flag in flags:
+        if skip_value:
+            skip_value = False
+        elif flag == '':
+            continue
+        elif mrc_image_format == COMPRESSOR_JPEG:
+            # jpegoptim: -S30, -S 30 or --size=30
+            if flag == '-S':
+                skip_value = True
+            elif not (flag.startswith('-S') or flag.startswith('--size=')):
+                res.append(flag)
+        elif flag in _RATE_FLAGS.get(jpeg2000_implementation, ()):
+            skip_value = True
+        else:
+            res.append(flag)
+
+    return res
+
+
+def rate_flags(size, width, height, channels, jpeg2000_implementation=None,
+               mrc_image_format=None, flags=None):
+    """
+    Create the compression flags that make an encoder target a size.
+
+    The flags that control the rate are removed from flags (-slope and -rate
+    for Kakadu, -r and -q for OpenJPEG and Grok, quality_mode and
+    quality_layers for Pillow, -S for jpegoptim), all other flags are kept,
+    and the flag that targets the size is added.
+
+    Args:
+
+    * size (int): size to target, in bytes
+    * width (int): image width
+    * height (int): image height
+    * channels (int): amount of channels (1 or 3)
+    * jpeg2000_implementation (str): JPEG2000 implementation
+    * mrc_image_format (str): image format
+    * flags (list of str): compression flags to start from
+
+    Returns the compression flags (list of str), like the
+    --bg-compression-flags of the encoder.
+    """
+    flags = _strip_rate_flags(flags, jpeg2000_implementation,
+                              mrc_image_format)
+
+    if mrc_image_format == COMPRESSOR_JPEG:
+        # jpegoptim -S takes kilobytes
+        return flags + ['-S%d' % max(1, int(round(size / 1024.)))]
+
+    # Kakadu wants bits per (image) pixel, the others a compression ratio
+    bpp = size * 8. / (width * height)
+    ratio = max(1., (width * height * channels) / float(size))
+
+    if jpeg2000_implementation == JPEG2000_IMPL_KAKADU:
+        return flags + ['-rate', '%.6f' % bpp]
+    elif jpeg2000_implementation in (JPEG2000_IMPL_OPENJPEG,
+                                     JPEG2000_IMPL_GROK):
+        return flags + ['-r', '%.3f' % ratio]
+    elif jpeg2000_implementation == JPEG2000_IMPL_PILLOW:
+        return [';'.join(flags + ['quality_mode:"rates"',
+                                  'quality_layers:[%.3f]' % ratio])]
+
+    raise ValueError('Unsupported JPEG2000 implementation: %s' %
+                     jpeg2000_implementation)
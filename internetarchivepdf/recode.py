@@ -30,30 +30,44 @@ import json
 from glob import glob
 import re
 import io
+import hashlib
+import zlib
 
 
 from PIL import Image
-import numpy as np
 import fitz
 
 from hocr.parse import (hocr_page_iterator, hocr_page_to_word_data,
         hocr_page_get_dimensions, hocr_page_get_scan_res)
 from internetarchivepdf.mrc import create_mrc_hocr_components, \
-        encode_mrc_images, encode_mrc_mask
-from internetarchivepdf.grayconvert import special_gray_convert
+        encode_mrc_images, encode_mrc_mask, ccitt_available
+from internetarchivepdf.grayconvert import special_gray_convert, \
+        gray_stats_step
+from internetarchivepdf.bitmask import PackedMask
+from internetarchivepdf.pagebuffer import PageBuffer, get_copy_summary
+from internetarchivepdf.mrccache import MRCCache, DEFAULT_CACHE_SIZE
+from internetarchivepdf.ratecontrol import RateControl
+from internetarchivepdf.threadbudget import ThreadBudget
+from internetarchivepdf.pageclass import detect_blank_page, classify_page, \
+        GRAY_MAX_CHROMA_SPREAD, BITONAL_MIN_BIMODALITY
 from internetarchivepdf.pdfhacks import fast_insert_image, write_pdfa, \
-        write_page_labels, write_basic_ua, write_metadata
+        write_page_labels, write_basic_ua, write_metadata, graft_xref, \
+        replace_text_layer, remove_page_images
 from internetarchivepdf.pdfrenderer import TessPDFRenderer
 from internetarchivepdf.scandata import scandata_xml_get_skip_pages, \
         scandata_xml_get_page_numbers, scandata_xml_get_dpi_per_page, \
         scandata_xml_get_document_dpi
-from internetarchivepdf.jpeg2000 import decode_jpeg2000, get_jpeg2000_info
+from internetarchivepdf.jpeg2000 import decode_jpeg2000, get_jpeg2000_info, \
+        resolve_jpeg2000_impls
 from internetarchivepdf.const import (IMAGE_MODE_PASSTHROUGH, IMAGE_MODE_PIXMAP,
         IMAGE_MODE_MRC, RECODE_RUNTIME_WARNING_INVALID_PAGE_SIZE,
         RECODE_RUNTIME_WARNING_INVALID_PAGE_NUMBERS,
         RECODE_RUNTIME_WARNING_INVALID_JP2_HEADERS, JPEG2000_IMPL_KAKADU,
         JPEG2000_IMPL_OPENJPEG, JPEG2000_IMPL_GROK, JPEG2000_IMPL_PILLOW,
-        COMPRESSOR_JPEG2000, COMPRESSOR_JPEG)
+        COMPRESSOR_JPEG2000, COMPRESSOR_JPEG, COMPRESSOR_JBIG2,
+        COMPRESSOR_CCITT, COMPRESSOR_FLATE, FILL_BOX, PAGE_CLASS_BLANK,
+        VERSION,
+        PAGE_CLASS_BITONAL, PAGE_CLASS_GRAY)
 
 PDFA_MIN_UNITS = 3
 PDFA_MAX_UNITS = 14400
@@ -265,6 +279,113 @@ def get_timing_summary(timing_data):
 
 
 
+def page_pixel_key(pixels, *params):
+    """
+    Hash the decoded pixels of a page, together with everything else that
+    influences how the page is encoded.
+
+    Args:
+
+    * pixels: page pixels (bytes or numpy.ndarray)
+    * params: other parameters (need to have a stable repr)
+
+    Returns the key (bytes)
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr(params).encode('utf-8'))
+    h.update(pixels)
+    return h.digest()
+
+
+def insert_image_dedup(page, stream_xrefs, streams, insert, overlay=True):
+    """
+    Insert an encoded image on a page, unless the same encoded streams were
+    inserted before, in which case the existing image XObject is referenced
+    instead.
+
+    Args:
+
+    * page (fitz.Page): page to insert the image on
+    * stream_xrefs (dict): hashes of inserted streams to their xrefs, None
+      disables deduplication
+    * streams (tuple): encoded image stream and mask stream (or None)
+    * insert (callable): inserts the image on the page, returns the xref
+    * overlay (bool): overlay argument of the insertion
+
+    Returns a tuple of the xref and whether it was a duplicate
+    """
+    if stream_xrefs is None:
+        return insert(), False
+
+    h = hashlib.blake2b(digest_size=20)
+    for stream in streams:
+        if stream is None:
+            h.update(b'-')
+        else:
+            h.update(b'%d:' % len(stream))
+            h.update(stream)
+    key = h.digest()
+
+    if key in stream_xrefs:
+        xref = stream_xrefs[key]
+        page.insert_image(page.rect, xref=xref, overlay=overlay)
+        return xref, True
+
+    xref = insert()
+    stream_xrefs[key] = xref
+    return xref, False
+
+
+def create_blank_page_image(mode, colour):
+    """
+    Create a single pixel image of the given colour, to be scaled to the full
+    page, as the image of a blank page.
+
+    Args:
+
+    * mode (str): 'L' or 'RGB'
+    * colour (int or tuple): colour of the page
+
+    Returns the zlib compressed pixel data (for /FlateDecode)
+    """
+    img = Image.new(mode, (1, 1), colour)
+
+    return zlib.compress(img.tobytes())
+
+
+def encode_mask_stream(mask, mask_fmt, tmp_dir=None, timing_data=None,
+                       debug=False):
+    """
+    Encode a bitonal image (or mask) to a stream that can be embedded as is,
+    see fast_insert_image.
+
+    Args:
+
+    * mask (PackedMask): bitonal image
+    * mask_fmt (str): COMPRESSOR_JBIG2, COMPRESSOR_CCITT or COMPRESSOR_FLATE
+    * tmp_dir (str): path the temporary directory to write images to
+    * timing_data (optional): Add time information to timing_data structure
+
+    Returns the encoded stream (bytes)
+    """
+    mask_jb2, mask_f = encode_mrc_mask(mask, tmp_dir=tmp_dir,
+            jbig2=mask_fmt == COMPRESSOR_JBIG2, embedded_jbig2=True,
+            ccitt=mask_fmt == COMPRESSOR_CCITT,
+            flate=mask_fmt == COMPRESSOR_FLATE,
+            timing_data=timing_data, debug=debug)
+
+    if mask_jb2 is not None:
+        mask_contents = open(mask_jb2, 'rb').read()
+        remove(mask_jb2)
+    else:
+        mask_contents = open(mask_f, 'rb').read()
+
+    # We always get a second (PBM, G4 or zlib) file
+    remove(mask_f)
+
+    return mask_contents
+
+
 def insert_images_mrc(to_pdf, hocr_file, from_pdf=None, image_files=None,
         dpi=None, dpi_pages=None,
         bg_compression_flags=None, fg_compression_flags=None,
@@ -272,23 +393,49 @@ def insert_images_mrc(to_pdf, hocr_file, from_pdf=None, image_files=None,
         downsample=None,
         bg_downsample=None,
         fg_downsample=None,
-        denoise_mask=None, reporter=None,
+        denoise_mask=None, fill_mode=None, strip_height=None,
+        detect_blank_pages=False, auto_page_mode=False,
+        gray_max_chroma_spread=GRAY_MAX_CHROMA_SPREAD,
+        bitonal_min_bimodality=BITONAL_MIN_BIMODALITY, page_routing=None,
+        dedup_images=True, mrc_cache=None, reporter=None,
         hq_pages=None, hq_bg_compression_flags=None, hq_fg_compression_flags=None,
         verbose=False, debug=False, tmp_dir=None, report_every=None,
         stop_after=None, grayscale_pdf=False,
         force_1bit_output=None,
         jpeg2000_implementation=None, mrc_image_format=None, threads=None,
-        errors=None):
+        rate_control=None, pages=None, jpeg2000_decode_implementation=None,
+        thread_budget=None, errors=None):
     hocr_iter = hocr_page_iterator(hocr_file)
 
     skipped_pages = 0
 
     last_time = time()
     timing_data = []
+    copy_trace = []
     reporting_page_count = 0
 
+    # Page pixel hashes and encoded stream hashes of the inserted images, to
+    # reference identical images instead of encoding and embedding them again
+    page_images = {}
+    stream_xrefs = {} if dedup_images else None
+    dedup_pages = 0
+    dedup_streams = 0
+
+    # Threads for the codecs and the concurrent stages of a page
+    if thread_budget is None:
+        thread_budget = ThreadBudget(threads)
+
     downsampled = False
 
+    # Masks and bitonal pages are encoded to a format that can be embedded as
+    # is: JBIG2, or without it CCITT G4 if our Pillow can do that, or Flate
+    if jbig2:
+        mask_fmt = COMPRESSOR_JBIG2
+    elif ccitt_available():
+        mask_fmt = COMPRESSOR_CCITT
+    else:
+        mask_fmt = COMPRESSOR_FLATE
+
     #for idx, page in enumerate(to_pdf):
     for idx, hocr_page in enumerate(hocr_iter):
         if skip_pages is not None and idx in skip_pages:
@@ -300,6 +447,10 @@ def insert_images_mrc(to_pdf, hocr_file, from_pdf=None, image_files=None,
         if stop_after is not None and idx >= stop_after:
             break
 
+        # Only insert the images of the requested pages
+        if pages is not None and idx not in pages:
+            continue
+
         picked_dpi = None
 
         hocr_dpi = hocr_page_get_scan_res(hocr_page)
@@ -342,8 +493,14 @@ def insert_images_mrc(to_pdf, hocr_file, from_pdf=None, image_files=None,
 
             # Potentially special path
             if imgfile.endswith('.jp2') or imgfile.endswith('.jpx'):
-                image = decode_jpeg2000(imgfile, reduce_=downsample,
-                        impl=jpeg2000_implementation, threads=threads, debug=debug)
+                decode_impl = jpeg2000_decode_implementation or \
+                        jpeg2000_implementation
+                with thread_budget.reserve(
+                        1 if decode_impl == JPEG2000_IMPL_PILLOW else None) \
+                        as decode_threads:
+                    image = decode_jpeg2000(imgfile, reduce_=downsample,
+                            impl=decode_impl, threads=decode_threads,
+                            debug=debug)
                 if downsample:
                     downsampled = True
             else:
@@ -359,9 +516,15 @@ def insert_images_mrc(to_pdf, hocr_file, from_pdf=None, image_files=None,
             if timing_data is not None:
                 timing_data.append(('image_load', time()-t))
 
+        page_buf = None
         if grayscale_pdf and image.mode not in ('L', 'LA'):
             t = time()
-            image = Image.fromarray(special_gray_convert(np.array(image)))
+            # The levels only need the statistics of a subsample
+            page_buf = PageBuffer(special_gray_convert(
+                PageBuffer.from_image(image, trace=copy_trace).asarray(),
+                stats_step=gray_stats_step(image.size[1], image.size[0])),
+                'L', trace=copy_trace)
+            image = page_buf.image()
             if timing_data is not None:
                 timing_data.append(('special_gray_convert', time()-t))
 
@@ -371,118 +534,274 @@ def insert_images_mrc(to_pdf, hocr_file, from_pdf=None, image_files=None,
             w, h = image.size
             image.thumbnail((w/downsample, h/downsample),
                             resample=Image.LANCZOS, reducing_gap=None)
+            # thumbnail replaces the pixels, the buffer is stale now
+            page_buf = None
             downsampled = True
 
         hocr_word_data = hocr_page_to_word_data(hocr_page)
 
-        if image.mode == '1':
-            ww, hh = image.size
-            mask_jb2, mask_png = encode_mrc_mask(np.array(image), tmp_dir=tmp_dir,
-                    jbig2=jbig2, timing_data=timing_data, debug=debug)
-
+        blank_colour = None
+        page_class = None
+        if detect_blank_pages and image.mode in ('L', 'RGB'):
             t = time()
+            blank_colour = detect_blank_page(image, hocr_word_data)
+            if blank_colour is not None:
+                page_class = PAGE_CLASS_BLANK
+            if timing_data is not None:
+                timing_data.append(('page_classify', time() - t))
 
-            if jbig2:
-                mask_contents = open(mask_jb2, 'rb').read()
-                remove(mask_jb2)
+        # Leave high quality pages alone
+        if auto_page_mode and page_class is None and not render_hq and \
+                image.mode in ('L', 'RGB'):
+            t = time()
+            page_class = classify_page(image,
+                    gray_max_chroma_spread=gray_max_chroma_spread,
+                    bitonal_min_bimodality=bitonal_min_bimodality)
+            if timing_data is not None:
+                timing_data.append(('page_classify', time() - t))
+
+            if page_class in (PAGE_CLASS_GRAY, PAGE_CLASS_BITONAL) and \
+                    image.mode == 'RGB':
+                t = time()
+                image = image.convert('L')
+                page_buf = None
+                if timing_data is not None:
+                    timing_data.append(('grey_conversion', time() - t))
+
+        if page_class is not None and page_routing is not None:
+            page_routing[page_class] = page_routing.get(page_class, 0) + 1
+
+        # Blank pages are deduplicated on their (tiny) encoded stream only, and
+        # pages are not skipped if their images have to be written to img_dir
+        dedup_page = dedup_images and img_dir is None
+        pixel_digest = None
+        if blank_colour is None and (dedup_page or mrc_cache is not None):
+            t = time()
+            if image.mode == '1':
+                pixels = image.tobytes()
             else:
-                mask_contents = open(mask_png, 'rb').read()
+                if page_buf is None:
+                    page_buf = PageBuffer.from_image(image, trace=copy_trace)
+                pixels = page_buf.asarray()
 
-            # We currently always return the PNG file
-            remove(mask_png)
+            pixel_digest = hashlib.blake2b(pixels, digest_size=20).digest()
+            pixels = None
+            if timing_data is not None:
+                timing_data.append(('page_hash', time() - t))
 
-            page.insert_image(page.rect, stream=mask_contents,
-                    width=ww, height=hh, alpha=0)
+        page_key = None
+        if dedup_page and pixel_digest is not None:
+            page_key = page_pixel_key(pixel_digest, image.mode, image.size,
+                                      render_hq, page_class, picked_dpi,
+                                      hocr_word_data)
 
+        # (xref, overlay) of the images inserted on this page
+        page_xrefs = []
+
+        if page_key is not None and page_key in page_images:
+            t = time()
+            for xref, overlay in page_images[page_key]:
+                page.insert_image(page.rect, xref=xref, overlay=overlay)
+            dedup_pages += 1
+            page_key = None
             if timing_data is not None:
-                timing_data.append(('page_image_insertion', time() - t))
+                timing_data.append(('page_image_dedup', time() - t))
 
-        elif force_1bit_output == True:
-            ww, hh = image.size
-            mrc_gen = create_mrc_hocr_components(image, hocr_word_data,
-                    dpi=picked_dpi,
-                    downsample=downsample,
-                    bg_downsample=None if render_hq else bg_downsample,
-                    fg_downsample=None if render_hq else fg_downsample,
-                    denoise_mask=denoise_mask,
-                    timing_data=timing_data, errors=errors)
-            np_mask = next(mrc_gen)
-            np_mask = np_mask ^ np.ones(np_mask.shape, dtype=bool)
-            mask_jb2, mask_png = encode_mrc_mask(np_mask, tmp_dir=tmp_dir, jbig2=jbig2,
-                    timing_data=timing_data, debug=debug)
+        elif blank_colour is not None:
+            t = time()
+            blank_contents = create_blank_page_image(image.mode, blank_colour)
+            blank_gray = image.mode == 'L'
+            xref, dup = insert_image_dedup(page, stream_xrefs,
+                    (blank_contents,),
+                    lambda: fast_insert_image(page, page.rect,
+                        stream=blank_contents, width=1, height=1,
+                        stream_fmt=COMPRESSOR_FLATE, gray=blank_gray))
+            dedup_streams += dup
+            page_xrefs.append((xref, True))
+            if timing_data is not None:
+                timing_data.append(('blank_page', time() - t))
 
-            if jbig2:
-                mask_contents = open(mask_jb2, 'rb').read()
-                remove(mask_jb2)
-            else:
-                mask_contents = open(mask_png, 'rb').read()
+        elif image.mode == '1':
+            ww, hh = image.size
+            mask_contents = encode_mask_stream(PackedMask.from_pil(image),
+                    mask_fmt, tmp_dir=tmp_dir, timing_data=timing_data,
+                    debug=debug)
 
-            # We currently always return the PNG file
-            remove(mask_png)
+            t = time()
 
-            page.insert_image(page.rect, stream=mask_contents,
-                    width=ww, height=hh, alpha=0)
+            xref, dup = insert_image_dedup(page, stream_xrefs,
+                    (mask_contents,),
+                    lambda: fast_insert_image(page, page.rect,
+                        stream=mask_contents, width=ww, height=hh,
+                        stream_fmt=mask_fmt, bits=1))
+            dedup_streams += dup
+            page_xrefs.append((xref, True))
 
             if timing_data is not None:
                 timing_data.append(('page_image_insertion', time() - t))
-        else:
-            mrc_gen = create_mrc_hocr_components(image, hocr_word_data,
+
+        elif force_1bit_output == True or page_class == PAGE_CLASS_BITONAL:
+            ww, hh = image.size
+            if page_buf is None:
+                page_buf = PageBuffer.from_image(image, trace=copy_trace)
+            image = None
+
+            mrc_gen = create_mrc_hocr_components(page_buf, hocr_word_data,
                     dpi=picked_dpi,
                     downsample=downsample,
                     bg_downsample=None if render_hq else bg_downsample,
                     fg_downsample=None if render_hq else fg_downsample,
                     denoise_mask=denoise_mask,
+                    fill_mode=fill_mode,
+                    strip_height=strip_height,
                     timing_data=timing_data, errors=errors)
+            np_mask = next(mrc_gen)
+            mask_contents = encode_mask_stream(np_mask, mask_fmt,
+                    tmp_dir=tmp_dir, timing_data=timing_data, debug=debug)
+            np_mask = None
 
+            t = time()
 
-            # TODO: keep all these files on disk, and insert them into the pager
-            # later? maybe? or just saveIncr()
-            # TODO: maybe call the encode_mrc_{mask,foreground,background}
-            # separately from here so that we can free the arrays sooner (and even
-            # get the images separately from the create_mrc_hocr_components call)
-
-            fast_insert_image_ok = jbig2 and image.mode in ('L', 'RGB')
+            # The mask has the text set, invert it with /Decode rather than
+            # inverting the pixels
+            xref, dup = insert_image_dedup(page, stream_xrefs,
+                    (mask_contents, b'[1 0]'),
+                    lambda: fast_insert_image(page, page.rect,
+                        stream=mask_contents, width=ww, height=hh,
+                        stream_fmt=mask_fmt, bits=1, decode='[1 0]'))
+            dedup_streams += dup
+            page_xrefs.append((xref, True))
 
-            mask_f, bg_f, bg_s, fg_f, fg_s = encode_mrc_images(mrc_gen,
-                    bg_compression_flags=hq_bg_compression_flags if render_hq else bg_compression_flags,
-                    fg_compression_flags=hq_fg_compression_flags if render_hq else fg_compression_flags,
-                    tmp_dir=tmp_dir, jbig2=jbig2, timing_data=timing_data,
-                    jpeg2000_implementation=jpeg2000_implementation,
-                    mrc_image_format=mrc_image_format,
-                    embedded_jbig2=fast_insert_image_ok,
-                    threads=threads,
-                    debug=debug)
+            if timing_data is not None:
+                timing_data.append(('page_image_insertion', time() - t))
+        else:
+            # From here on only the page buffer holds the pixels
+            if page_buf is None:
+                page_buf = PageBuffer.from_image(image, trace=copy_trace)
+            image = None
+
+            # Other modes are left to PyMuPDF to figure out
+            page_mask_fmt = mask_fmt if page_buf.mode in ('L', 'RGB') else None
+            fast_insert_image_ok = page_mask_fmt is not None
+
+            # High quality pages are not subject to the size budget
+            page_rate_control = None if render_hq else rate_control
+
+            page_bg_compression_flags = hq_bg_compression_flags if render_hq \
+                    else bg_compression_flags
+            page_fg_compression_flags = hq_fg_compression_flags if render_hq \
+                    else fg_compression_flags
+
+            cache_key = None
+            cached = None
+            if mrc_cache is not None:
+                t = time()
+                cache_key = mrc_cache.key(pixel_digest, VERSION,
+                        page_buf.mode, page_buf.size, picked_dpi,
+                        hocr_word_data, page_bg_compression_flags,
+                        page_fg_compression_flags, jbig2, page_mask_fmt,
+                        fast_insert_image_ok, jpeg2000_implementation,
+                        mrc_image_format, downsample,
+                        None if render_hq else bg_downsample,
+                        None if render_hq else fg_downsample,
+                        denoise_mask, fill_mode, strip_height,
+                        None if page_rate_control is None else
+                        (page_rate_control.bpp['bg'],
+                         page_rate_control.bpp['fg']))
+                cached = mrc_cache.get(cache_key, tmp_dir=tmp_dir)
+                if timing_data is not None:
+                    timing_data.append(('mrc_cache', time() - t))
+
+            if cached is not None:
+                mask_f, bg_f, bg_s, fg_f, fg_s = cached
+            else:
+                mrc_gen = create_mrc_hocr_components(page_buf, hocr_word_data,
+                        dpi=picked_dpi,
+                        downsample=downsample,
+                        bg_downsample=None if render_hq else bg_downsample,
+                        fg_downsample=None if render_hq else fg_downsample,
+                        denoise_mask=denoise_mask,
+                        fill_mode=fill_mode,
+                        strip_height=strip_height,
+                        timing_data=timing_data, errors=errors)
+
+
+                # TODO: keep all these files on disk, and insert them into the pager
+                # later? maybe? or just saveIncr()
+                # TODO: maybe call the encode_mrc_{mask,foreground,background}
+                # separately from here so that we can free the arrays sooner (and even
+                # get the images separately from the create_mrc_hocr_components call)
+
+                mask_f, bg_f, bg_s, fg_f, fg_s = encode_mrc_images(mrc_gen,
+                        bg_compression_flags=page_bg_compression_flags,
+                        fg_compression_flags=page_fg_compression_flags,
+                        tmp_dir=tmp_dir, jbig2=jbig2, timing_data=timing_data,
+                        jpeg2000_implementation=jpeg2000_implementation,
+                        mrc_image_format=mrc_image_format,
+                        embedded_jbig2=jbig2 and fast_insert_image_ok,
+                        ccitt=page_mask_fmt == COMPRESSOR_CCITT,
+                        flate=page_mask_fmt == COMPRESSOR_FLATE,
+                        rate_control=page_rate_control,
+                        threads=threads,
+                        thread_budget=thread_budget,
+                        debug=debug)
+
+                if mrc_cache is not None:
+                    t = time()
+                    mrc_cache.put(cache_key, mask_f, bg_f, bg_s, fg_f, fg_s)
+                    if timing_data is not None:
+                        timing_data.append(('mrc_cache', time() - t))
 
             if img_dir is not None:
-                shutil.copy(mask_f, join(img_dir, '%.6d_mask.jbig2' % idx))
+                mask_ext = {COMPRESSOR_CCITT: 'g4',
+                            COMPRESSOR_FLATE: 'zlib'}.get(page_mask_fmt,
+                                                          'jbig2')
+                shutil.copy(mask_f, join(img_dir, '%.6d_mask.%s' % (idx,
+                                                                    mask_ext)))
                 shutil.copy(bg_f, join(img_dir, '%.6d_bg.jp2' % idx))
                 shutil.copy(fg_f, join(img_dir, '%.6d_fg.jp2' % idx))
 
 
             t = time()
             bg_contents = open(bg_f, 'rb').read()
-            if not jbig2 or image.mode not in ('L', 'RGB'):
+            gray = page_buf.mode == 'L'
+            if not fast_insert_image_ok:
                 # Tell PyMuPDF about width/height/alpha since it's faster this way
-                page.insert_image(page.rect, stream=bg_contents, mask=None,
-                    overlay=False, width=bg_s[0], height=bg_s[1], alpha=0)
+                insert_bg = lambda: page.insert_image(page.rect,
+                    stream=bg_contents, mask=None, overlay=False,
+                    width=bg_s[0], height=bg_s[1], alpha=0)
+                bg_overlay = False
             else:
-                fast_insert_image(page, page.rect, stream=bg_contents,
-                                  mask=None, width=bg_s[0], height=bg_s[1],
-                                  stream_fmt=mrc_image_format,
-                                  gray=image.mode == 'L')
+                insert_bg = lambda: fast_insert_image(page, page.rect,
+                    stream=bg_contents, mask=None, width=bg_s[0],
+                    height=bg_s[1], stream_fmt=mrc_image_format, gray=gray)
+                bg_overlay = True
+
+            xref, dup = insert_image_dedup(page, stream_xrefs,
+                    (bg_contents, None), insert_bg, overlay=bg_overlay)
+            dedup_streams += dup
+            page_xrefs.append((xref, bg_overlay))
 
             fg_contents = open(fg_f, 'rb').read()
             mask_contents = open(mask_f, 'rb').read()
 
             # Tell PyMuPDF about width/height/alpha since it's faster this way
-            if not jbig2 or image.mode not in ('L', 'RGB'):
-                page.insert_image(page.rect, stream=fg_contents, mask=mask_contents,
-                        overlay=True, width=fg_s[0], height=fg_s[1], alpha=0)
+            if not fast_insert_image_ok:
+                insert_fg = lambda: page.insert_image(page.rect,
+                    stream=fg_contents, mask=mask_contents, overlay=True,
+                    width=fg_s[0], height=fg_s[1], alpha=0)
             else:
-                fast_insert_image(page, page.rect, stream=fg_contents,
-                                  mask=mask_contents, width=fg_s[0], height=fg_s[1],
-                                  stream_fmt=mrc_image_format,
-                                  gray=image.mode == 'L')
+                insert_fg = lambda: fast_insert_image(page, page.rect,
+                    stream=fg_contents, mask=mask_contents, width=fg_s[0],
+                    height=fg_s[1], stream_fmt=mrc_image_format,
+                    mask_fmt=page_mask_fmt,
+                    gray=gray, mask_width=page_buf.width,
+                    mask_height=page_buf.height)
+
+            xref, dup = insert_image_dedup(page, stream_xrefs,
+                    (fg_contents, mask_contents), insert_fg)
+            dedup_streams += dup
+            page_xrefs.append((xref, True))
 
             # Remove leftover files
             remove(mask_f)
@@ -491,6 +810,9 @@ def insert_images_mrc(to_pdf, hocr_file, from_pdf=None, image_files=None,
             if timing_data is not None:
                 timing_data.append(('page_image_insertion', time() - t))
 
+        if page_key is not None and page_xrefs:
+            page_images[page_key] = page_xrefs
+
         reporting_page_count += 1
 
         if report_every is not None and reporting_page_count % report_every == 0:
@@ -529,6 +851,10 @@ def insert_images_mrc(to_pdf, hocr_file, from_pdf=None, image_files=None,
     if verbose:
         summary = get_timing_summary(timing_data)
         print('MRC time breakdown:', summary)
+        print('MRC page buffer copies:', get_copy_summary(copy_trace))
+        if dedup_images:
+            print('Deduplicated images: %d pages, %d streams' % (dedup_pages,
+                                                                 dedup_streams))
 
 
 def insert_images(from_pdf, to_pdf, mode, report_every=None, stop_after=None):
@@ -536,6 +862,9 @@ def insert_images(from_pdf, to_pdf, mode, report_every=None, stop_after=None):
     # really.
     # TODO: implement img_dir here
 
+    # Objects copied (as is) from from_pdf so far, see graft_xref
+    xref_map = {}
+
     for idx, page in enumerate(to_pdf):
         # XXX: TODO: FIXME: MEGAHACK: For some reason the _imgonly PDFs
         # generated by us have all images on all pages according to pymupdf, so
@@ -546,8 +875,9 @@ def insert_images(from_pdf, to_pdf, mode, report_every=None, stop_after=None):
         xref = img[0]
         maskxref = img[1]
         if mode == IMAGE_MODE_PASSTHROUGH:
-            image = from_pdf.extract_image(xref)
-            page.insert_image(page.rect, stream=image["image"], overlay=False)
+            # Copy the image XObject (and its mask) without decoding it
+            new_xref = graft_xref(from_pdf, to_pdf, xref, xref_map)
+            page.insert_image(page.rect, xref=new_xref, overlay=False)
         elif mode == IMAGE_MODE_PIXMAP:
             pixmap = fitz.Pixmap(from_pdf, xref)
             page.insert_image(page.rect, pixmap=pixmap, overlay=False)
@@ -560,6 +890,254 @@ def insert_images(from_pdf, to_pdf, mode, report_every=None, stop_after=None):
             sys.stdout.flush()
 
 
+def parse_hq_pages(hq_pages, page_count):
+    """
+    Parse a list of (high quality) pages.
+
+    Args:
+
+    * hq_pages (str): comma separated list of 1-indexed page numbers,
+      negative numbers count from the end (-1 is the last page), or None
+    * page_count (int): amount of pages in the PDF
+
+    Returns a list with a bool for every page
+    """
+    HQ_PAGES = [False for x in range(page_count)]
+    if hq_pages is not None:
+        index_range = map(int, hq_pages.split(','))
+        for i in index_range:
+            # We want 0-indexed, not 1-indexed, but not negative numbers we want
+            # to remain 1-indexed.
+            if i > 0:
+                i = i - 1
+
+            if abs(i) >= len(HQ_PAGES):
+                # Page out of range, silently ignore for automation purposes.
+                # We don't want scripts that call out tool to worry about how
+                # many a PDF has exactly. E.g. if 1,2,3,4,-4,-3,-2,-1 is passed,
+                # and a PDF has only three pages, let's just set them all to HQ
+                # and not complain about 4 and -4 being out of range.
+                continue
+
+            # Mark page as HQ
+            HQ_PAGES[i] = True
+
+    return HQ_PAGES
+
+
+def refresh_text_layer(in_pdf, hocr_file, out_pdf=None, scandata_file=None,
+                       render_text_lines=False, verbose=False, debug=False,
+                       tmp_dir=None):
+    """
+    Replace the text layer of a PDF created by recode with a text layer
+    created from a (new) hOCR file, without touching the images, metadata
+    and structure tree.
+
+    Args:
+
+    * in_pdf (str): path to the PDF created by recode
+    * hocr_file (str): path to the hOCR file
+    * out_pdf (str): path to write the result to, if None (or the same as
+      in_pdf) in_pdf is updated with an incremental save
+    * scandata_file (str): scandata file of the item, for the pages to skip
+    * render_text_lines (bool): render the text visible instead of invisible
+    * tmp_dir (str): directory for the temporary text only PDF
+
+    Returns a dictionary with the errors (set) and the amount of pages.
+    """
+    errors = set()
+
+    start_time = time()
+
+    skip_pages = []
+    if scandata_file is not None:
+        skip_pages = scandata_xml_get_skip_pages(scandata_file)
+
+    doc = fitz.open(in_pdf)
+
+    fd, tess_tmp_path = mkstemp(prefix='pdfrenderer', suffix='.pdf', dir=tmp_dir)
+    os.close(fd)
+
+    if verbose:
+        print('Creating text only PDF')
+
+    # The page sizes of the existing PDF are the page sizes of its text layer
+    create_tess_textonly_pdf(hocr_file, tess_tmp_path, in_pdf=doc,
+            skip_pages=skip_pages, verbose=verbose, debug=debug,
+            render_text_lines=render_text_lines, tmp_dir=tmp_dir,
+            errors=errors)
+
+    text_doc = fitz.open(tess_tmp_path)
+    text_page_count = text_doc.page_count
+    page_count = doc.page_count
+    if text_page_count != page_count:
+        text_doc.close()
+        doc.close()
+        remove(tess_tmp_path)
+        raise ValueError('Number of pages in hOCR (%d) does not match the '
+                         'number of pages in the PDF (%d)' %
+                         (text_page_count, page_count))
+
+    if verbose:
+        print('Replacing text layers')
+
+    xref_map = {}
+    for idx in range(page_count):
+        replace_text_layer(doc[idx], text_doc[idx], xref_map)
+
+    text_doc.close()
+    remove(tess_tmp_path)
+
+    if out_pdf is None or os.path.abspath(out_pdf) == os.path.abspath(in_pdf):
+        doc.save(in_pdf, incremental=True,
+                 encryption=fitz.PDF_ENCRYPT_KEEP)
+    else:
+        doc.save(out_pdf, deflate=True, pretty=True)
+
+    doc.close()
+
+    if verbose:
+        print('Replaced the text layer of %d pages in %.2f seconds' %
+              (page_count, time() - start_time))
+
+    return {'errors': errors, 'pages': page_count}
+
+
+def reencode_pages(in_pdf, hq_pages, hocr_file, from_pdf=None,
+                   from_imagestack=None, dpi=None, scandata_file=None,
+                   out_pdf=None, jbig2=False, verbose=False, debug=False,
+                   tmp_dir=None, jpeg2000_implementation=JPEG2000_IMPL_PILLOW,
+                   hq_bg_compression_flags=None, hq_fg_compression_flags=None,
+                   mrc_image_format=None, downsample=None, denoise_mask=None,
+                   fill_mode=FILL_BOX, strip_height=None, threads=None,
+                   grayscale_pdf=False, force_1bit_output=False,
+                   jpeg2000_decode_implementation=None, incremental=False):
+    """
+    Encode some pages of a PDF created by recode again, in high quality,
+    without touching the other pages.
+
+    The page images are created (with MRC) from the original input again,
+    with the high quality compression flags. The old images are removed from
+    the pages and the new images are inserted.
+
+    Args:
+
+    * in_pdf (str): path to the PDF created by recode
+    * hq_pages (str): pages to encode again, see parse_hq_pages
+    * hocr_file (str): path to the hOCR file used to create in_pdf
+    * from_pdf (str): input PDF used to create in_pdf
+    * from_imagestack (str): glob of the input images used to create in_pdf
+    * out_pdf (str): path to write the result to, if None (or the same as
+      in_pdf) in_pdf is updated in place
+    * incremental (bool): update in_pdf in place with an incremental save.
+      This is faster, but the replaced images stay in the file (unused), so
+      the file grows by their size every time. By default the file is saved
+      in full, without the unused objects.
+
+    The other arguments are like the arguments of recode, and have to match
+    the ones used to create in_pdf.
+
+    Returns a dictionary with the errors (set), the amount of pages that were
+    encoded again, and the size of the PDF before and after (in bytes).
+    """
+    errors = set()
+
+    start_time = time()
+
+    jpeg2000_implementation, jpeg2000_decode_implementation = \
+            resolve_jpeg2000_impls(jpeg2000_implementation,
+                                   jpeg2000_decode_implementation,
+                                   tmp_dir=tmp_dir)
+
+    skip_pages = []
+    dpi_pages = None
+    if scandata_file is not None:
+        skip_pages = scandata_xml_get_skip_pages(scandata_file)
+        dpi_pages = scandata_xml_get_dpi_per_page(scandata_file)
+        scandata_doc_dpi = scandata_xml_get_document_dpi(scandata_file)
+
+        if scandata_doc_dpi is not None:
+            dpi = scandata_doc_dpi
+
+    source_pdf = None
+    if from_pdf:
+        source_pdf = fitz.open(from_pdf)
+
+    image_files = None
+    if from_imagestack:
+        image_files = sorted(glob(from_imagestack))
+
+    doc = fitz.open(in_pdf)
+
+    hq = parse_hq_pages(hq_pages, doc.page_count)
+    pages = set([idx for idx, render_hq in enumerate(hq) if render_hq])
+
+    for idx in sorted(pages):
+        remove_page_images(doc[idx])
+
+    insert_images_mrc(doc, hocr_file,
+                      from_pdf=source_pdf,
+                      image_files=image_files,
+                      dpi=dpi,
+                      dpi_pages=dpi_pages,
+                      skip_pages=skip_pages,
+                      jbig2=jbig2,
+                      downsample=downsample,
+                      denoise_mask=denoise_mask,
+                      fill_mode=fill_mode,
+                      strip_height=strip_height,
+                      hq_pages=hq,
+                      hq_bg_compression_flags=hq_bg_compression_flags,
+                      hq_fg_compression_flags=hq_fg_compression_flags,
+                      verbose=verbose,
+                      debug=debug,
+                      tmp_dir=tmp_dir,
+                      jpeg2000_implementation=jpeg2000_implementation,
+                      mrc_image_format=mrc_image_format,
+                      threads=threads,
+                      grayscale_pdf=grayscale_pdf,
+                      force_1bit_output=force_1bit_output,
+                      pages=pages,
+                      jpeg2000_decode_implementation=jpeg2000_decode_implementation,
+                      errors=errors)
+
+    size_before = os.path.getsize(in_pdf)
+
+    in_place = out_pdf is None or \
+            os.path.abspath(out_pdf) == os.path.abspath(in_pdf)
+    if in_place and incremental:
+        doc.save(in_pdf, incremental=True,
+                 encryption=fitz.PDF_ENCRYPT_KEEP)
+    elif in_place:
+        # A full save cannot overwrite the open file, write next to it and
+        # move it over in_pdf. garbage=1 drops the replaced images.
+        fd, tmp_path = mkstemp(prefix='reencode', suffix='.pdf',
+                               dir=os.path.dirname(os.path.abspath(in_pdf)))
+        os.close(fd)
+        doc.save(tmp_path, garbage=1, deflate=True, pretty=True)
+        doc.close()
+        doc = None
+        os.replace(tmp_path, in_pdf)
+    else:
+        doc.save(out_pdf, garbage=1, deflate=True, pretty=True)
+
+    if doc is not None:
+        doc.close()
+    if source_pdf is not None:
+        source_pdf.close()
+
+    size_after = os.path.getsize(in_pdf if in_place else out_pdf)
+
+    if verbose:
+        print('Encoded %d pages again in %.2f seconds' %
+              (len(pages), time() - start_time))
+        print('PDF size: %d bytes before, %d bytes after' %
+              (size_before, size_after))
+
+    return {'errors': errors, 'pages': len(pages), 'size_before': size_before,
+            'size_after': size_after}
+
+
 # TODO: Document these options (like in bin/recode_pdf)
 def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
         scandata_file=None, out_pdf=None, out_dir=None,
@@ -583,12 +1161,36 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
         metadata_url=None, metadata_title=None, metadata_author=None,
         metadata_creator=None, metadata_language=None,
         metadata_subject=None, metadata_creatortool=None,
-        ignore_invalid_pagenumbers=False):
+        ignore_invalid_pagenumbers=False,
+        fill_mode=FILL_BOX, strip_height=None, detect_blank_pages=False,
+        auto_page_mode=False, gray_max_chroma_spread=GRAY_MAX_CHROMA_SPREAD,
+        bitonal_min_bimodality=BITONAL_MIN_BIMODALITY, dedup_images=True,
+        mrc_cache_dir=None, mrc_cache_size=DEFAULT_CACHE_SIZE,
+        bg_target_bpp=None, fg_target_bpp=None,
+        jpeg2000_decode_implementation=None):
     # TODO: document that the scandata document dpi will override the dpi arg
     # TODO: Take hq-pages and reporter arg and change format (as lib call we
     # don't want to pass that as one string, I guess?)
 
     errors = set()
+    page_routing = {}
+
+    mrc_cache = None
+    if mrc_cache_dir is not None:
+        mrc_cache = MRCCache(mrc_cache_dir, max_size=mrc_cache_size)
+
+    rate_control = None
+    if bg_target_bpp is not None or fg_target_bpp is not None:
+        rate_control = RateControl(bg_bpp=bg_target_bpp, fg_bpp=fg_target_bpp)
+
+    thread_budget = ThreadBudget(threads)
+
+    # Decoding can use a different implementation than encoding, and either
+    # can be picked by benchmarking the installed implementations
+    jpeg2000_implementation, jpeg2000_decode_implementation = \
+            resolve_jpeg2000_impls(jpeg2000_implementation,
+                                   jpeg2000_decode_implementation,
+                                   tmp_dir=tmp_dir)
 
     in_pdf = None
     if from_pdf:
@@ -647,7 +1249,7 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
             verbose=verbose, debug=debug, stop_after=stop,
             render_text_lines=render_text_lines,
             tmp_dir=tmp_dir,
-            jpeg2000_implementation=jpeg2000_implementation,
+            jpeg2000_implementation=jpeg2000_decode_implementation,
             errors=errors)
 
     if verbose:
@@ -656,25 +1258,7 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
     # We open the generated file but do not modify it in place
     outdoc = fitz.open(tess_tmp_path)
 
-    HQ_PAGES = [False for x in range(outdoc.page_count)]
-    if hq_pages is not None:
-        index_range = map(int, hq_pages.split(','))
-        for i in index_range:
-            # We want 0-indexed, not 1-indexed, but not negative numbers we want
-            # to remain 1-indexed.
-            if i > 0:
-                i = i - 1
-
-            if abs(i) >= len(HQ_PAGES):
-                # Page out of range, silently ignore for automation purposes.
-                # We don't want scripts that call out tool to worry about how
-                # many a PDF has exactly. E.g. if 1,2,3,4,-4,-3,-2,-1 is passed,
-                # and a PDF has only three pages, let's just set them all to HQ
-                # and not complain about 4 and -4 being out of range.
-                continue
-
-            # Mark page as HQ
-            HQ_PAGES[i] = True
+    HQ_PAGES = parse_hq_pages(hq_pages, outdoc.page_count)
 
 
     if verbose:
@@ -694,6 +1278,16 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
                           bg_downsample=bg_downsample,
                           fg_downsample=fg_downsample,
                           denoise_mask=denoise_mask,
+                          fill_mode=fill_mode,
+                          strip_height=strip_height,
+                          detect_blank_pages=detect_blank_pages,
+                          auto_page_mode=auto_page_mode,
+                          gray_max_chroma_spread=gray_max_chroma_spread,
+                          bitonal_min_bimodality=bitonal_min_bimodality,
+                          page_routing=page_routing,
+                          dedup_images=dedup_images,
+                          mrc_cache=mrc_cache,
+                          rate_control=rate_control,
                           reporter=reporter,
                           hq_pages=HQ_PAGES,
                           hq_bg_compression_flags=hq_bg_compression_flags,
@@ -708,6 +1302,8 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
                           jpeg2000_implementation=jpeg2000_implementation,
                           mrc_image_format=mrc_image_format,
                           threads=threads,
+                          jpeg2000_decode_implementation=jpeg2000_decode_implementation,
+                          thread_budget=thread_budget,
                           errors=errors)
     elif image_mode in (0, 1):
         # TODO: Update this codepath
@@ -792,5 +1388,25 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
     outdoc.close()
     remove(tess_tmp_path)
 
-    return {'errors': errors,
-            'compression_ratio': compression_ratio}
+    if verbose and page_routing:
+        print('Page routing:', page_routing)
+
+    res = {'errors': errors,
+           'compression_ratio': compression_ratio,
+           'page_routing': page_routing}
+
+    if mrc_cache is not None:
+        res['mrc_cache'] = mrc_cache.get_stats()
+        if verbose:
+            print('MRC cache:', res['mrc_cache'])
+
+    if rate_control is not None:
+        res['rate_control'] = rate_control.get_stats()
+        if verbose:
+            print('Rate control:', res['rate_control'])
+
+    res['thread_budget'] = thread_budget.get_stats()
+    if verbose:
+        print('Thread budget:', res['thread_budget'])
+
+    return res
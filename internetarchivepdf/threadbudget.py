@@ -0,0 +1,129 @@
+# archive-pdf-tools
+# Copyright (C) 2020-2021, Internet Archive
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Merlijn Boris Wolf Wajer <merlijn@archive.org>
+#
+# Division of the available cores between the stages of a page that run at
+# the same time.
+
+import os
+import threading
+from contextlib import contextmanager
+
+
+def available_cores():
+    """
+    Returns the amount of cores this process may run on
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on all platforms
+        return os.cpu_count() or 1
+
+
+class ThreadBudget(object):
+    """
+    Budget of threads, shared by the stages of the page pipeline that run at
+    the same time: creating the MRC components, encoding the mask, and
+    encoding (or decoding) the images with a codec that can use threads.
+
+    A stage asks for threads when it starts and gives them back when it is
+    done. It gets a fair share of what is free: the free threads divided over
+    the stages that are running (itself included), so a stage that starts
+    while others run does not starve, and a stage that runs alone gets all
+    threads. If no thread is free, the stage waits until another stage is
+    done, so the budget is never exceeded.
+    """
+
+    def __init__(self, threads=None):
+        """
+        Args:
+
+        * threads (int): amount of threads to divide, 0 for all available
+          cores, None for one (the default of --threads)
+        """
+        if threads is None:
+            threads = 1
+        elif threads == 0:
+            threads = available_cores()
+
+        self.total = max(1, int(threads))
+        self.free = self.total
+        self.active = 0
+
+        self.grants = 0
+        self.peak = 0
+
+        self._cond = threading.Condition()
+
+    def acquire(self, want=None):
+        """
+        Take threads from the budget, waiting until at least one is free.
+
+        Args:
+
+        * want (int): most threads the stage can use, None for no limit
+
+        Returns the amount of threads the stage may use (int), which has to
+        be given back with release.
+        """
+        with self._cond:
+            while self.free < 1:
+                self._cond.wait()
+
+            share = self.free // (self.active + 1)
+            if want is not None:
+                share = min(share, want)
+            granted = max(1, share)
+
+            self.free -= granted
+            self.active += 1
+
+            self.grants += 1
+            self.peak = max(self.peak, self.total - self.free)
+
+        return granted
+
+    def release(self, granted):
+        """
+        Give back threads that acquire handed out.
+        """
+        with self._cond:
+            self.free += granted
+            self.active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, want=None):
+        """
+        Context manager around acquire and release, that yields the amount
+        of threads the stage may use.
+        """
+        granted = self.acquire(want)
+        try:
+            yield granted
+        finally:
+            self.release(granted)
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the size of the budget, the amount of
+        handed out reservations and the most threads that were in use at the
+        same time.
+        """
+        return {'threads': self.total, 'grants': self.grants,
+                'peak': self.peak}
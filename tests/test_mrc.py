@@ -0,0 +1,32 @@
+from PIL import Image
+
+from internetarchivepdf import mrc
+from internetarchivepdf.bitmask import PackedMask
+
+
+def _encode_page_mask():
+    # A4 at 300 dpi
+    try:
+        mrc.encode_ccitt_g4(PackedMask(2480, 3508))
+    except ValueError:
+        return False
+    return True
+
+
+def test_ccitt_available_page_sized_mask():
+    assert mrc.ccitt_available() == _encode_page_mask()
+
+
+def test_ccitt_available_without_strip_size(monkeypatch):
+    # Older Pillow versions ignore strip_size, and write a strip per 64 KiB
+    save = Image.Image.save
+
+    def save_without_strip_size(self, fp, format=None, **params):
+        params.pop('strip_size', None)
+        return save(self, fp, format=format, **params)
+
+    monkeypatch.setattr(Image.Image, 'save', save_without_strip_size)
+    monkeypatch.setattr(mrc, '_CCITT_INVERT', None)
+
+    assert not _encode_page_mask()
+    assert not mrc.ccitt_available()
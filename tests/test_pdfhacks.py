@@ -0,0 +1,99 @@
+import re
+
+import fitz
+import pytest
+
+from internetarchivepdf.pdfhacks import parent_tree_ranges, write_basic_ua, \
+        graft_xref, PARENTTREE_KID_SIZE
+
+
+@pytest.mark.parametrize('page_count, ranges', [
+    (1, [(0, 1)]),
+    (31, [(0, 31)]),
+    (32, [(0, 32)]),
+    (33, [(0, 32), (32, 33)]),
+    (64, [(0, 32), (32, 64)]),
+    (65, [(0, 32), (32, 64), (64, 65)]),
+])
+def test_parent_tree_ranges(page_count, ranges):
+    assert PARENTTREE_KID_SIZE == 32
+    assert parent_tree_ranges(page_count) == ranges
+
+
+def _ref(doc, xref, key):
+    typ, val = doc.xref_get_key(xref, key)
+    assert typ == 'xref'
+    return int(val.split()[0])
+
+
+@pytest.mark.parametrize('page_count', [1, 31, 32, 33, 64, 65])
+def test_write_basic_ua_parent_tree(page_count):
+    doc = fitz.open()
+    for _ in range(page_count):
+        doc.new_page()
+
+    write_basic_ua(doc)
+
+    root = _ref(doc, doc.pdf_catalog(), 'StructTreeRoot')
+    parent_tree = _ref(doc, root, 'ParentTree')
+    typ, kids = doc.xref_get_key(parent_tree, 'Kids')
+    assert typ == 'array'
+    kids = [int(xref) for xref in re.findall(r'(\d+) 0 R', kids)]
+
+    keys = []
+    for kid in kids:
+        typ, limits = doc.xref_get_key(kid, 'Limits')
+        assert typ == 'array'
+        low, high = [int(x) for x in limits.strip('[]').split()]
+
+        typ, nums = doc.xref_get_key(kid, 'Nums')
+        assert typ == 'array'
+        # Key followed by the (inline) array of structure elements
+        kid_keys = [int(x) for x in re.findall(r'(\d+)\s*\[', nums)]
+
+        assert kid_keys
+        assert (low, high) == (kid_keys[0], kid_keys[-1])
+        keys += kid_keys
+
+    assert keys == list(range(page_count))
+
+
+def test_graft_xref_rewrites_only_references():
+    from_doc = fitz.open()
+    target = from_doc.get_new_xref()
+    from_doc.update_object(target, '<< /Type /Test >>')
+    xref = from_doc.get_new_xref()
+    from_doc.update_object(xref, '<< /Ref %d 0 R /Text (see %d 0 R \\( ) '
+                           '/Hex <3120302052> /Arr [ %d 0 R 5 ] >>'
+                           % (target, target, target))
+
+    to_doc = fitz.open()
+    # Make sure the xrefs differ between the documents
+    for _ in range(5):
+        to_doc.get_new_xref()
+    xref_map = {}
+    new_xref = graft_xref(from_doc, to_doc, xref, xref_map)
+    new_target = xref_map[target]
+    assert new_target != target
+
+    assert to_doc.xref_get_key(new_xref, 'Ref') == ('xref',
+                                                    '%d 0 R' % new_target)
+    assert to_doc.xref_get_key(new_xref, 'Arr') == ('array',
+                                                    '[%d 0 R 5]' % new_target)
+    assert to_doc.xref_get_key(new_xref, 'Text')[1] == 'see %d 0 R ( ' % target
+    assert to_doc.xref_object(new_target) == from_doc.xref_object(target)
+
+
+def test_graft_xref_long_chain():
+    from_doc = fitz.open()
+    xrefs = [from_doc.get_new_xref() for _ in range(5000)]
+    from_doc.update_object(xrefs[-1], '<< /End true >>')
+    for xref, next_xref in zip(xrefs, xrefs[1:]):
+        from_doc.update_object(xref, '<< /Next %d 0 R >>' % next_xref)
+
+    to_doc = fitz.open()
+    xref_map = {}
+    graft_xref(from_doc, to_doc, xrefs[0], xref_map)
+
+    assert len(xref_map) == len(xrefs)
+    assert to_doc.xref_get_key(xref_map[xrefs[-1]], 'End') == ('bool', 'true')
@@ -0,0 +1,30 @@
+import pytest
+
+from internetarchivepdf.ratecontrol import rate_flags
+from internetarchivepdf.const import (JPEG2000_IMPL_KAKADU,
+        JPEG2000_IMPL_OPENJPEG, JPEG2000_IMPL_GROK, JPEG2000_IMPL_PILLOW,
+        COMPRESSOR_JPEG)
+
+
+@pytest.mark.parametrize('impl, flags, expected', [
+    (JPEG2000_IMPL_KAKADU, ['-slope', '44250', 'Cblk={32,32}', '-no_weights'],
+     ['Cblk={32,32}', '-no_weights', '-rate', '0.800000']),
+    (JPEG2000_IMPL_OPENJPEG, ['-r', '500', '-n', '5', '-q', '30'],
+     ['-n', '5', '-r', '30.000']),
+    (JPEG2000_IMPL_GROK, ['-r', '500'], ['-r', '30.000']),
+    (JPEG2000_IMPL_PILLOW,
+     ['quality_mode:"rates";quality_layers:[500];irreversible:True'],
+     ['irreversible:True;quality_mode:"rates";quality_layers:[30.000]']),
+    (JPEG2000_IMPL_PILLOW, None,
+     ['quality_mode:"rates";quality_layers:[30.000]']),
+])
+def test_rate_flags_keeps_other_flags(impl, flags, expected):
+    # 100x100 RGB in 1000 bytes: 0.8 bpp, ratio 30
+    assert rate_flags(1000, 100, 100, 3, jpeg2000_implementation=impl,
+                      flags=flags) == expected
+
+
+def test_rate_flags_jpeg():
+    flags = ['-S30', '-m', '90', '--all-progressive', '-S', '20']
+    assert rate_flags(10240, 100, 100, 3, mrc_image_format=COMPRESSOR_JPEG,
+                      flags=flags) == ['-m', '90', '--all-progressive', '-S10']